@@ -21,7 +21,6 @@ import sys
 import os
 import json
 from urllib import parse
-from berkeleydb.db import DB_SET_RANGE
 import falcon
 
 from .lib import autoBytes, validFamily
@@ -60,24 +59,13 @@ class AutocompleteResource:
 
         response = []
 
-        i = 0
-        cur = db.db.cursor()
         query_bytes = autoBytes(parse.quote(ident_prefix))
-        # Find "the smallest key greater than or equal to the specified key"
-        # https://docs.oracle.com/cd/E17276_01/html/api_reference/C/dbcget.html
-        # In practice this should mean "the key that starts with provided prefix"
-        # See docs about the default comparison function for B-Tree databases:
+        # Keys are in byte order: those that start with the prefix follow
+        # each other, see the default comparison function for B-Tree databases
         # https://docs.oracle.com/cd/E17276_01/html/api_reference/C/dbset_bt_compare.html
-        key, _ = cur.get(query_bytes, DB_SET_RANGE)
-        while i <= 10:
-            if key.startswith(query_bytes):
-                # If found key starts with the prefix, add to response
-                # and move to the next key
-                i += 1
-                response.append(process(key.decode("utf-8")))
-                key, _ = cur.next()
-            else:
-                # If found key does not start with the prefix, stop
+        for key in db.iter_prefix_keys(query_bytes):
+            response.append(process(key.decode("utf-8")))
+            if len(response) > 10:
                 break
 
         resp.status = falcon.HTTP_200
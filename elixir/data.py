@@ -24,6 +24,11 @@ from . import lib
 import os
 import os.path
 import errno
+import hashlib
+import struct
+import zlib
+from array import array
+from bisect import bisect_left
 
 deflist_regex = re.compile(b'(\d*)(\w)(\d*)(\w),?')
 deflist_macro_regex = re.compile('\dM\d+(\w)')
@@ -73,13 +78,38 @@ class DefList:
             yield maxId, None, None, None
 
     def append(self, id, type, line, family):
-        if type not in defTypeD:
+        self.extend([(id, type, line, family)])
+
+    def extend(self, entries):
+        '''Appends a list of (id, type, line, family) at once'''
+        parts = []
+        families = {}
+        for id, type, line, family in entries:
+            if type not in defTypeD:
+                continue
+            parts.append(str(id) + defTypeD[type] + str(line) + family)
+            families[family] = None
+        if not parts:
             return
-        p = str(id) + defTypeD[type] + str(line) + family
+
+        p = ','.join(parts)
         if self.data != b'':
             p = ',' + p
         self.data += p.encode()
-        self.add_family(family)
+        for family in families:
+            self.add_family(family)
+
+    def filter(self, keep):
+        '''Keeps the entries whose blob ID passes keep'''
+        entries = [e for e in deflist_regex.findall(self.data) if keep(int(e[0]))]
+        self.data = b','.join(b''.join(e) for e in entries)
+        self.families = b''
+        for e in entries:
+            self.add_family(e[3].decode())
+
+    def truncate(self, id):
+        '''Removes the entries of blob IDs greater than or equal to id'''
+        self.filter(lambda i: i < id)
 
     def pack(self):
         return self.data + b'#' + self.families
@@ -97,6 +127,13 @@ class DefList:
     def get_macros(self):
         return deflist_macro_regex.findall(self.data.decode()) or ''
 
+    def get_cache_families(self):
+        '''Returns the families whose definitions cache must contain this ident'''
+        families = self.get_families()
+        macros = self.get_macros()
+        return [family for family in lib.CACHED_DEFINITIONS_FAMILIES
+                if lib.compatibleFamily(families, family) or lib.compatibleMacro(macros, family)]
+
 class PathList:
     '''Stores associations between a blob ID and a file path.
         Inserted by update.py sorted by blob ID.'''
@@ -113,8 +150,11 @@ class PathList:
             yield maxId, None
 
     def append(self, id, path):
-        p = str(id).encode() + b' ' + path + b'\n'
-        self.data += p
+        self.extend([(id, path)])
+
+    def extend(self, entries):
+        '''Appends a list of (id, path) at once'''
+        self.data += b''.join(str(id).encode() + b' ' + path + b'\n' for id, path in entries)
 
     def pack(self):
         return self.data
@@ -138,12 +178,139 @@ class RefList:
             yield maxId, None, None
 
     def append(self, id, lines, family):
-        p = str(id) + ':' + lines + ':' + family + '\n'
+        self.extend([(id, lines, family)])
+
+    def extend(self, entries):
+        '''Appends a list of (id, lines, family) at once'''
+        p = ''.join(str(id) + ':' + lines + ':' + family + '\n' for id, lines, family in entries)
         self.data += p.encode()
 
+    def filter(self, keep):
+        '''Keeps the entries whose blob ID passes keep'''
+        self.data = b''.join(entry + b'\n' for entry in self.data.split(b'\n')[:-1]
+                             if keep(int(entry.split(b':', 1)[0])))
+
+    def truncate(self, id):
+        '''Removes the entries of blob IDs greater than or equal to id'''
+        self.filter(lambda i: i < id)
+
     def pack(self):
         return self.data
 
+class Checkpoint:
+    '''Progress of a tag being indexed by update.py: the range of IDs
+        of its new blobs, the stages to write once all tags are indexed, its
+        stages already written, and the stage being written with the idents
+        it changes, if any.
+        "last" is None while the IDs of the tag are being allocated.'''
+    def __init__(self, data=b'0 -\n\n\n'):
+        lines = data.split(b'\n')
+        first, last, *deferred = lines[0].decode().split(' ')
+        self.first = int(first)
+        self.last = int(last) if last != '-' else None
+        self.deferred = deferred
+        self.done = lines[1].decode().split()
+        self.writing = lines[2].decode() or None
+        self.idents = lines[3:] if self.writing else []
+
+    def pack(self):
+        last = str(self.last) if self.last is not None else '-'
+        return (f'{" ".join([str(self.first), last, *self.deferred])}\n'
+                f'{" ".join(self.done)}\n{self.writing or ""}\n'.encode() +
+                b'\n'.join(self.idents))
+
+class Snapshot:
+    '''Version indexed from a branch or a commit with update.py --ref: its
+        creation order, the ref it was taken from, the ranges of IDs of the
+        blobs that only snapshots may contain, and the tags indexed after it,
+        which may contain them too.'''
+    def __init__(self, data=b'0 \n\n'):
+        lines = data.split(b'\n')
+        seq, self.ref = lines[0].decode().split(' ', maxsplit=1)
+        self.seq = int(seq)
+        self.owned = [tuple(int(i) for i in r.split('-')) for r in lines[1].decode().split()]
+        self.tags = lines[2].split()
+
+    def iter_owned(self):
+        for first, last in self.owned:
+            yield from range(first, last)
+
+    # Replaces the owned ranges with the ones of a set of IDs
+    def set_owned(self, idxes):
+        self.owned = []
+        for idx in sorted(idxes):
+            if self.owned and self.owned[-1][1] == idx:
+                self.owned[-1] = (self.owned[-1][0], idx + 1)
+            else:
+                self.owned.append((idx, idx + 1))
+
+    def pack(self):
+        return (f'{self.seq} {self.ref}\n'
+                f'{" ".join(f"{first}-{last}" for first, last in self.owned)}\n'.encode() +
+                b' '.join(self.tags))
+
+class ZlibCodec:
+    '''Compresses the values of a table that are at least threshold bytes
+        long with zlib, with the preset dictionary number current (0 for
+        none). Compressed values are "\\1", the number of their dictionary
+        and the zlib stream, other values are stored as is: values of
+        tables with a codec never start with "\\1" otherwise. With current
+        None, values are only decoded.
+        Dictionaries and settings are stored in codecs.db, see
+        'utils/maintenance.py compress'.'''
+    marker = b'\1'
+
+    def __init__(self, dictionaries, current=None, threshold=512, level=6):
+        self.dictionaries = dictionaries # Number -> preset dictionary
+        self.current = current
+        self.threshold = threshold
+        self.level = level
+
+    # Returns the codec of a table from codecs.db, or None if its values
+    # were never compressed. Keys are "<table>" for the settings,
+    # "<current> <threshold> <level>", and "<table>:<n>" for dictionaries.
+    @staticmethod
+    def load(codecs, name):
+        dictionaries = {}
+        for key, value in codecs.iter_items():
+            table, _, n = key.partition(b':')
+            if table == name and n:
+                dictionaries[int(n)] = value
+        settings = codecs.get(name)
+        if settings is None and not dictionaries:
+            return None
+        elif settings is None:
+            return ZlibCodec(dictionaries)
+
+        current, threshold, level = map(int, settings.split(b' '))
+        return ZlibCodec(dictionaries, current, threshold, level)
+
+    def encode(self, val):
+        if self.current is None or len(val) < self.threshold:
+            if not val.startswith(self.marker):
+                return val
+            current = self.current or 0
+        else:
+            current = self.current
+
+        if current:
+            c = zlib.compressobj(self.level, zdict=self.dictionaries[current])
+        else:
+            c = zlib.compressobj(self.level)
+        data = self.marker + bytes([current]) + c.compress(val) + c.flush()
+        if len(data) >= len(val) and not val.startswith(self.marker):
+            return val
+        return data
+
+    def decode(self, val):
+        if not val.startswith(self.marker):
+            return val
+        n = val[1]
+        if n:
+            d = zlib.decompressobj(zdict=self.dictionaries[n])
+            return d.decompress(val[2:]) + d.flush()
+        return zlib.decompress(val[2:])
+
 class BsdDB:
     def __init__(self, filename, readonly, contentType, shared=False):
         self.filename = filename
@@ -157,6 +324,10 @@ class BsdDB:
             flags |= berkeleydb.db.DB_CREATE
             self.db.open(filename, flags=flags, mode=0o644, dbtype=berkeleydb.db.DB_BTREE)
         self.ctype = contentType
+        self.codec = None # ZlibCodec of the values, if they are compressed
+        # Writes since the table was opened, see update.py --report
+        self.puts = 0
+        self.put_bytes = 0
 
     def exists(self, key):
         key = lib.autoBytes(key)
@@ -164,27 +335,522 @@ class BsdDB:
 
     def get(self, key):
         key = lib.autoBytes(key)
-        p = self.db.get(key)
+        p = self.get_raw(key)
         return self.ctype(p) if p is not None else None
 
+    # Returns the bytes of the value of key, or None
+    def get_raw(self, key):
+        p = self.db.get(key)
+        if p is not None and self.codec is not None:
+            p = self.codec.decode(p)
+        return p
+
     def get_keys(self):
         return self.db.keys()
 
+    def iter_items(self):
+        # Walk the table with a cursor, in key order, without loading it whole
+        cur = self.db.cursor()
+        rec = cur.first()
+        while rec is not None:
+            key, value = rec
+            if self.codec is not None:
+                value = self.codec.decode(value)
+            yield key, self.ctype(value)
+            rec = cur.next()
+        cur.close()
+
+    # Yields the keys that start with prefix, in key order
+    def iter_prefix_keys(self, prefix):
+        prefix = lib.autoBytes(prefix)
+        cur = self.db.cursor()
+        # Moves to the smallest key greater than or equal to prefix, see
+        # https://docs.oracle.com/cd/E17276_01/html/api_reference/C/dbcget.html
+        rec = cur.set_range(prefix)
+        while rec is not None and rec[0].startswith(prefix):
+            yield rec[0]
+            rec = cur.next()
+        cur.close()
+
+    def delete(self, key):
+        key = lib.autoBytes(key)
+        self.db.delete(key)
+
     def put(self, key, val, sync=False):
         key = lib.autoBytes(key)
         val = lib.autoBytes(val)
         if type(val) is not bytes:
             val = val.pack()
-        self.db.put(key, val)
+        self.put_raw(key, val)
         if sync:
             self.db.sync()
 
+    def put_raw(self, key, val):
+        if self.codec is not None:
+            val = self.codec.encode(val)
+        self.puts += 1
+        self.put_bytes += len(val)
+        self.db.put(key, val)
+
+    def sync(self):
+        self.db.sync()
+
     def close(self):
         self.db.close()
 
     def __len__(self):
         return self.db.stat()["nkeys"]
 
+class RefListDB(BsdDB):
+    '''Table of RefList values. Values that grow larger than segment_size
+        are split into segments stored under "<key>\\0<n>" keys, and the key
+        itself stores a directory of the segments: "@" followed by one
+        "<n> <lowest id> <highest id> <size> <family>\\n" line per segment.
+        Each segment holds the entries of a single file family, so that
+        lookups can skip the families they do not show. Segments written
+        before families were recorded have none, and hold any family.
+        New entries are appended to the last segment of their family only.
+        With an IdentDict, values are keyed by the ID of their ident instead
+        of its name, see IdentDict. Methods still take and return names.'''
+    segment_size = 128*1024
+
+    def __init__(self, filename, readonly, shared=False, idents=None):
+        super().__init__(filename, readonly, RefList, shared=shared)
+        self.idents = idents
+
+    # Returns the key of the value of ident, or None if it has no ID
+    # add: give an ID to the ident if it has none
+    def get_ident_key(self, ident, add=False):
+        ident = lib.autoBytes(ident)
+        if self.idents is None:
+            return ident
+        id = self.idents.add(ident) if add else self.idents.get(ident)
+        return IdentDict.pack_id(id) if id is not None else None
+
+    # Returns the ident of a key, or None if its ID has no name
+    def get_key_ident(self, key):
+        if self.idents is None:
+            return key
+        return self.idents.names.get(key)
+
+    # Tells keys of idents from keys of segments
+    def is_ident_key(self, key):
+        if self.idents is None:
+            return b'\0' not in key
+        return len(key) == IdentDict.key_size
+
+    @staticmethod
+    def segment_key(key, n):
+        return key + b'\0' + str(n).encode()
+
+    @staticmethod
+    def parse_directory(value):
+        segments = []
+        for line in value[1:].split(b'\n')[:-1]:
+            n, lo, hi, size, *family = line.split(b' ')
+            segments.append([int(n), int(lo), int(hi), int(size), family[0] if family else b''])
+        return segments
+
+    @staticmethod
+    def pack_directory(segments):
+        return b'@' + b''.join(b'%d %d %d %d %s\n' % tuple(seg) for seg in segments)
+
+    @staticmethod
+    def get_id_range(data):
+        ids = [int(entry.split(b':', 1)[0]) for entry in data.split(b'\n')[:-1]]
+        return min(ids), max(ids)
+
+    # Returns family -> entries of data, in order
+    @staticmethod
+    def split_families(data):
+        parts = {}
+        for entry in data.split(b'\n')[:-1]:
+            family = entry.rsplit(b':', 1)[1]
+            parts.setdefault(family, []).append(entry + b'\n')
+        return parts
+
+    def exists(self, ident):
+        key = self.get_ident_key(ident)
+        return key is not None and self.db.exists(key)
+
+    # idxes: if set, sorted list of ids, segments that have none of them are skipped
+    # families: if set, list of families, segments of other families are skipped
+    def get(self, ident, idxes=None, families=None):
+        key = self.get_ident_key(ident)
+        if key is None:
+            return None
+        return self.get_value(key, idxes, families)
+
+    def get_value(self, key, idxes=None, families=None):
+        return self.read_value(key, self.get_raw(key), idxes, families)
+
+    # Returns the value of key, whose decoded bytes are value: a directory
+    # is replaced by the content of its segments
+    def read_value(self, key, value, idxes=None, families=None):
+        if value is None or not value.startswith(b'@'):
+            return self.ctype(value) if value is not None else None
+
+        if families is not None:
+            families = [lib.autoBytes(family) for family in families]
+        parts = []
+        for n, lo, hi, size, family in self.parse_directory(value):
+            if idxes is not None:
+                i = bisect_left(idxes, lo)
+                if i == len(idxes) or idxes[i] > hi:
+                    continue
+            if families is not None and family and family not in families:
+                continue
+            parts.append(self.get_raw(self.segment_key(key, n)))
+        return self.ctype(b''.join(parts))
+
+    def get_keys(self):
+        idents = (self.get_key_ident(key) for key in self.db.keys() if self.is_ident_key(key))
+        return [ident for ident in idents if ident is not None]
+
+    def iter_items(self):
+        # Segments are only read through the directory of their ident
+        cur = self.db.cursor()
+        rec = cur.first()
+        while rec is not None:
+            key, value = rec
+            if self.is_ident_key(key):
+                ident = self.get_key_ident(key)
+                if ident is not None:
+                    if self.codec is not None:
+                        value = self.codec.decode(value)
+                    yield ident, self.read_value(key, value)
+            rec = cur.next()
+        cur.close()
+
+    # Skips the keys of segments, which start with the key of their ident.
+    # Only for tables keyed by name.
+    def iter_prefix_keys(self, prefix):
+        for key in super().iter_prefix_keys(prefix):
+            if self.is_ident_key(key):
+                yield key
+
+    def put(self, ident, val, sync=False):
+        '''Replaces the value of ident, split in segments if it is too large'''
+        self.put_value(self.get_ident_key(ident, add=True), val)
+        if sync:
+            self.db.sync()
+
+    def put_value(self, key, val):
+        if type(val) is not bytes:
+            val = val.pack()
+
+        self.delete_segments(key)
+
+        if len(val) <= self.segment_size:
+            self.put_raw(key, val)
+        else:
+            # Cut the entries of each family at entry boundaries
+            segments = []
+            chunks = []
+            for family, entries in sorted(self.split_families(val).items()):
+                chunk = []
+                size = 0
+                for entry in entries:
+                    if chunk and size + len(entry) > self.segment_size:
+                        chunks.append(b''.join(chunk))
+                        segments.append([len(segments), *self.get_id_range(chunks[-1]), size, family])
+                        chunk = []
+                        size = 0
+                    chunk.append(entry)
+                    size += len(entry)
+                chunks.append(b''.join(chunk))
+                segments.append([len(segments), *self.get_id_range(chunks[-1]), size, family])
+
+            self.put_raw(key, self.pack_directory(segments))
+            for n, chunk in enumerate(chunks):
+                self.put_raw(self.segment_key(key, n), chunk)
+
+    def extend(self, ident, entries):
+        '''Appends a list of (id, lines, family) to the value of ident'''
+        new = RefList()
+        new.extend(entries)
+        new = new.data
+        if not new:
+            return
+
+        key = self.get_ident_key(ident, add=True)
+        value = self.get_raw(key)
+        if value is None or not value.startswith(b'@'):
+            value = value or b''
+            if len(value) + len(new) <= self.segment_size:
+                self.put_raw(key, value + new)
+            else:
+                # The value gets too large: split it in segments
+                self.put_value(key, value + new)
+            return
+
+        segments = self.parse_directory(value)
+        next_n = max(seg[0] for seg in segments) + 1 if segments else 0
+        writes = []
+        for family, parts in sorted(self.split_families(new).items()):
+            part = b''.join(parts)
+            lo, hi = self.get_id_range(part)
+            tail = None
+            for seg in segments:
+                if seg[4] == family:
+                    tail = seg
+            if tail is not None and tail[3] + len(part) <= self.segment_size:
+                part = self.get_raw(self.segment_key(key, tail[0])) + part
+                tail[1] = min(tail[1], lo)
+                tail[2] = max(tail[2], hi)
+                tail[3] = len(part)
+            else:
+                tail = [next_n, lo, hi, len(part), family]
+                segments.append(tail)
+                next_n += 1
+            writes.append((tail[0], part))
+
+        # Write the directory first: if interrupted, it may describe ids
+        # that are not in the segments yet, which is harmless
+        self.put_raw(key, self.pack_directory(segments))
+        for n, part in writes:
+            self.put_raw(self.segment_key(key, n), part)
+
+    def delete_segments(self, key):
+        value = self.get_raw(key)
+        if value is not None and value.startswith(b'@'):
+            for seg in self.parse_directory(value):
+                skey = self.segment_key(key, seg[0])
+                if self.db.exists(skey):
+                    self.db.delete(skey)
+
+    def delete(self, ident):
+        '''Deletes ident and its segments'''
+        key = self.get_ident_key(ident)
+        if key is None:
+            return
+        self.delete_segments(key)
+        self.db.delete(key)
+
+    def truncate(self, ident, id):
+        '''Removes the entries of blob IDs greater than or equal to id. As
+            IDs are appended in increasing order, these are the last ones.'''
+        key = self.get_ident_key(ident)
+        if key is None:
+            return
+        value = self.get_raw(key)
+        if value is None:
+            return
+
+        if not value.startswith(b'@'):
+            obj = RefList(value)
+            obj.truncate(id)
+            if obj.data:
+                self.put_raw(key, obj.data)
+            else:
+                self.db.delete(key)
+            return
+
+        segments = []
+        for seg in self.parse_directory(value):
+            skey = self.segment_key(key, seg[0])
+            if seg[2] < id:
+                segments.append(seg)
+                continue
+
+            obj = RefList(self.get_raw(skey) or b'')
+            obj.truncate(id)
+            if obj.data:
+                self.put_raw(skey, obj.data)
+                segments.append([seg[0], *self.get_id_range(obj.data), len(obj.data), seg[4]])
+            elif self.db.exists(skey):
+                self.db.delete(skey)
+
+        if segments:
+            self.put_raw(key, self.pack_directory(segments))
+        else:
+            self.db.delete(key)
+
+class IdentDict:
+    '''Gives each ident a sequential integer ID, used as key of the tables
+        of references instead of its name. IDs are stored as 4-byte big
+        endian keys, shorter than most names, and in the same order as
+        the IDs: idents given IDs in name order, as by a bulk load, are
+        written in key order. idents.db maps names to IDs, and
+        identnames.db maps IDs back to names. IDs are reserved reserve_size
+        at a time in the numIdents variable, so that an interrupted run
+        never gives an ID twice.'''
+    reserve_size = 1 << 12
+    key_size = 4
+
+    def __init__(self, dir, readonly, vars, shared=False):
+        self.ids = BsdDB(dir + '/idents.db', readonly, self.unpack_id, shared=shared)
+        self.names = BsdDB(dir + '/identnames.db', readonly, lambda x: x, shared=shared)
+        self.vars = vars
+        self.next = None # Next ID to give, up to limit excluded
+        self.limit = None
+
+    @staticmethod
+    def pack_id(id):
+        return struct.pack('>I', id)
+
+    @staticmethod
+    def unpack_id(key):
+        return struct.unpack('>I', key)[0]
+
+    def get(self, ident):
+        return self.ids.get(ident)
+
+    def get_name(self, id):
+        return self.names.get(self.pack_id(id))
+
+    # Returns the ID of ident, giving it the next one if it has none
+    def add(self, ident):
+        ident = lib.autoBytes(ident)
+        id = self.ids.get(ident)
+        if id is not None:
+            return id
+
+        if self.next is None:
+            self.next = self.vars.get('numIdents') if self.vars.exists('numIdents') else 0
+            self.limit = self.next
+        if self.next == self.limit:
+            self.limit += self.reserve_size
+            self.vars.put('numIdents', self.limit, sync=True)
+
+        id = self.next
+        self.next += 1
+        self.ids.put(ident, self.pack_id(id))
+        self.names.put(self.pack_id(id), ident)
+        return id
+
+    # Writes the names of IDs that an interrupted run only saved in
+    # idents.db. add() then returns these IDs without writing their name.
+    def restore_names(self):
+        for ident, key in self.ids.db.items():
+            if not self.names.exists(key):
+                self.names.put(key, ident)
+        self.names.sync()
+
+    # Removes all IDs, for tables that are written again from scratch
+    def clear(self):
+        for table in (self.ids, self.names):
+            for key in table.db.keys():
+                table.db.delete(key)
+        if self.vars.exists('numIdents'):
+            self.vars.delete('numIdents')
+        self.next = self.limit = None
+        self.sync()
+
+    def sync(self):
+        self.vars.sync()
+        self.names.sync()
+        self.ids.sync()
+
+    def close(self):
+        self.ids.close()
+        self.names.close()
+
+class BlobIndex:
+    '''In-memory map from blob hash to blob ID, to avoid probing blobs.db
+        for every blob of every tag. Hashes are kept as binary digests in a
+        sorted array, with the IDs in a parallel array. Hashes added
+        afterwards go to a dict, merged into the arrays once it holds
+        merge_size of them.'''
+    merge_size = 1 << 16
+
+    def __init__(self, blob_db):
+        digests = bytearray()
+        self.idxes = array('L')
+        self.width = 0
+        # B-tree keys come in lexicographic order, and so do the digests
+        # of lowercase hex hashes
+        for hash, idx in blob_db.iter_items():
+            digest = bytes.fromhex(hash.decode())
+            self.width = len(digest)
+            digests += digest
+            self.idxes.append(idx)
+        self.digests = bytes(digests)
+        self.new = {} # Digest -> ID
+
+    def __getitem__(self, i):
+        # Sequence view over the sorted digests, for bisect
+        return self.digests[i*self.width:(i+1)*self.width]
+
+    def get(self, hash):
+        digest = bytes.fromhex(lib.autoBytes(hash).decode())
+        idx = self.new.get(digest)
+        if idx is None and self.idxes:
+            i = bisect_left(self, digest, hi=len(self.idxes))
+            if i < len(self.idxes) and self[i] == digest:
+                idx = self.idxes[i]
+        return idx
+
+    def add(self, hash, idx):
+        digest = bytes.fromhex(lib.autoBytes(hash).decode())
+        self.width = len(digest)
+        self.new[digest] = idx
+        if len(self.new) >= self.merge_size:
+            self.merge()
+
+    def merge(self):
+        '''Moves the added hashes to the sorted arrays'''
+        digests = bytearray()
+        idxes = array('L')
+        view = memoryview(self.digests)
+        start = 0
+        for digest, idx in sorted(self.new.items()):
+            # Copy the old entries up to the new one at once
+            i = bisect_left(self, digest, start, len(self.idxes))
+            digests += view[start*self.width:i*self.width]
+            digests += digest
+            idxes += self.idxes[start:i]
+            idxes.append(idx)
+            start = i
+        digests += view[start*self.width:]
+        idxes += self.idxes[start:]
+        view.release()
+
+        self.digests = bytes(digests)
+        self.idxes = idxes
+        self.new = {}
+
+class IdentFilter:
+    '''In-memory Bloom filter of the keys of a table, to avoid probing the
+        table for keys it does not have. A key the filter has may still be
+        missing (about 1% of the time up to the capacity), so exists()
+        checks the table then. Keys added to the table afterwards must be
+        added to the filter too; keys removed from the table can stay.'''
+    hashes = 7 # Bits set per key, about 10 bits per key are allocated
+
+    def __init__(self, table, capacity=0):
+        keys = table.get_keys()
+        # Room for the keys of later tags, rounded up to a power of two
+        # so that positions are masks of the digest
+        capacity = max(capacity, 2*len(keys), 1 << 16)
+        self.mask = (1 << (capacity * 10 - 1).bit_length()) - 1
+        self.bits = bytearray((self.mask >> 3) + 1)
+        self.table = table
+        self.capacity = capacity
+        self.count = 0
+        for key in keys:
+            self.add(key)
+
+    def positions(self, key):
+        digest = hashlib.blake2b(key, digest_size=4*self.hashes).digest()
+        return (pos & self.mask for pos in memoryview(digest).cast('I'))
+
+    def add(self, key):
+        key = lib.autoBytes(key)
+        for pos in self.positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def exists(self, key):
+        key = lib.autoBytes(key)
+        for pos in self.positions(key):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return self.table.exists(key)
+
+    def is_full(self):
+        return self.count > self.capacity
+
 class DB:
     def __init__(self, dir, readonly=True, dtscomp=False, shared=False):
         if os.path.isdir(dir):
@@ -204,6 +870,11 @@ class DB:
             # Map serial number to filename
         self.vers = BsdDB(dir + '/versions.db', ro, PathList, shared=shared)
         self.defs = BsdDB(dir + '/definitions.db', ro, DefList, shared=shared)
+            # Keyed by ident name, as are the definitions caches and the
+            # tables of compatibles, but not references and doc comments
+            # (see IdentDict): autocomplete walks definitions.db and
+            # compatibledts.db from a prefix, and the source view looks up
+            # each token of a file in the definitions caches
         self.defs_cache = {}
         NOOP = lambda x: x
         self.defs_cache['C'] = BsdDB(dir + '/definitions-cache-C.db', ro, NOOP, shared=shared)
@@ -211,13 +882,43 @@ class DB:
         self.defs_cache['D'] = BsdDB(dir + '/definitions-cache-D.db', ro, NOOP, shared=shared)
         self.defs_cache['M'] = BsdDB(dir + '/definitions-cache-M.db', ro, NOOP, shared=shared)
         assert sorted(self.defs_cache.keys()) == sorted(lib.CACHED_DEFINITIONS_FAMILIES)
-        self.refs = BsdDB(dir + '/references.db', ro, RefList, shared=shared)
-        self.docs = BsdDB(dir + '/doccomments.db', ro, RefList, shared=shared)
+        self.idents = None
+        if os.path.exists(dir + '/idents.db') or not ro and not os.path.exists(dir + '/references.db'):
+            self.idents = IdentDict(dir, ro, self.vars, shared=shared)
+                # IDs of the idents, which key references and doc comments.
+                # Databases created before keep keying them by name.
+        self.refs = RefListDB(dir + '/references.db', ro, shared=shared, idents=self.idents)
+        self.docs = RefListDB(dir + '/doccomments.db', ro, shared=shared, idents=self.idents)
         self.dtscomp = dtscomp
         if dtscomp:
-            self.comps = BsdDB(dir + '/compatibledts.db', ro, RefList, shared=shared)
-            self.comps_docs = BsdDB(dir + '/compatibledts_docs.db', ro, RefList, shared=shared)
+            self.comps = RefListDB(dir + '/compatibledts.db', ro, shared=shared)
+            self.comps_docs = RefListDB(dir + '/compatibledts_docs.db', ro, shared=shared)
             # Use a RefList in case there are multiple doc comments for an identifier
+        self.checkpoints = None
+        if not ro:
+            self.checkpoints = BsdDB(dir + '/checkpoints.db', ro, Checkpoint, shared=shared)
+                # Progress of the tags being indexed, see update.py
+        self.snapshots = None
+        if not ro or os.path.exists(dir + '/snapshots.db'):
+            self.snapshots = BsdDB(dir + '/snapshots.db', ro, Snapshot, shared=shared)
+                # Versions indexed from branches or commits, see update.py --ref
+        self.codecs = None
+        if os.path.exists(dir + '/codecs.db'):
+            self.codecs = BsdDB(dir + '/codecs.db', ro, lambda x: x, shared=shared)
+                # Compression of the values of the tables, see ZlibCodec
+            self.load_codecs()
+
+    # Tables whose values can be compressed
+    def get_codec_tables(self):
+        tables = [self.defs, self.refs, self.docs]
+        if self.dtscomp:
+            tables += [self.comps, self.comps_docs]
+        return tables
+
+    def load_codecs(self):
+        for table in self.get_codec_tables():
+            name = os.path.basename(table.filename)[:-len('.db')].encode()
+            table.codec = ZlibCodec.load(self.codecs, name)
 
     def close(self):
         self.vars.close()
@@ -232,7 +933,15 @@ class DB:
         self.defs_cache['M'].close()
         self.refs.close()
         self.docs.close()
+        if self.idents is not None:
+            self.idents.close()
         if self.dtscomp:
             self.comps.close()
             self.comps_docs.close()
+        if self.checkpoints is not None:
+            self.checkpoints.close()
+        if self.snapshots is not None:
+            self.snapshots.close()
+        if self.codecs is not None:
+            self.codecs.close()
 
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+
+#  This file is part of Elixir, a source code cross-referencer.
+#
+#  Elixir is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Elixir is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with Elixir.  If not, see <http://www.gnu.org/licenses/>.
+
+# Reads git objects straight from the pack files of a repository, without
+# starting git. Objects that are not in a pack (loose objects, objects of
+# alternates, SHA-256 repositories) are not found, and the caller has to
+# fall back to git for them. See update.py --read-packs.
+
+import mmap
+import os
+import os.path
+import struct
+import zlib
+from bisect import bisect_left
+from collections import OrderedDict
+from . import lib
+
+OBJ_COMMIT = 1
+OBJ_TREE = 2
+OBJ_BLOB = 3
+OBJ_TAG = 4
+OBJ_OFS_DELTA = 6
+OBJ_REF_DELTA = 7
+
+class PackIndex:
+    '''Version 2 .idx file: objects of the pack sorted by hash, with a
+        table of the number of objects up to each first byte (fan-out)'''
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:8] != b'\377tOc\0\0\0\2':
+            raise ValueError(path + ': unsupported index version')
+        self.fanout = struct.unpack_from('>256L', self.map, 8)
+        self.count = self.fanout[255]
+        self.hashes = 8 + 256*4
+        self.offsets = self.hashes + self.count*(20 + 4)
+        self.large_offsets = self.offsets + self.count*4
+
+    def __getitem__(self, i):
+        # Sequence view over the sorted hashes, for bisect
+        start = self.hashes + i*20
+        return self.map[start:start+20]
+
+    # Returns the offset of an object in the pack, or None
+    def get(self, digest):
+        lo = self.fanout[digest[0]-1] if digest[0] else 0
+        hi = self.fanout[digest[0]]
+        i = bisect_left(self, digest, lo, hi)
+        if i == hi or self[i] != digest:
+            return None
+        offset, = struct.unpack_from('>L', self.map, self.offsets + i*4)
+        if offset & 0x80000000:
+            offset, = struct.unpack_from('>Q', self.map,
+                                         self.large_offsets + (offset & 0x7fffffff)*8)
+        return offset
+
+    def close(self):
+        self.map.close()
+
+class Pack:
+    chunk_size = 64*1024 # Compressed bytes given to zlib at once
+
+    def __init__(self, path):
+        self.path = path
+        self.index = PackIndex(path + '.idx')
+        with open(path + '.pack', 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:4] != b'PACK':
+            raise ValueError(path + ': not a pack file')
+
+    # Returns type, size and data offset of the object header at offset
+    def read_header(self, offset):
+        c = self.map[offset]
+        type = (c >> 4) & 7
+        size = c & 15
+        shift = 4
+        offset += 1
+        while c & 0x80:
+            c = self.map[offset]
+            size |= (c & 0x7f) << shift
+            shift += 7
+            offset += 1
+        return type, size, offset
+
+    # Returns the offset of the base of an OBJ_OFS_DELTA, and of its delta
+    def read_ofs_base(self, obj_offset, offset):
+        c = self.map[offset]
+        delta = c & 0x7f
+        offset += 1
+        while c & 0x80:
+            c = self.map[offset]
+            delta = ((delta + 1) << 7) | (c & 0x7f)
+            offset += 1
+        return obj_offset - delta, offset
+
+    def inflate(self, offset, size):
+        # Feed the stream in chunks: zlib copies the input it does not use,
+        # which would be the rest of the pack
+        d = zlib.decompressobj()
+        view = memoryview(self.map)
+        data = bytearray()
+        pos = offset
+        while len(data) < size and not d.eof:
+            chunk = d.unconsumed_tail
+            if not chunk:
+                chunk = view[pos:pos + self.chunk_size]
+                if not chunk:
+                    break
+                pos += len(chunk)
+            data += d.decompress(chunk, size - len(data))
+        if len(data) != size:
+            raise ValueError(self.path + '.pack: corrupt object at ' + str(offset))
+        return bytes(data)
+
+    def close(self):
+        self.index.close()
+        self.map.close()
+
+def read_varint(delta, pos):
+    value = shift = 0
+    while True:
+        c = delta[pos]
+        value |= (c & 0x7f) << shift
+        shift += 7
+        pos += 1
+        if not c & 0x80:
+            return value, pos
+
+def apply_delta(base, delta):
+    src_size, pos = read_varint(delta, 0)
+    dst_size, pos = read_varint(delta, pos)
+    if src_size != len(base):
+        raise ValueError('delta does not apply to its base')
+
+    out = bytearray()
+    while pos < len(delta):
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            # Copy from the base: bits 0-3 select offset bytes, 4-6 size bytes
+            offset = size = 0
+            for i in range(4):
+                if op & (1 << i):
+                    offset |= delta[pos] << (8*i)
+                    pos += 1
+            for i in range(3):
+                if op & (1 << (4+i)):
+                    size |= delta[pos] << (8*i)
+                    pos += 1
+            out += base[offset:offset + (size or 0x10000)]
+        elif op:
+            # Insert the next op bytes
+            out += delta[pos:pos+op]
+            pos += op
+        else:
+            raise ValueError('invalid delta opcode')
+
+    if len(out) != dst_size:
+        raise ValueError('delta result has the wrong size')
+    return bytes(out)
+
+class PackReader:
+    '''Reads objects from the pack files of a repository. Delta chains
+        are resolved from the nearest base in an LRU cache of the objects
+        they went through, which holds the bases shared by the following
+        objects when they are read in order.'''
+    def __init__(self, repo_dir, cache_size=32 << 20):
+        git_dir = os.path.join(repo_dir, '.git')
+        if not os.path.isdir(git_dir):
+            git_dir = repo_dir
+        self.pack_dir = os.path.join(git_dir, 'objects', 'pack')
+        self.packs = []
+        self.mtime = None
+        self.cache = OrderedDict() # (pack, offset) -> (type, data)
+        self.cache_bytes = 0
+        self.cache_size = cache_size
+        self.load_packs()
+
+    # Opens the packs of the repository, again if they changed since, for
+    # example after a fetch or a repack. Returns False if they did not.
+    def load_packs(self):
+        try:
+            mtime = os.stat(self.pack_dir).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self.mtime:
+            return False
+
+        for pack in self.packs:
+            pack.close()
+        self.packs = []
+        self.cache.clear()
+        self.cache_bytes = 0
+        self.mtime = mtime
+        if mtime is not None:
+            for name in sorted(os.listdir(self.pack_dir)):
+                if name.endswith('.idx') and \
+                        os.path.exists(os.path.join(self.pack_dir, name[:-4] + '.pack')):
+                    self.packs.append(Pack(os.path.join(self.pack_dir, name[:-4])))
+        return True
+
+    def find(self, digest):
+        for pack in self.packs:
+            offset = pack.index.get(digest)
+            if offset is not None:
+                return pack, offset
+        return None
+
+    # Returns type and content of an object, or None if it is not in a pack
+    def get(self, hash):
+        if len(hash) != 40:
+            return None
+        digest = bytes.fromhex(lib.autoBytes(hash).decode())
+        location = self.find(digest)
+        if location is None and self.load_packs():
+            location = self.find(digest)
+        if location is None:
+            return None
+        return self.read(*location)
+
+    # Returns the content of a blob, or None if it is not in a pack
+    def get_blob(self, hash):
+        obj = self.get(hash)
+        if obj is None or obj[0] != OBJ_BLOB:
+            return None
+        return obj[1]
+
+    def read(self, pack, offset):
+        # Walk the delta chain down to a base, or an object of the cache
+        chain = []
+        while True:
+            cached = self.cache.get((pack, offset))
+            if cached is not None:
+                self.cache.move_to_end((pack, offset))
+                type, data = cached
+                break
+
+            type, size, pos = pack.read_header(offset)
+            if type == OBJ_OFS_DELTA:
+                base, pos = pack.read_ofs_base(offset, pos)
+                chain.append((pack, offset, pos, size))
+                offset = base
+            elif type == OBJ_REF_DELTA:
+                location = self.find(bytes(pack.map[pos:pos+20]))
+                if location is None:
+                    return None
+                chain.append((pack, offset, pos + 20, size))
+                pack, offset = location
+            else:
+                data = pack.inflate(pos, size)
+                if chain:
+                    self.add_cache(pack, offset, type, data)
+                break
+
+        for pack, offset, pos, size in reversed(chain):
+            data = apply_delta(data, pack.inflate(pos, size))
+            self.add_cache(pack, offset, type, data)
+        return type, data
+
+    def add_cache(self, pack, offset, type, data):
+        if len(data) > self.cache_size // 4:
+            return
+        self.cache[(pack, offset)] = (type, data)
+        self.cache_bytes += len(data)
+        while self.cache_bytes > self.cache_size:
+            _, (_, old) = self.cache.popitem(last=False)
+            self.cache_bytes -= len(old)
+
+    def close(self):
+        for pack in self.packs:
+            pack.close()
+        self.packs = []
+        self.cache.clear()
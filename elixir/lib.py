@@ -26,15 +26,15 @@ logger = logging.getLogger(__name__)
 
 CURRENT_DIR = os.path.abspath(os.path.dirname(os.path.abspath(__file__)) + '/../')
 
-def script(*args, env=None):
+def script(*args, env=None, input=None):
     args = (os.path.join(CURRENT_DIR, 'script.sh'),) + args
     # subprocess.run was introduced in Python 3.5
     # fall back to subprocess.check_output if it's not available
     if hasattr(subprocess, 'run'):
-        p = subprocess.run(args, stdout=subprocess.PIPE, env=env)
+        p = subprocess.run(args, stdout=subprocess.PIPE, env=env, input=input)
         p = p.stdout
     else:
-        p = subprocess.check_output(args)
+        p = subprocess.check_output(args, input=input)
     return p
 
 def run_cmd(*args, env=None):
@@ -46,8 +46,8 @@ def run_cmd(*args, env=None):
 # Invoke ./script.sh with the given arguments
 # Returns the list of output lines
 
-def scriptLines(*args, env=None):
-    p = script(*args, env=env)
+def scriptLines(*args, env=None, input=None):
+    p = script(*args, env=env, input=input)
     p = p.split(b'\n')
     del p[-1]
     return p
@@ -72,7 +72,7 @@ def decode(byte_object):
 
 # List of tokens which we don't want to consider as identifiers
 # Typically for very frequent variable names and things redefined by #define
-# TODO: allow to have per project blacklists
+# See also getStopList() for the identifiers of a single project
 
 blacklist = (
     b'NULL',
@@ -179,14 +179,27 @@ blacklist = (
     b'x'
 )
 
-def isIdent(bstr):
+# stoplist: if set, identifiers of the project whose references are not indexed
+def isIdent(bstr, stoplist=()):
     if (len(bstr) < 2 or
         bstr in blacklist or
+        bstr in stoplist or
         bstr.startswith(b'~')):
         return False
     else:
         return True
 
+# Returns the identifiers of the stoplist file of a data directory, one per
+# line. Their references are not indexed, but their definitions are.
+# See 'utils/maintenance.py stoplist'.
+def getStopList(data_dir):
+    try:
+        with open(os.path.join(data_dir, 'stoplist'), 'rb') as f:
+            return frozenset(line.strip() for line in f
+                             if line.strip() and not line.startswith(b'#'))
+    except FileNotFoundError:
+        return frozenset()
+
 def autoBytes(arg):
     if type(arg) is str:
         arg = arg.encode()
@@ -261,3 +274,11 @@ def compatibleMacro(macro_family, requested_family):
         item += 'M'
         result = result or item in compatibility_list[requested_family]
     return result
+
+# Returns the families of the files whose references are shown for the
+# requested family, or None for all of them
+def getReferenceFamilies(requested_family):
+    if requested_family == 'A':
+        return None
+    return [family for family in compatibility_list
+            if compatibleFamily(requested_family, family)]
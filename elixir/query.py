@@ -58,9 +58,12 @@ def get_query(basedir, project):
 class Query:
     def __init__(self, data_dir, repo_dir):
         self.repo_dir = repo_dir
-        self.data_dir = data_dir
+        # The data directory can be a link to the current generation of the
+        # database, switched by 'update.py --shadow': resolve it once, so that
+        # all tables come from the same generation
+        self.data_dir = os.path.realpath(data_dir)
         self.dts_comp_support = int(self.script('dts-comp'))
-        self.db = data.DB(data_dir, readonly=True, dtscomp=self.dts_comp_support)
+        self.db = data.DB(self.data_dir, readonly=True, dtscomp=self.dts_comp_support)
         self.file_cache = {}
 
     def script(self, *args):
@@ -164,8 +167,24 @@ class Query:
                     versions[topmenu][submenu] = []
                 versions[topmenu][submenu].append(tag)
 
+        # Snapshots of branches or commits, newest first, see update.py --ref
+        if self.db.snapshots is not None:
+            snapshots = OrderedDict()
+            for name, snapshot in sorted(self.db.snapshots.iter_items(), key=lambda item: -item[1].seq):
+                if self.db.vers.exists(name):
+                    snapshots.setdefault(snapshot.ref, []).append(decode(name))
+            if snapshots:
+                versions['snapshots'] = snapshots
+                versions.move_to_end('snapshots', last=False)
+
         return versions
 
+    # Returns a number that changes each time update.py indexes new tags
+    def get_generation(self):
+        if self.db.vars.exists('generation'):
+            return self.db.vars.get('generation')
+        return 0
+
     # Returns the type (blob or tree) associated to
     # the given path. Example:
     # > ./query.py type v3.1-rc10 /Makefile
@@ -214,11 +233,13 @@ class Query:
         if not self.dts_comp_support or not self.db.comps.exists(ident):
             return symbol_c, symbol_dts, symbol_docs
 
-        files_this_version = self.db.vers.get(version).iter()
-        comps = self.db.comps.get(ident).iter(dummy=True)
+        files_this_version = list(self.db.vers.get(version).iter())
+        # Used to skip the parts of large values that have no file of this version
+        idxes_this_version = [idx for idx, _ in files_this_version]
+        comps = self.db.comps.get(ident, idxes_this_version).iter(dummy=True)
 
         if self.db.comps_docs.exists(ident):
-            comps_docs = self.db.comps_docs.get(ident).iter(dummy=True)
+            comps_docs = self.db.comps_docs.get(ident, idxes_this_version).iter(dummy=True)
         else:
             comps_docs = data.RefList().iter(dummy=True)
 
@@ -267,23 +288,28 @@ class Query:
         if not self.db.vers.exists(version):
             return symbol_definitions, symbol_references, symbol_doccomments
 
-        files_this_version = self.db.vers.get(version).iter()
+        files_this_version = list(self.db.vers.get(version).iter())
+        # Used to skip the parts of large values that have no file of this version
+        idxes_this_version = [idx for idx, _ in files_this_version]
         this_ident = self.db.defs.get(ident)
         defs_this_ident = this_ident.iter(dummy=True)
         macros_this_ident = this_ident.get_macros()
         # FIXME: see why we can have a discrepancy between defs_this_ident and refs
         if self.db.refs.exists(ident):
-            refs = self.db.refs.get(ident).iter(dummy=True)
+            # Large values are split by family, only read the ones shown
+            refs = self.db.refs.get(ident, idxes_this_version,
+                                    lib.getReferenceFamilies(family)).iter(dummy=True)
         else:
             refs = data.RefList().iter(dummy=True)
 
         if self.db.docs.exists(ident):
-            docs = self.db.docs.get(ident).iter(dummy=True)
+            docs = self.db.docs.get(ident, idxes_this_version).iter(dummy=True)
         else:
             docs = data.RefList().iter(dummy=True)
 
-        # vers, defs, refs, and docs are all populated by update.py in order of
-        # idx, and there is a one-to-one mapping between blob hashes and idx
+        # vers is stored sorted by idx, and defs, refs and docs are iterated
+        # in order of idx, whatever the order in which update.py indexed
+        # the tags. There is a one-to-one mapping between blob hashes and idx
         # values.  Therefore, we can sequentially step through the defs, refs,
         # and docs for each file in a version.
 
@@ -430,18 +430,18 @@ def get_versions(versions: OrderedDict[str, OrderedDict[str, str]],
     return result, current_version_path
 
 # Caches get_versions result in a context object
+# Versions are listed again when update.py indexed new tags, or after
+# VERSION_CACHE_DURATION_SECONDS at most
 def get_versions_cached(q, ctx, project):
+    generation = q.get_generation()
     with ctx.versions_cache_lock:
-        if project not in ctx.versions_cache:
-            ctx.versions_cache[project] = (time.time(), q.get_versions())
-            cached_versions = ctx.versions_cache[project]
-        else:
-            cached_versions = ctx.versions_cache[project]
-            if time.time()-cached_versions[0] > VERSION_CACHE_DURATION_SECONDS:
-                ctx.versions_cache[project] = (time.time(), q.get_versions())
-                cached_versions = ctx.versions_cache[project]
+        cached_versions = ctx.versions_cache.get(project)
+        if cached_versions is None or cached_versions[1] != generation or \
+                time.time()-cached_versions[0] > VERSION_CACHE_DURATION_SECONDS:
+            cached_versions = (time.time(), generation, q.get_versions())
+            ctx.versions_cache[project] = cached_versions
 
-        return cached_versions[1]
+        return cached_versions[2]
 
 # Retruns template context used by the layout template
 # get_url_with_new_version: see get_url parameter of get_versions
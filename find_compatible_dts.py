@@ -24,42 +24,50 @@ from elixir.lib import decode
 
 class FindCompatibleDTS:
     def __init__(self):
-        # Compile regexes
-        self.regex_c = re.compile("\s*{*\s*\.compatible\s*=\s*\"(.+?)\"")
-        self.regex_dts1 = re.compile("\s*compatible")
-        self.regex_dts2 = re.compile("\"(.+?)\"")
-        self.regex_bindings = re.compile("([\w-]+,?[\w-]+)")
+        # Compile regexes. They are run on a whole file, and none of them
+        # matches across lines: horizontal whitespace is [^\S\n].
+        self.regex_c = re.compile(r'\.compatible[^\S\n]*=[^\S\n]*"(.+?)"')
+        self.regex_dts1 = re.compile(r'^[^\S\n]*compatible.*', re.MULTILINE)
+        self.regex_dts2 = re.compile(r'"(.+?)"')
+        self.regex_bindings = re.compile(r'([\w-]+,?[\w-]+)')
 
     def parse_c(self, content):
-        return self.regex_c.findall(content)
+        return self.regex_c.finditer(content)
 
     def parse_dts(self, content):
-        ret = []
-        if self.regex_dts1.match(content) != None:
-            ret = self.regex_dts2.findall(content)
-        return ret
+        # Strings of the lines that start with "compatible"
+        for line in self.regex_dts1.finditer(content):
+            yield from self.regex_dts2.finditer(content, line.start(), line.end())
 
     def parse_bindings(self, content):
         # There are a lot of wrong results
         # but we don't apply that to a lot of files
         # so it should be fine
-        return self.regex_bindings.findall(content)
+        return self.regex_bindings.finditer(content)
 
-    def run(self, file_lines, family):
-        ident_list = []
+    # Returns the (quoted compatible, line number) of a file, in file order
+    def run(self, content, family):
+        content = decode(content)
+        if family == 'C':
+            matches = self.parse_c(content)
+        elif family == 'D':
+            matches = self.parse_dts(content)
+        elif family == 'B':
+            matches = self.parse_bindings(content)
 
-        # Iterate though lines and search for idents
-        for num, line in enumerate(file_lines, 1):
-            line = decode(line)
-            if family == 'C':
-                ret = self.parse_c(line)
-            elif family == 'D':
-                ret = self.parse_dts(line)
-            elif family == 'B':
-                ret = self.parse_bindings(line)
+        ident_list = []
+        quoted = {}
+        num = 1
+        pos = 0
+        for match in matches:
+            # Matches come in order, count the lines since the previous one
+            start = match.start(1)
+            num += content.count('\n', pos, start)
+            pos = start
 
-            for i in range(len(ret)):
-                ident_list.append(str(parse.quote(ret[i])) + ' ' + str(num))
+            ident = match.group(1)
+            if ident not in quoted:
+                quoted[ident] = parse.quote(ident)
+            ident_list.append((quoted[ident], num))
 
         return ident_list
-
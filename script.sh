@@ -63,6 +63,30 @@ list_tags_h()
     sed -r 's/^(v[0-9]*)\.([0-9]*)(.*)$/\1 \1.\2 \1.\2\3/'
 }
 
+# Versions indexed from a branch or a commit with update.py --ref are named
+# <ref>:<commit>, they do not go through version_rev
+get_rev()
+{
+    case $1 in
+        *:*)
+            echo "${1##*:}"
+            ;;
+        *)
+            echo "$1" | version_rev
+            ;;
+    esac
+}
+
+get_commit()
+{
+    git rev-parse --verify -q "$opt1^{commit}"
+}
+
+list_refs()
+{
+    git for-each-ref --format='%(objectname) %(refname)'
+}
+
 get_latest_tags()
 {
     git tag | version_dir | grep -v '\-rc' | sort -Vr
@@ -70,7 +94,7 @@ get_latest_tags()
 
 get_type()
 {
-    v=`echo $opt1 | version_rev`
+    v=`get_rev $opt1`
     git cat-file -t "$v:`denormalize $opt2`" 2>/dev/null
 }
 
@@ -79,15 +103,26 @@ get_blob()
     git cat-file blob $opt1
 }
 
+# Prints the blob of hash $1, or standard input if $1 is "-", when
+# update.py --read-packs already read it
+cat_blob()
+{
+    if [ "$1" = - ]; then
+        cat
+    else
+        git cat-file blob "$1"
+    fi
+}
+
 get_file()
 {
-    v=`echo $opt1 | version_rev`
+    v=`get_rev $opt1`
     git cat-file blob "$v:`denormalize $opt2`" 2>/dev/null
 }
 
 get_dir()
 {
-        v=`echo $opt1 | version_rev`
+        v=`get_rev $opt1`
         git ls-tree -l "$v:`denormalize $opt2`" 2>/dev/null |
         awk '{print $2" "$5" "$4" "$1}' |
         grep -v ' \.' |
@@ -99,7 +134,7 @@ tokenize_file()
     if [ "$opt1" = -b ]; then
         ref=$opt2
     else
-        v=`echo $opt1 | version_rev`
+        v=`get_rev $opt1`
         ref="$v:`denormalize $opt2`"
     fi
 
@@ -109,7 +144,7 @@ tokenize_file()
         regex='s%((/\*.*?\*/|//.*?\001|[^'"'"']"(\\.|.)*?"|# *include *<.*?>|\W)+)(\w+)?%\1\n\4\n%g'
     fi
 
-    git cat-file blob $ref 2>/dev/null |
+    cat_blob "$ref" 2>/dev/null |
     tr '\n' '\1' |
     perl -pe "$regex" |
     head -n -1
@@ -117,7 +152,7 @@ tokenize_file()
 
 list_blobs()
 {
-    v=`echo $opt2 | version_rev`
+    v=`get_rev $opt2`
 
     if [ "$opt1" = '-p' ]; then
         # "path" option: return blob hash and full path
@@ -128,13 +163,24 @@ list_blobs()
     else
         # default option: return only blob hash
         format='\1'
-        v=`echo $opt1 | version_rev`
+        v=`get_rev $opt1`
     fi
 
     git ls-tree -r "$v" |
     sed -r "s/^\S* blob (\S*)\t(([^/]*\/)*(.*))$/$format/; /^\S* commit .*$/d"
 }
 
+diff_blobs()
+{
+    v1=`get_rev $opt1`
+    v2=`get_rev $opt2`
+
+    # Return new mode, new blob hash and full path of files that changed
+    # between the two versions. Deleted files have a null mode and hash.
+    git diff-tree -r --no-renames "$v1" "$v2" |
+    sed -r "s/^:\S* (\S*) \S* (\S*) \S*\t(.*)$/\1 \2 \3/"
+}
+
 untokenize()
 {
     tr -d '\n' |
@@ -162,7 +208,7 @@ parse_defs_C()
 {
     tmp=`mktemp -d`
     full_path=$tmp/$opt2
-    git cat-file blob "$opt1" > "$full_path"
+    cat_blob "$opt1" > "$full_path"
 
     # Use ctags to parse most of the defs
     ctags -x --kinds-c=+p+x --extras='-{anonymous}' "$full_path" |
@@ -181,7 +227,7 @@ parse_defs_K()
 {
     tmp=`mktemp -d`
     full_path=$tmp/$opt2
-    git cat-file blob "$opt1" > "$full_path"
+    cat_blob "$opt1" > "$full_path"
     ctags -x --language-force=kconfig --kinds-kconfig=c --extras-kconfig=-{configPrefixed} "$full_path" |
     awk '{print "CONFIG_"$1" "$2" "$3}'
     rm "$full_path"
@@ -192,7 +238,7 @@ parse_defs_D()
 {
     tmp=`mktemp -d`
     full_path=$tmp/$opt2
-    git cat-file blob "$opt1" > "$full_path"
+    cat_blob "$opt1" > "$full_path"
     ctags -x --language-force=dts "$full_path" |
     awk '{print $1" "$2" "$3}'
     rm "$full_path"
@@ -203,7 +249,7 @@ parse_docs()
 {
     tmpfile=`mktemp`
 
-    git cat-file blob "$opt1" > "$tmpfile"
+    cat_blob "$opt1" > "$tmpfile"
     "$script_dir/find-file-doc-comments.pl" "$tmpfile" || exit "$?"
 
     rm -rf "$tmpfile"
@@ -247,6 +293,14 @@ case $cmd in
         fi
         ;;
 
+    list-refs)
+        list_refs
+        ;;
+
+    get-commit)
+        get_commit
+        ;;
+
     get-latest-tags)
         get_latest_tags
         ;;
@@ -271,6 +325,10 @@ case $cmd in
         list_blobs
         ;;
 
+    diff-blobs)
+        diff_blobs
+        ;;
+
     tokenize-file)
         tokenize_file
         ;;
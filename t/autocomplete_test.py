@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+#  This file is part of Elixir, a source code cross-referencer.
+#
+#  Elixir is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Elixir is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with Elixir.  If not, see <http://www.gnu.org/licenses/>.
+
+# Tests of the suggestions of elixir/autocomplete.py, on a temporary
+# database whose large values are split in segments.
+
+import os
+import sys
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+from urllib import parse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')))
+
+from elixir import data
+from elixir.autocomplete import AutocompleteResource
+
+class AutocompleteTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = data.DB(self.tmpdir.name, readonly=False, dtscomp=True)
+        self.db.comps.segment_size = 100
+        self.db.refs.segment_size = 100
+
+        for n in range(20):
+            ident = f'vendor_func{n:02}'
+            self.db.defs.put(ident, data.DefList())
+            self.db.refs.extend(ident, [(id, '1', 'C') for id in range(n * 10 + 1)])
+            self.db.comps.extend(parse.quote(f'vendor,dev{n:02}'), [(id, '1', 'D') for id in range(n * 10 + 1)])
+
+    def tearDown(self):
+        self.db.close()
+        self.tmpdir.cleanup()
+
+    def get(self, prefix, family):
+        params = {'q': prefix, 'f': family, 'p': 'proj'}
+        req = SimpleNamespace(get_param=params.get,
+                              context=SimpleNamespace(config=SimpleNamespace(project_dir=self.tmpdir.name)))
+        resp = SimpleNamespace()
+        query = SimpleNamespace(db=self.db, close=lambda: None)
+        with mock.patch('elixir.autocomplete.get_query', return_value=query):
+            AutocompleteResource().on_get(req, resp)
+        return resp.media
+
+    def test_compatibles(self):
+        self.assertTrue(any(b'\0' in key for key in self.db.comps.db.keys()))
+        self.assertEqual(self.get('vendor,dev', 'B'), [f'vendor,dev{n:02}' for n in range(11)])
+        self.assertEqual(self.get('vendor,dev1', 'B'), [f'vendor,dev{n}' for n in range(10, 20)])
+        self.assertEqual(self.get('other', 'B'), [])
+
+    def test_definitions(self):
+        self.assertEqual(self.get('vendor_func1', 'C'), [f'vendor_func{n}' for n in range(10, 20)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,554 @@
+#!/usr/bin/env python3
+
+#  This file is part of Elixir, a source code cross-referencer.
+#
+#  Elixir is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Elixir is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with Elixir.  If not, see <http://www.gnu.org/licenses/>.
+
+# Tests of the value formats and tables of elixir/data.py, on temporary
+# databases.
+
+import os
+import sys
+import tempfile
+import unittest
+from random import Random
+from unittest import mock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')))
+
+from elixir import data
+
+def make_reflist(ids, family='C'):
+    return [(id, str(id % 97 + 1), family) for id in ids]
+
+class TableTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.tables = []
+
+    def tearDown(self):
+        for table in self.tables:
+            table.close()
+        self.tmpdir.cleanup()
+
+    def open(self, cls, name, *args):
+        table = cls(os.path.join(self.tmpdir.name, name), False, *args)
+        self.tables.append(table)
+        return table
+
+class BlobIndexTest(TableTestCase):
+    def test_get_and_merge(self):
+        hashes = [os.urandom(20).hex().encode() for _ in range(1000)]
+        blob = self.open(data.BsdDB, 'blobs.db', lambda x: int(x.decode()))
+        for idx, hash in enumerate(hashes[:300]):
+            blob.put(hash, idx)
+
+        index = data.BlobIndex(blob)
+        index.merge_size = 64
+        for idx, hash in enumerate(hashes[300:], 300):
+            self.assertIsNone(index.get(hash))
+            index.add(hash, idx)
+
+        self.assertLess(len(index.new), index.merge_size)
+        self.assertEqual(len(index.idxes) + len(index.new), len(hashes))
+        digests = [index[i] for i in range(len(index.idxes))]
+        self.assertEqual(digests, sorted(digests))
+        for idx, hash in enumerate(hashes):
+            self.assertEqual(index.get(hash), idx)
+        self.assertIsNone(index.get(os.urandom(20).hex().encode()))
+
+    def test_empty_table(self):
+        index = data.BlobIndex(self.open(data.BsdDB, 'blobs.db', lambda x: int(x.decode())))
+        self.assertIsNone(index.get(b'0' * 40))
+        index.add(b'0' * 40, 7)
+        index.merge()
+        self.assertEqual(index.get(b'0' * 40), 7)
+        self.assertEqual(index.new, {})
+
+class IdentFilterTest(TableTestCase):
+    def setUp(self):
+        super().setUp()
+        self.table = self.open(data.BsdDB, 'definitions.db', lambda x: x)
+        for n in range(1000):
+            self.table.put(b'ident%d' % n, b'')
+
+    # Whether all bits of key are set, which exists() checks before looking
+    # the key up in the table
+    @staticmethod
+    def has_bits(filter, key):
+        return all(filter.bits[pos >> 3] & (1 << (pos & 7)) for pos in filter.positions(key))
+
+    def test_no_false_negatives(self):
+        filter = data.IdentFilter(self.table)
+        for n in range(1000, 3000):
+            self.table.put(b'ident%d' % n, b'')
+            filter.add('ident%d' % n)
+        for n in range(3000):
+            self.assertTrue(self.has_bits(filter, b'ident%d' % n))
+            self.assertTrue(filter.exists(b'ident%d' % n))
+        self.assertFalse(filter.exists(b'ident3000'))
+
+    def test_false_positives(self):
+        filter = data.IdentFilter(self.table, 1 << 16)
+        self.assertEqual(filter.capacity, 1 << 16)
+        rng = Random(0)
+        for _ in range(filter.capacity - filter.count):
+            filter.add(rng.randbytes(12).hex())
+        self.assertFalse(filter.is_full())
+
+        probes = [b'other%d' % n for n in range(100000)]
+        positives = sum(1 for key in probes if self.has_bits(filter, key))
+        self.assertLess(positives / len(probes), 0.015)
+
+        # The table is only looked up for false positives
+        with mock.patch.object(self.table, 'exists', return_value=False) as exists:
+            self.assertFalse(any(filter.exists(key) for key in probes[:10000]))
+        self.assertEqual(exists.call_count, sum(1 for key in probes[:10000] if self.has_bits(filter, key)))
+
+        filter.add(b'one more')
+        self.assertTrue(filter.is_full())
+
+class RefListDBTest(TableTestCase):
+    def setUp(self):
+        super().setUp()
+        self.refs = self.open(data.RefListDB, 'references.db')
+        self.refs.segment_size = 300
+
+    # Returns the key of ident in the table
+    def key(self, ident):
+        return ident
+
+    def get_segments(self, ident):
+        value = self.refs.db.get(self.key(ident))
+        if value is None or not value.startswith(b'@'):
+            return None
+        return self.refs.parse_directory(value)
+
+    def test_small_values(self):
+        self.refs.extend(b'ident', make_reflist([1, 2]))
+        self.refs.extend(b'ident', make_reflist([5]))
+        self.assertEqual(self.refs.db.get(self.key(b'ident')), b'1:2:C\n2:3:C\n5:6:C\n')
+        self.assertIsNone(self.get_segments(b'ident'))
+        self.assertEqual(list(self.refs.get(b'ident').iter()), make_reflist([1, 2, 5]))
+        self.assertIsNone(self.refs.get(b'other'))
+
+    def test_segments(self):
+        for first in range(0, 200, 10):
+            self.refs.extend(b'ident', make_reflist(range(first, first + 10)))
+
+        segments = self.get_segments(b'ident')
+        self.assertGreater(len(segments), 1)
+        for n, lo, hi, size, family in segments:
+            segment = self.refs.db.get(self.refs.segment_key(self.key(b'ident'), n))
+            self.assertLessEqual(len(segment), self.refs.segment_size)
+            self.assertEqual(len(segment), size)
+            self.assertEqual(self.refs.get_id_range(segment), (lo, hi))
+            self.assertTrue(segment.endswith(b'\n'))
+
+        self.assertEqual(list(self.refs.get(b'ident').iter()), make_reflist(range(200)))
+        self.assertEqual(self.refs.get_keys(), [b'ident'])
+        self.assertEqual([key for key, _ in self.refs.iter_items()], [b'ident'])
+
+        # Only segments that have some of the ids are read
+        value = self.refs.get(b'ident', idxes=[3, 4])
+        self.assertLess(len(value.data), self.refs.segment_size)
+        self.assertIn((3, '4', 'C'), list(value.iter()))
+        self.assertEqual(self.refs.get(b'ident', idxes=[1000]).data, b'')
+
+    def test_put_and_delete(self):
+        self.refs.put(b'ident', data.RefList(b''.join(b'%d:1:C\n' % id for id in range(100))))
+        self.assertGreater(len(self.get_segments(b'ident')), 1)
+        self.refs.put(b'ident', data.RefList(b'1:1:C\n'))
+        self.assertEqual(self.refs.db.keys(), [self.key(b'ident')])
+
+        self.refs.put(b'ident', data.RefList(b''.join(b'%d:1:C\n' % id for id in range(100))))
+        self.refs.delete(b'ident')
+        self.assertEqual(self.refs.db.keys(), [])
+
+    def test_truncate(self):
+        for first in range(0, 200, 10):
+            self.refs.extend(b'ident', make_reflist(range(first, first + 10)))
+        num_segments = len(self.get_segments(b'ident'))
+
+        self.refs.truncate(b'ident', 150)
+        self.assertEqual(list(self.refs.get(b'ident').iter()), make_reflist(range(150)))
+        segments = self.get_segments(b'ident')
+        self.assertLess(len(segments), num_segments)
+        self.assertEqual(max(hi for _, _, hi, _, _ in segments), 149)
+        self.assertEqual(len(self.refs.db.keys()), len(segments) + 1)
+
+        self.refs.truncate(b'ident', 0)
+        self.assertEqual(self.refs.db.keys(), [])
+
+    def test_families(self):
+        self.refs.extend(b'ident', make_reflist(range(0, 30)) + make_reflist(range(30, 40), 'K'))
+        self.refs.extend(b'ident', make_reflist(range(40, 50), 'M') + make_reflist(range(50, 60)))
+        self.refs.extend(b'ident', make_reflist(range(60, 70), 'K'))
+
+        segments = self.get_segments(b'ident')
+        for n, _, _, _, family in segments:
+            segment = self.refs.db.get(self.refs.segment_key(self.key(b'ident'), n))
+            self.assertEqual({entry.rsplit(b':', 1)[1] for entry in segment.split(b'\n')[:-1]}, {family})
+        self.assertEqual({family for *_, family in segments}, {b'C', b'K', b'M'})
+
+        value = self.refs.get(b'ident', families=['K'])
+        self.assertEqual(sorted(value.iter()), make_reflist(range(30, 40), 'K') + make_reflist(range(60, 70), 'K'))
+        value = self.refs.get(b'ident', families=['C', 'M'])
+        self.assertEqual(sorted(value.iter()), sorted(make_reflist(list(range(0, 30)) + list(range(50, 60))) +
+                                                      make_reflist(range(40, 50), 'M')))
+        self.assertEqual(self.refs.get(b'ident', families=['D']).data, b'')
+        self.assertEqual(len(list(self.refs.get(b'ident').iter())), 70)
+
+        # Families are kept by truncate
+        self.refs.truncate(b'ident', 35)
+        value = self.refs.get(b'ident', families=['K'])
+        self.assertEqual(sorted(value.iter()), make_reflist(range(30, 35), 'K'))
+
+    def test_segments_without_family(self):
+        # Written before segments had a family: read for any family
+        old = b''.join(b'%d:1:%s\n' % (id, (b'C', b'K')[id % 2]) for id in range(20))
+        key = self.key(b'ident')
+        self.refs.db.put(key + b'\0' + b'0', old[:60])
+        self.refs.db.put(key + b'\0' + b'1', old[60:])
+        self.refs.db.put(key, b'@0 %d %d 60\n1 %d %d %d\n' % (
+            *self.refs.get_id_range(old[:60]), *self.refs.get_id_range(old[60:]), len(old) - 60))
+
+        self.assertEqual(self.refs.get(b'ident', families=['D']).data, old)
+        self.refs.extend(b'ident', make_reflist([20, 21], 'D'))
+        self.assertEqual(self.refs.get(b'ident', families=['D']).data, old + b'20:21:D\n21:22:D\n')
+        self.assertEqual(self.refs.get(b'ident', families=['C']).data, old)
+
+    def test_random_operations(self):
+        random = Random(2)
+        model = {}
+        next_id = 0
+        for step in range(1000):
+            key = random.choice([b'a', b'b', b'c'])
+            op = random.random()
+            if op < 0.8:
+                entries = []
+                for _ in range(random.randint(1, 8)):
+                    next_id += 1
+                    lines = ','.join(str(random.randint(1, 999)) for _ in range(random.randint(1, 5)))
+                    entries.append((next_id, lines, random.choice('CCCKDM')))
+                self.refs.extend(key, entries)
+                model.setdefault(key, []).extend(entries)
+            elif op < 0.9 and key in model:
+                id = random.randint(next_id - 30, next_id)
+                self.refs.truncate(key, id)
+                model[key] = [entry for entry in model[key] if entry[0] < id]
+                if not model[key]:
+                    del model[key]
+            elif key in model:
+                self.refs.put(key, self.refs.get(key))
+
+            value = self.refs.get(key)
+            self.assertEqual(sorted(value.iter()) if value else [], sorted(model.get(key, [])))
+
+class PrefixKeysTest(TableTestCase):
+    def test_bsd_db(self):
+        table = self.open(data.BsdDB, 'definitions.db', lambda x: x)
+        for key in (b'abc', b'abd', b'ab', b'b', b'a'):
+            table.put(key, b'')
+        self.assertEqual(list(table.iter_prefix_keys(b'ab')), [b'ab', b'abc', b'abd'])
+        self.assertEqual(list(table.iter_prefix_keys('b')), [b'b'])
+        self.assertEqual(list(table.iter_prefix_keys(b'c')), [])
+
+    def test_segment_keys(self):
+        comps = self.open(data.RefListDB, 'compatibledts.db')
+        comps.segment_size = 100
+        comps.extend(b'vendor,foo', make_reflist(range(50)))
+        comps.extend(b'vendor,foo-bar', make_reflist([1]))
+        self.assertGreater(len(comps.db.keys()), 3)
+        self.assertEqual(list(comps.iter_prefix_keys(b'vendor,f')), [b'vendor,foo', b'vendor,foo-bar'])
+
+class IdentRefListDBTest(RefListDBTest):
+    # Same tests, with the table keyed by ident IDs
+    def setUp(self):
+        TableTestCase.setUp(self)
+        vars = self.open(data.BsdDB, 'variables.db', lambda x: int(x.decode()))
+        self.idents = data.IdentDict(self.tmpdir.name, False, vars)
+        self.refs = self.open(data.RefListDB, 'references.db', False, self.idents)
+        self.refs.segment_size = 300
+
+    def tearDown(self):
+        self.idents.close()
+        super().tearDown()
+
+    def key(self, ident):
+        return data.IdentDict.pack_id(self.idents.add(ident))
+
+    def test_keys(self):
+        self.refs.extend(b'first', make_reflist([1]))
+        self.refs.put(b'second', data.RefList(b'2:3:C\n'))
+        self.assertEqual(sorted(self.refs.db.keys()), [b'\0\0\0\0', b'\0\0\0\1'])
+        self.assertEqual(sorted(self.refs.get_keys()), [b'first', b'second'])
+        self.assertEqual(sorted(ident for ident, _ in self.refs.iter_items()), [b'first', b'second'])
+        self.assertTrue(self.refs.exists(b'second'))
+
+        # Idents without an ID are not given one by lookups or removals
+        self.assertFalse(self.refs.exists(b'other'))
+        self.assertIsNone(self.refs.get(b'other'))
+        self.refs.delete(b'other')
+        self.refs.truncate(b'other', 0)
+        self.assertIsNone(self.idents.get(b'other'))
+
+        # IDs are kept once the value is deleted
+        self.refs.delete(b'first')
+        self.assertEqual(self.refs.get_keys(), [b'second'])
+        self.assertEqual(self.idents.get(b'first'), 0)
+
+class IdentDictTest(TableTestCase):
+    def setUp(self):
+        super().setUp()
+        self.vars = self.open(data.BsdDB, 'variables.db', lambda x: int(x.decode()))
+
+    def test_add(self):
+        idents = data.IdentDict(self.tmpdir.name, False, self.vars)
+        self.assertEqual([idents.add(ident) for ident in (b'a', 'b', b'a', b'c')], [0, 1, 0, 2])
+        self.assertEqual(idents.get(b'b'), 1)
+        self.assertIsNone(idents.get(b'd'))
+        self.assertEqual(idents.get_name(2), b'c')
+        self.assertIsNone(idents.get_name(3))
+        idents.close()
+
+    def test_key_order(self):
+        # Keys sort like IDs, and segment keys right after the key of their ident
+        keys = [data.IdentDict.pack_id(id) for id in (0, 2, 10, 255, 256, 70000)]
+        self.assertEqual(sorted(keys), keys)
+        self.assertTrue(all(len(key) == data.IdentDict.key_size for key in keys))
+        refs = self.open(data.RefListDB, 'references.db')
+        self.assertLess(refs.segment_key(keys[1], 12), keys[2])
+
+    def test_reserve(self):
+        idents = data.IdentDict(self.tmpdir.name, False, self.vars)
+        idents.reserve_size = 4
+        for n in range(6):
+            idents.add(b'ident%d' % n)
+        self.assertEqual(self.vars.get('numIdents'), 8)
+        idents.close()
+
+        # IDs reserved by an interrupted run are never given again
+        idents = data.IdentDict(self.tmpdir.name, False, self.vars)
+        self.assertEqual(idents.add(b'ident2'), 2)
+        self.assertEqual(idents.add(b'new'), 8)
+        idents.close()
+
+    def test_restore_names(self):
+        # An interrupted run saved an ID in idents.db but not its name
+        idents = data.IdentDict(self.tmpdir.name, False, self.vars)
+        idents.add(b'a')
+        idents.add(b'b')
+        idents.names.delete(data.IdentDict.pack_id(1))
+        self.assertIsNone(idents.get_name(1))
+
+        idents.restore_names()
+        self.assertEqual(idents.get_name(0), b'a')
+        self.assertEqual(idents.get_name(1), b'b')
+        idents.close()
+
+    def test_clear(self):
+        idents = data.IdentDict(self.tmpdir.name, False, self.vars)
+        idents.add(b'a')
+        idents.add(b'b')
+        idents.clear()
+        self.assertIsNone(idents.get(b'a'))
+        self.assertFalse(self.vars.exists('numIdents'))
+        self.assertEqual(idents.add(b'b'), 0)
+        idents.close()
+
+    def test_db(self):
+        # New databases key references by ID, older ones by name
+        db = data.DB(self.tmpdir.name, readonly=False)
+        db.refs.extend(b'ident', make_reflist([1]))
+        db.docs.extend(b'ident', make_reflist([2]))
+        self.assertEqual(db.refs.db.keys(), [b'\0\0\0\0'])
+        self.assertEqual(db.docs.db.keys(), [b'\0\0\0\0'])
+        db.close()
+
+        db = data.DB(self.tmpdir.name, readonly=True)
+        self.assertEqual(list(db.refs.get(b'ident').iter()), make_reflist([1]))
+        db.close()
+
+        os.remove(os.path.join(self.tmpdir.name, 'idents.db'))
+        os.remove(os.path.join(self.tmpdir.name, 'identnames.db'))
+        db = data.DB(self.tmpdir.name, readonly=False)
+        self.assertIsNone(db.idents)
+        db.refs.extend(b'ident', make_reflist([3]))
+        self.assertIn(b'ident', db.refs.db.keys())
+        db.close()
+
+class CheckpointTest(unittest.TestCase):
+    def test_new(self):
+        checkpoint = data.Checkpoint()
+        self.assertEqual((checkpoint.first, checkpoint.last), (0, None))
+        self.assertEqual((checkpoint.deferred, checkpoint.done), ([], []))
+        self.assertIsNone(checkpoint.writing)
+        self.assertEqual(checkpoint.idents, [])
+
+    def test_pack_and_parse(self):
+        checkpoint = data.Checkpoint()
+        checkpoint.first = 120
+        checkpoint.last = 180
+        checkpoint.deferred = ['late_refs']
+        checkpoint.done = ['defs', 'docs']
+        checkpoint.writing = 'refs'
+        checkpoint.idents = [b'ident', b'CONFIG_OTHER']
+
+        parsed = data.Checkpoint(checkpoint.pack())
+        self.assertEqual((parsed.first, parsed.last), (120, 180))
+        self.assertEqual(parsed.deferred, ['late_refs'])
+        self.assertEqual(parsed.done, ['defs', 'docs'])
+        self.assertEqual(parsed.writing, 'refs')
+        self.assertEqual(parsed.idents, [b'ident', b'CONFIG_OTHER'])
+
+        # Idents are only kept while a stage is being written
+        parsed.writing = None
+        parsed = data.Checkpoint(parsed.pack())
+        self.assertIsNone(parsed.writing)
+        self.assertEqual(parsed.idents, [])
+
+    def test_allocating(self):
+        checkpoint = data.Checkpoint()
+        checkpoint.first = 7
+        parsed = data.Checkpoint(checkpoint.pack())
+        self.assertEqual((parsed.first, parsed.last), (7, None))
+
+class SnapshotTest(unittest.TestCase):
+    def test_pack_and_parse(self):
+        snapshot = data.Snapshot()
+        snapshot.seq = 3
+        snapshot.ref = 'refs/heads/some branch'
+        snapshot.set_owned({10, 11, 12, 20, 5})
+        snapshot.tags = [b'v1.0', b'v1.1']
+
+        self.assertEqual(snapshot.owned, [(5, 6), (10, 13), (20, 21)])
+        self.assertEqual(list(snapshot.iter_owned()), [5, 10, 11, 12, 20])
+
+        parsed = data.Snapshot(snapshot.pack())
+        self.assertEqual(parsed.seq, 3)
+        self.assertEqual(parsed.ref, 'refs/heads/some branch')
+        self.assertEqual(parsed.owned, [(5, 6), (10, 13), (20, 21)])
+        self.assertEqual(parsed.tags, [b'v1.0', b'v1.1'])
+
+    def test_empty(self):
+        snapshot = data.Snapshot()
+        snapshot.ref = 'master'
+        snapshot.set_owned(set())
+        parsed = data.Snapshot(snapshot.pack())
+        self.assertEqual((parsed.seq, parsed.ref, parsed.owned, parsed.tags), (0, 'master', [], []))
+
+class ZlibCodecTest(unittest.TestCase):
+    value = b''.join(b'%d:%d,%d:C\n' % (id, id % 50, id % 70) for id in range(2000))
+
+    def test_small_values_are_stored_as_is(self):
+        codec = data.ZlibCodec({}, 0, threshold=512)
+        self.assertEqual(codec.encode(b'12:3:C\n'), b'12:3:C\n')
+        self.assertEqual(codec.decode(b'12:3:C\n'), b'12:3:C\n')
+
+    def test_round_trip_without_dictionary(self):
+        codec = data.ZlibCodec({}, 0)
+        encoded = codec.encode(self.value)
+        self.assertTrue(encoded.startswith(data.ZlibCodec.marker + b'\0'))
+        self.assertLess(len(encoded), len(self.value))
+        self.assertEqual(codec.decode(encoded), self.value)
+
+    def test_round_trip_with_dictionary(self):
+        codec = data.ZlibCodec({1: self.value[:4096], 2: b'unused'}, 1)
+        encoded = codec.encode(self.value)
+        self.assertEqual(encoded[:2], data.ZlibCodec.marker + b'\1')
+        self.assertEqual(codec.decode(encoded), self.value)
+
+        # Values written with a previous dictionary still decode
+        codec.current = 2
+        self.assertEqual(codec.decode(encoded), self.value)
+        self.assertEqual(codec.encode(self.value)[1], 2)
+
+    def test_values_starting_with_the_marker(self):
+        codec = data.ZlibCodec({}, 0)
+        for value in (b'\1', b'\1abc', b'\1' + bytes(range(256))):
+            encoded = codec.encode(value)
+            self.assertTrue(encoded.startswith(data.ZlibCodec.marker))
+            self.assertEqual(codec.decode(encoded), value)
+
+    def test_incompressible_values_are_stored_as_is(self):
+        value = os.urandom(4096).replace(b'\1', b'\2')
+        codec = data.ZlibCodec({}, 0)
+        self.assertEqual(codec.encode(value), value)
+
+    def test_decode_only(self):
+        encoded = data.ZlibCodec({}, 0).encode(self.value)
+        codec = data.ZlibCodec({})
+        self.assertEqual(codec.encode(self.value), self.value)
+        self.assertEqual(codec.decode(encoded), self.value)
+
+class CodecTablesTest(TableTestCase):
+    def test_load(self):
+        codecs = self.open(data.BsdDB, 'codecs.db', lambda x: x)
+        self.assertIsNone(data.ZlibCodec.load(codecs, b'references'))
+
+        codecs.put(b'references:1', b'dictionary')
+        codecs.put(b'references', b'1 64 9')
+        codecs.put(b'doccomments:3', b'other')
+        codec = data.ZlibCodec.load(codecs, b'references')
+        self.assertEqual(codec.dictionaries, {1: b'dictionary'})
+        self.assertEqual((codec.current, codec.threshold, codec.level), (1, 64, 9))
+
+        # Compression turned off: values are only decoded
+        codec = data.ZlibCodec.load(codecs, b'doccomments')
+        self.assertEqual(codec.dictionaries, {3: b'other'})
+        self.assertIsNone(codec.current)
+
+    def test_reflist_db(self):
+        refs = self.open(data.RefListDB, 'references.db')
+        refs.segment_size = 4096
+        refs.codec = data.ZlibCodec({}, 0, threshold=256)
+
+        refs.extend(b'small', make_reflist([1]))
+        refs.extend(b'large', make_reflist(range(0, 300)))
+        refs.extend(b'large', make_reflist(range(300, 600), 'K'))
+        refs.extend(b'large', make_reflist(range(600, 1000)))
+
+        self.assertEqual(refs.db.get(b'small'), b'1:2:C\n')
+        stored = [key for key in refs.db.keys() if refs.db.get(key).startswith(data.ZlibCodec.marker)]
+        self.assertIn(b'large\0' + b'0', stored)
+
+        expected = make_reflist(range(0, 300)) + make_reflist(range(300, 600), 'K') + \
+                   make_reflist(range(600, 1000))
+        self.assertEqual(sorted(refs.get(b'large').iter()), sorted(expected))
+        self.assertEqual(sorted(refs.get(b'large', families=['K']).iter()),
+                         make_reflist(range(300, 600), 'K'))
+        self.assertEqual(dict(refs.iter_items()).keys(), {b'small', b'large'})
+
+        # Walking the table decodes each segment once, with its ident
+        decoded = []
+        decode = refs.codec.decode
+        with mock.patch.object(refs.codec, 'decode', lambda val: decoded.append(val) or decode(val)):
+            items = dict(refs.iter_items())
+        self.assertEqual(sorted(items[b'large'].iter()), sorted(expected))
+        self.assertEqual(len(decoded), len(refs.db.keys()))
+
+        refs.truncate(b'large', 500)
+        self.assertEqual(sorted(refs.get(b'large').iter()), sorted(expected[:500]))
+
+        # The table reads the same without compression once decoded
+        refs.codec.current = None
+        refs.put(b'large', refs.get(b'large'))
+        self.assertFalse(any(refs.db.get(key).startswith(data.ZlibCodec.marker)
+                             for key in refs.db.keys()))
+        refs.codec = None
+        self.assertEqual(sorted(refs.get(b'large').iter()), sorted(expected[:500]))
+
+if __name__ == '__main__':
+    unittest.main()
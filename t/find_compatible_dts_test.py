@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+#  This file is part of Elixir, a source code cross-referencer.
+#
+#  Elixir is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Elixir is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with Elixir.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compares FindCompatibleDTS, which parses whole files, with the line by
+# line parsing it replaced.
+
+import os
+import re
+import sys
+import unittest
+from random import Random
+from urllib import parse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')))
+
+from find_compatible_dts import FindCompatibleDTS
+
+tree_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'tree')
+
+# Former implementation: the regexes are run on each line
+def run_by_line(content, family):
+    regex_c = re.compile(r'\s*{*\s*\.compatible\s*=\s*"(.+?)"')
+    regex_dts1 = re.compile(r'\s*compatible')
+    regex_dts2 = re.compile(r'"(.+?)"')
+    regex_bindings = re.compile(r'([\w-]+,?[\w-]+)')
+
+    ident_list = []
+    lines = content.split(b'\n')
+    if not lines[-1]:
+        del lines[-1]
+    for num, line in enumerate(lines, 1):
+        line = line.decode()
+        if family == 'C':
+            ret = regex_c.findall(line)
+        elif family == 'D':
+            ret = regex_dts2.findall(line) if regex_dts1.match(line) else []
+        elif family == 'B':
+            ret = regex_bindings.findall(line)
+
+        for ident in ret:
+            ident_list.append((parse.quote(ident), num))
+    return ident_list
+
+dts = b'''/dts-v1/;
+/ {
+\tcompatible = "acme,board", "acme,soc";
+\tmodel = "Board with a \\"compatible\\" string";
+
+\ti2c@1000 {
+\t\tcompatible = "acme,i2c";
+\t\tsensor@48 {
+\t\t\tcompatible="ti,tmp102",
+\t\t\t\t"ti,tmp75";
+\t\t};
+\t};
+\t/* compatible = "acme,commented"; */
+\tcompatible-extra = "acme,\xc3\xa9";
+};
+'''
+
+c = b'''static const struct of_device_id acme_of_match[] = {
+\t{ .compatible = "acme,i2c", .data = &acme_data },
+\t{.compatible="acme,i2c-v2"},
+\t{
+\t\t.compatible = "acme,multi line",
+\t},
+\t{ .compatible =
+\t\t"acme,split" },
+\t{ }
+};
+'''
+
+bindings = b'''Acme I2C controller
+
+Required properties:
+- compatible: should be "acme,i2c" or "acme,i2c-v2"
+- reg: address and length of the register set
+'''
+
+class FindCompatibleDTSTest(unittest.TestCase):
+    def setUp(self):
+        self.parser = FindCompatibleDTS()
+
+    def test_dts(self):
+        self.assertEqual(self.parser.run(dts, 'D'), [
+            ('acme%2Cboard', 3), ('acme%2Csoc', 3), ('acme%2Ci2c', 7), ('ti%2Ctmp102', 9),
+            ('acme%2C%C3%A9', 14)])
+        self.assertEqual(self.parser.run(dts, 'D'), run_by_line(dts, 'D'))
+
+    def test_c(self):
+        self.assertEqual(self.parser.run(c, 'C'), [
+            ('acme%2Ci2c', 2), ('acme%2Ci2c-v2', 3), ('acme%2Cmulti%20line', 5)])
+        self.assertEqual(self.parser.run(c, 'C'), run_by_line(c, 'C'))
+
+    def test_bindings(self):
+        result = self.parser.run(bindings, 'B')
+        self.assertIn(('acme%2Ci2c-v2', 4), result)
+        self.assertEqual(result, run_by_line(bindings, 'B'))
+
+    def test_tree(self):
+        for root, _, files in os.walk(tree_dir):
+            for name in files:
+                with open(os.path.join(root, name), 'rb') as f:
+                    content = f.read()
+                for family in 'CDB':
+                    self.assertEqual(self.parser.run(content, family), run_by_line(content, family),
+                                     (name, family))
+
+    def test_random(self):
+        random = Random(0)
+        words = [b'compatible', b'.compatible', b' = ', b'"', b'acme,foo', b'\n', b'\t', b' ',
+                 b'{', b'-', b',', b'x', b'\xc3\xa9', b'\r', b'=']
+        for _ in range(2000):
+            content = b''.join(random.choice(words) for _ in range(random.randint(0, 60))) + b'\n'
+            for family in 'CDB':
+                self.assertEqual(self.parser.run(content, family), run_by_line(content, family),
+                                 (content, family))
+
+if __name__ == '__main__':
+    unittest.main()
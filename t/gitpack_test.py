@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+#  This file is part of Elixir, a source code cross-referencer.
+#
+#  Elixir is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Elixir is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with Elixir.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compares the blobs read by elixir/gitpack.py with 'git cat-file', on a
+# repository whose files change a little in each commit, so that they are
+# packed as chains of deltas.
+
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')))
+
+from elixir import gitpack
+
+def git(repo, *args):
+    return subprocess.run(['git', '-C', repo, '-c', 'user.name=Elixir', '-c', 'user.email=elixir@localhost',
+                           *args], check=True, stdout=subprocess.PIPE).stdout
+
+class PackReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.repo = self.tmpdir.name
+        git(self.repo, 'init', '-q')
+
+        lines = [f'int function_{i}(int arg) {{ return arg + {i}; }}\n' for i in range(300)]
+        for rev in range(12):
+            lines[rev*20] = f'/* revision {rev} */\n'
+            lines.insert(rev*7, f'#define REVISION_{rev} {rev}\n')
+            with open(os.path.join(self.repo, 'file.c'), 'w') as f:
+                f.writelines(lines)
+            with open(os.path.join(self.repo, 'other.h'), 'w') as f:
+                f.writelines(reversed(lines[:100 + rev*10]))
+            git(self.repo, 'add', '.')
+            git(self.repo, 'commit', '-q', '-m', f'revision {rev}')
+
+        self.blobs = []
+        for line in git(self.repo, 'rev-list', '--objects', '--all').split(b'\n'):
+            if line:
+                hash = line.split(b' ')[0]
+                if git(self.repo, 'cat-file', '-t', hash) == b'blob\n':
+                    self.blobs.append(hash)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def repack(self, *config):
+        git(self.repo, *config, 'repack', '-a', '-d', '-f', '-q', '--depth=50', '--window=50')
+
+    # Returns the number of objects of each type stored in the packs
+    def get_types(self, reader):
+        types = {}
+        for pack in reader.packs:
+            for i in range(pack.index.count):
+                type, _, _ = pack.read_header(pack.index.get(pack.index[i]))
+                types[type] = types.get(type, 0) + 1
+        return types
+
+    def check_blobs(self, reader):
+        for hash in self.blobs:
+            self.assertEqual(reader.get_blob(hash), git(self.repo, 'cat-file', 'blob', hash), hash)
+
+    def test_ofs_deltas(self):
+        self.repack()
+        reader = gitpack.PackReader(self.repo)
+        self.assertGreater(self.get_types(reader).get(gitpack.OBJ_OFS_DELTA, 0), 10)
+        self.check_blobs(reader)
+        # Again with the bases in the cache
+        self.check_blobs(reader)
+        reader.close()
+
+    def test_ref_deltas(self):
+        self.repack('-c', 'repack.useDeltaBaseOffset=false')
+        reader = gitpack.PackReader(self.repo)
+        self.assertGreater(self.get_types(reader).get(gitpack.OBJ_REF_DELTA, 0), 10)
+        self.check_blobs(reader)
+        reader.close()
+
+    def test_small_chunks(self):
+        self.repack()
+        reader = gitpack.PackReader(self.repo, cache_size=0)
+        for pack in reader.packs:
+            pack.chunk_size = 7
+        self.check_blobs(reader)
+        reader.close()
+
+    def test_loose_objects(self):
+        self.repack()
+        reader = gitpack.PackReader(self.repo)
+        with open(os.path.join(self.repo, 'new.c'), 'w') as f:
+            f.write('int new_file;\n')
+        hash = git(self.repo, 'hash-object', '-w', 'new.c').strip()
+        self.assertIsNone(reader.get_blob(hash))
+        self.assertIsNone(reader.get_blob(b'0' * 40))
+
+        # Packs written after the reader was created are found
+        git(self.repo, 'add', 'new.c')
+        git(self.repo, 'commit', '-q', '-m', 'new file')
+        self.repack()
+        self.assertEqual(reader.get_blob(hash), b'int new_file;\n')
+        reader.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+#  This file is part of Elixir, a source code cross-referencer.
+#
+#  Elixir is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Elixir is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with Elixir.  If not, see <http://www.gnu.org/licenses/>.
+
+# Runs the commands of utils/maintenance.py on the database update.py writes
+# for the repository of update_test.py.
+
+import os
+import subprocess
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+
+from update_test import RepoTestCase, elixir_dir, git
+from elixir import data, lib
+
+class MaintenanceTestCase(RepoTestCase):
+    def run_maintenance(self, data_dir, *args):
+        env = {**os.environ, 'LXR_REPO_DIR': self.repo, 'LXR_DATA_DIR': data_dir}
+        process = subprocess.run([sys.executable, '-m', 'utils.maintenance', *args], cwd=elixir_dir,
+                                 env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.last_output = process.stdout.decode()
+        self.assertEqual(process.returncode, 0, self.last_output)
+
+class MaintenanceTest(MaintenanceTestCase):
+    @staticmethod
+    def get_generation(data_dir):
+        db = data.DB(data_dir, readonly=True)
+        generation = db.vars.get('generation') if db.vars.exists('generation') else 0
+        db.close()
+        return generation
+
+    # Returns the entries of dump that belong to the blobs of a tag
+    @staticmethod
+    def get_tag_entries(dump, tag):
+        idxes = set(idx for idx, _ in dump['versions'][tag])
+        result = {'definitions': {}}
+        for ident, (defs, _) in dump['definitions'].items():
+            entries = [entry for entry in defs if entry[0] in idxes]
+            if entries:
+                result['definitions'][ident] = entries
+        for name in ('references', 'doccomments'):
+            result[name] = {}
+            for ident, entries in dump[name].items():
+                entries = [entry for entry in entries if entry[0] in idxes]
+                if entries:
+                    result[name][ident] = entries
+        return result
+
+    def test_prune(self):
+        data_dir = self.run_update(self.make_data_dir())
+        before = self.dump(data_dir)
+        generation = self.get_generation(data_dir)
+
+        # util.c and util.h of v1.0 changed in v1.1, main.c did not
+        self.run_maintenance(data_dir, 'prune', 'v1.0')
+        self.assertIn('1 tags removed, 2 blobs no longer used', self.last_output)
+
+        after = self.dump(data_dir)
+        self.assertEqual(sorted(after['versions']), [b'v1.1', b'v1.1.1', b'v1.2'])
+        for path in ('util.c', 'util.h'):
+            self.assertNotIn(self.get_hash('v1.0:' + path), after['blobs'])
+        self.assertIn(self.get_hash('v1.0:main.c'), after['blobs'])
+        self.assertEqual(len(after['files']), len(after['blobs']))
+
+        for tag in after['versions']:
+            with self.subTest(tag=tag):
+                self.assertEqual(after['versions'][tag], before['versions'][tag])
+                self.assertEqual(self.get_tag_entries(after, tag), self.get_tag_entries(before, tag))
+
+        # No entry is left for the removed blobs
+        idxes = set(after['blobs'].values())
+        for name in ('references', 'doccomments'):
+            for entries in after[name].values():
+                self.assertTrue(entries)
+                self.assertLessEqual(set(entry[0] for entry in entries), idxes)
+        for defs, _ in after['definitions'].values():
+            self.assertTrue(defs)
+            self.assertLessEqual(set(entry[0] for entry in defs), idxes)
+
+        # UTIL_OLD is only defined in util.h of v1.0
+        self.assertIn(b'UTIL_OLD', before['cache-C'])
+        self.assertNotIn(b'UTIL_OLD', after['definitions'])
+        self.assertNotIn(b'UTIL_OLD', after['cache-C'])
+        self.run_maintenance(data_dir, 'check-defs-caches')
+
+        self.assertEqual(self.get_generation(data_dir), generation + 1)
+
+    # Returns the raw keys and values of every table of a data directory
+    @staticmethod
+    def get_raw_tables(data_dir):
+        result = {}
+        for name in sorted(os.listdir(data_dir)):
+            if name.endswith('.db'):
+                table = data.BsdDB(os.path.join(data_dir, name), True, lambda x: x)
+                result[name] = list(table.iter_items())
+                table.close()
+        return result
+
+    def test_compact(self):
+        data_dir = self.run_update(self.make_data_dir())
+        count = len(self.dump(data_dir)['references'][b'util_add'])
+        # Large enough to be split in segments, then compressed
+        db = data.DB(data_dir, readonly=False)
+        db.refs.segment_size = 200
+        db.refs.extend(b'util_add', [(1000 + n, ','.join(str(l) for l in range(n % 20 + 1)), 'C')
+                                     for n in range(100)])
+        db.close()
+        self.run_maintenance(data_dir, 'compress', '--threshold', '64')
+
+        raw = self.get_raw_tables(data_dir)
+        refs = raw['references.db']
+        self.assertTrue(any(b'\0' in key for key, _ in refs))
+        self.assertTrue(any(value.startswith(b'\1') for _, value in refs))
+        self.assertIn('codecs.db', raw)
+        before = self.dump(data_dir)
+        self.assertEqual(len(before['references'][b'util_add']), count + 100)
+
+        output = os.path.join(self.tmpdir.name, 'updtest', 'compact')
+        self.run_maintenance(data_dir, 'compact', '--output', output)
+        self.assertEqual(self.get_raw_tables(output), raw)
+        self.assertEqual(self.dump(output), before)
+
+        self.run_maintenance(data_dir, 'compact')
+        self.assertEqual(sorted(os.listdir(data_dir)), sorted(os.listdir(output)))
+        self.assertEqual(self.get_raw_tables(data_dir), raw)
+        self.assertEqual(self.dump(data_dir), before)
+
+# Adds a tag to the repository, which MaintenanceTest does not expect
+class StoplistTest(MaintenanceTestCase):
+    def test_stoplist(self):
+        data_dir = self.run_update(self.make_data_dir())
+        before = self.dump(data_dir)
+
+        # Only these idents have more than one reference in v1.2
+        stopped = [b'CONFIG_UTIL', b'util_add', b'util_sub']
+        self.run_maintenance(data_dir, 'stoplist', '--threshold', '1')
+        self.assertIn('3 idents with more than 1 references in v1.2', self.last_output)
+        self.assertEqual(self.dump(data_dir), before)
+        self.assertFalse(os.path.exists(os.path.join(data_dir, 'stoplist')))
+
+        self.run_maintenance(data_dir, 'stoplist', '--threshold', '1', '--apply')
+        self.assertEqual(sorted(lib.getStopList(data_dir)), stopped)
+        after = self.dump(data_dir)
+        for ident in stopped:
+            self.assertNotIn(ident, after['references'])
+            self.assertFalse(lib.isIdent(ident, lib.getStopList(data_dir)))
+            del before['references'][ident]
+        self.assertEqual(after, before)
+
+        # References to stopped idents are not indexed for new tags
+        git(self.repo, 'checkout', '-q', '-b', 'stop', 'v1.2')
+        self.commit({'stop.c': 'int stop(void)\n{\n\treturn util_sub(1, UTIL_MAX);\n}\n'}, 'v1.3')
+        self.run_update(data_dir)
+        after = self.dump(data_dir)
+        stop_idx = after['blobs'][self.get_hash('v1.3:stop.c')]
+        self.assertIn((stop_idx, '3', 'C'), after['references'][b'UTIL_MAX'])
+        for ident in stopped:
+            self.assertNotIn(ident, after['references'])
+        self.assertIn(b'util_sub', after['definitions'])
+
+if __name__ == '__main__':
+    unittest.main()
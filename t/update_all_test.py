@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+#  This file is part of Elixir, a source code cross-referencer.
+#
+#  Elixir is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Elixir is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with Elixir.  If not, see <http://www.gnu.org/licenses/>.
+
+# Tests of how utils/update_all.py shares processes between projects, with
+# update.py runs replaced by projects that finish in a given order.
+
+import itertools
+import os
+import sys
+import unittest
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')))
+
+from utils.update_all import Project, Scheduler
+
+# Does not start update.py: projects finish in launch order, or the newest
+# first with lifo
+class FakeScheduler(Scheduler):
+    def __init__(self, *args, lifo=False):
+        super().__init__(*args)
+        self.lifo = lifo
+        self.launched = []
+        self.max_used = 0
+        self.finished = SimpleNamespace(get=lambda: self.running[-1 if self.lifo else 0])
+
+    def launch(self, project):
+        self.free -= project.cpu
+        self.running.append(project)
+        self.launched.append(project)
+        used = sum(p.cpu for p in self.running)
+        assert used + self.free == self.cpu
+        self.max_used = max(self.max_used, used)
+
+class SchedulerTest(unittest.TestCase):
+    def make_projects(self, new_tags):
+        projects = []
+        for n, count in enumerate(new_tags):
+            project = Project(f'project{n}', '/nonexistent')
+            project.new_tags = count
+            projects.append(project)
+        return projects
+
+    def test_budget(self):
+        for new_tags in ([0], [5], [-1, 0, 3], [100, 1, 1, 0, 0, 7, -1], [2] * 10, [0] * 5):
+            for cpu, jobs, lifo in itertools.product((1, 2, 3, 8, 17), (1, 2, 4, 16), (False, True)):
+                with self.subTest(new_tags=new_tags, cpu=cpu, jobs=jobs, lifo=lifo):
+                    projects = self.make_projects(new_tags)
+                    scheduler = FakeScheduler(projects, cpu, jobs, [], lifo=lifo)
+                    scheduler.run()
+
+                    self.assertLessEqual(scheduler.max_used, cpu)
+                    self.assertEqual(scheduler.free, cpu)
+                    self.assertEqual(sorted(p.name for p in scheduler.launched),
+                                     sorted(p.name for p in projects))
+                    self.assertTrue(all(p.cpu >= 1 for p in projects))
+                    # Projects without new tags get a single process
+                    self.assertTrue(all(p.cpu == 1 for p in projects if p.new_tags == 0))
+
+    def test_order(self):
+        projects = self.make_projects([3, 0, -1, 10])
+        scheduler = FakeScheduler(projects, 8, 2, [])
+        scheduler.run()
+        # Interrupted runs first, then by number of new tags
+        self.assertEqual([p.name for p in scheduler.launched],
+                         ['project2', 'project3', 'project0', 'project1'])
+        # The first two share the processes, the next ones get those freed
+        self.assertEqual([p.cpu for p in scheduler.launched], [4, 4, 4, 1])
+
+if __name__ == '__main__':
+    unittest.main()
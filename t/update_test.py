@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+
+#  This file is part of Elixir, a source code cross-referencer.
+#
+#  Elixir is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Elixir is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with Elixir.  If not, see <http://www.gnu.org/licenses/>.
+
+# Runs update.py on a small repository of several tags, and compares the
+# databases written by a plain run, a --bulk run, and runs interrupted at
+# various points then started again, and the database left by an expired
+# snapshot with one that never had it. --daemon runs index a tag created
+# while they wait, and --textfile metrics follow the Prometheus format.
+
+import json
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+elixir_dir = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+sys.path.insert(0, elixir_dir)
+
+from elixir import data
+
+metric_name = r'[a-zA-Z_:][a-zA-Z0-9_:]*'
+label_regex = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\\n]|\\.)*)"(,|$)')
+sample_regex = re.compile(r'(' + metric_name + r')(?:\{(.*)\})? (\S+)( -?\d+)?')
+comment_regex = re.compile(r'# (HELP|TYPE) (' + metric_name + r') (.*)')
+
+# Parses the Prometheus text exposition format, and returns the help, type
+# and (labels, value) samples of each metric. Raises ValueError on lines
+# that do not follow the format.
+def parse_textfile(text):
+    metrics = {}
+    if not text.endswith('\n'):
+        raise ValueError('no newline at the end')
+    for line in text[:-1].split('\n'):
+        match = comment_regex.fullmatch(line)
+        if match:
+            kind, name, value = match.groups()
+            metric = metrics.setdefault(name, {'help': None, 'type': None, 'samples': []})
+            key = kind.lower()
+            if metric[key] is not None or metric['samples']:
+                raise ValueError('misplaced ' + kind + ': ' + line)
+            if kind == 'TYPE' and value not in ('counter', 'gauge', 'histogram', 'summary', 'untyped'):
+                raise ValueError('unknown type: ' + line)
+            metric[key] = value
+            continue
+
+        match = sample_regex.fullmatch(line)
+        if match is None or match.group(1) not in metrics:
+            raise ValueError('invalid sample: ' + line)
+        labels = {}
+        rest = match.group(2) or ''
+        while rest:
+            label = label_regex.match(rest)
+            if label is None or label.group(1) in labels:
+                raise ValueError('invalid labels: ' + line)
+            labels[label.group(1)] = label.group(2)
+            rest = rest[label.end():]
+        metrics[match.group(1)]['samples'].append((labels, float(match.group(3))))
+    return metrics
+
+# Files of each tag, None to remove a file
+tags = [
+    ('v1.0', {
+        'main.c': '#include "util.h"\n\nint main(void)\n{\n\tlater_init();\n\treturn util_add(N, UTIL_MAX);\n}\n',
+        'util.h': '#define N 1\n#define UTIL_MAX 10\n#define UTIL_OLD 0\n\nint util_add(int a, int b);\n',
+        'util.c': '/**\n * util_add - adds\n */\nint util_add(int a, int b)\n{\n\treturn a + b;\n}\n',
+        'Kconfig': 'config UTIL\n\tbool "Utilities"\n',
+        'Makefile': 'obj-$(CONFIG_UTIL) += util.o\n',
+    }),
+    ('v1.1', {
+        'util.c': '/**\n * util_add - adds\n */\nint util_add(int a, int b)\n{\n\treturn a + b;\n}\n\n'
+                  'int util_sub(int a, int b)\n{\n\treturn util_add(a, -b);\n}\n',
+        'util.h': '#define N 1\n#define UTIL_MAX 10\n\nint util_add(int a, int b);\nint util_sub(int a, int b);\n',
+        'lib/list.c': '#include "../util.h"\n\nstruct list_node {\n\tint x;\n};\n\n'
+                      'int list_len(struct list_node *n)\n{\n\treturn util_sub(UTIL_MAX, n->x);\n}\n',
+    }),
+    ('v1.1.1', {}),
+    ('v1.2', {
+        'main.c': '#include "util.h"\n\nint main(void)\n{\n\treturn util_sub(N, UTIL_MAX) + list_len(0);\n}\n',
+        'lib/list.c': None,
+        'later.c': 'void later_init(void)\n{\n}\n',
+        'Kconfig': 'config UTIL\n\tbool "Utilities"\n\nconfig LIST\n\tdepends on UTIL\n',
+    }),
+]
+
+def git(repo, *args):
+    subprocess.run(['git', '-C', repo, '-c', 'user.name=Elixir', '-c', 'user.email=elixir@localhost',
+                    *args], check=True, stdout=subprocess.DEVNULL)
+
+# Interrupts update.py at the given number of writes, and prints their
+# number if it ends before. Writes are counted once the function of
+# update.py given after the number is called, from the start with '-'.
+crash_script = '''
+import os, sys
+sys.path.insert(0, {elixir_dir!r})
+import elixir.data as data
+limit = int(sys.argv.pop(1))
+after = sys.argv.pop(1)
+count = 0
+started = after == '-'
+put_raw = data.BsdDB.put_raw
+def crashing_put_raw(self, key, val):
+    global count
+    if started:
+        count += 1
+        if count == limit:
+            os._exit(9)
+    put_raw(self, key, val)
+data.BsdDB.put_raw = crashing_put_raw
+import update
+if not started:
+    function = getattr(update, after)
+    def start(*args, **kwargs):
+        global started
+        started = True
+        return function(*args, **kwargs)
+    setattr(update, after, start)
+update.main()
+print('writes', count)
+'''.format(elixir_dir=elixir_dir)
+
+# Creates the repository of tags for each test class, and runs update.py on it
+class RepoTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.repo = os.path.join(cls.tmpdir.name, 'updtest', 'repo')
+        os.makedirs(cls.repo)
+        git(cls.repo, 'init', '-q')
+        for tag, files in tags:
+            cls.commit(files, tag)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    # Commits files on the current branch, None to remove a file, and tags
+    # the commit if tag is set
+    @classmethod
+    def commit(cls, files, tag=None):
+        for path, content in files.items():
+            path = os.path.join(cls.repo, path)
+            if content is None:
+                os.remove(path)
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(content)
+        git(cls.repo, 'add', '-A')
+        git(cls.repo, 'commit', '-q', '--allow-empty', '-m', tag or 'commit')
+        if tag is not None:
+            git(cls.repo, 'tag', tag)
+
+    @classmethod
+    def get_hash(cls, rev):
+        return subprocess.run(['git', '-C', cls.repo, 'rev-parse', rev], check=True,
+                              stdout=subprocess.PIPE).stdout.strip()
+
+    @classmethod
+    def make_data_dir(cls, name='data'):
+        data_dir = os.path.join(cls.tmpdir.name, 'updtest', name)
+        if os.path.exists(data_dir):
+            shutil.rmtree(data_dir)
+        os.makedirs(data_dir)
+        return data_dir
+
+    @classmethod
+    def run_update(cls, data_dir, *args, crash_at=None, crash_after='-'):
+        env = {**os.environ, 'LXR_REPO_DIR': cls.repo, 'LXR_DATA_DIR': data_dir}
+        if crash_at is None:
+            command = [sys.executable, 'update.py', '2', *args]
+        else:
+            command = [sys.executable, '-c', crash_script, str(crash_at), crash_after, '2', *args]
+
+        # In a session of its own, to kill the workers of an interrupted run
+        process = subprocess.Popen(command, cwd=elixir_dir, env=env, start_new_session=True,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output, _ = process.communicate()
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+        if crash_at is None or process.returncode != 9:
+            if process.returncode != 0:
+                raise AssertionError(output.decode())
+        cls.last_output = output.decode()
+        return data_dir
+
+    # Returns the content of the database, with entries in ID order
+    @staticmethod
+    def dump(data_dir):
+        db = data.DB(data_dir, readonly=True)
+        result = {
+            'numBlobs': db.vars.get('numBlobs'),
+            'blobs': dict(db.blob.iter_items()),
+            'files': dict(db.file.iter_items()),
+            'versions': {tag: sorted(paths.iter()) for tag, paths in db.vers.iter_items()},
+            'definitions': {ident: (sorted(defs.iter()), sorted(defs.get_families()))
+                            for ident, defs in db.defs.iter_items()},
+            'references': {ident: sorted(refs.iter()) for ident, refs in db.refs.iter_items()},
+            'doccomments': {ident: sorted(docs.iter()) for ident, docs in db.docs.iter_items()},
+        }
+        for family, cache in db.defs_cache.items():
+            result['cache-' + family] = sorted(cache.get_keys())
+        db.close()
+        return result
+
+    # Returns the content of dump with blob IDs replaced by the hash and path
+    # of the blob, as they depend on the order tags are indexed in
+    @staticmethod
+    def by_blob(dump):
+        hashes = {idx: hash for hash, idx in dump['blobs'].items()}
+        blob = lambda idx: (hashes[idx], dump['files'][str(idx).encode()])
+        result = {
+            'versions': {tag: sorted(blob(idx) for idx, _ in paths)
+                         for tag, paths in dump['versions'].items()},
+            'definitions': {ident: (sorted((blob(idx), *entry) for idx, *entry in defs), families)
+                            for ident, (defs, families) in dump['definitions'].items()},
+        }
+        for name in ('references', 'doccomments'):
+            result[name] = {ident: sorted((blob(idx), *entry) for idx, *entry in entries)
+                            for ident, entries in dump[name].items()}
+        for name in dump:
+            if name.startswith('cache-'):
+                result[name] = dump[name]
+        return result
+
+class UpdateTest(RepoTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.expected = cls.dump(cls.run_update(cls.make_data_dir()))
+
+    def test_content(self):
+        self.assertEqual(sorted(self.expected['versions']), [b'v1.0', b'v1.1', b'v1.1.1', b'v1.2'])
+        self.assertEqual(self.expected['versions'][b'v1.1'], self.expected['versions'][b'v1.1.1'])
+        self.assertIn(b'util_add', self.expected['definitions'])
+        self.assertIn(b'CONFIG_UTIL', self.expected['references'])
+        self.assertIn(b'util_add', self.expected['doccomments'])
+        self.assertIn(b'util_sub', self.expected['cache-C'])
+        # One-letter macros have neither definitions nor references
+        self.assertNotIn(b'N', self.expected['definitions'])
+        self.assertNotIn(b'N', self.expected['references'])
+
+    def test_textfile(self):
+        textfile = os.path.join(self.tmpdir.name, 'updtest', 'metrics.prom')
+        report = os.path.join(self.tmpdir.name, 'updtest', 'report.json')
+        self.run_update(self.make_data_dir(), '--textfile', textfile, '--report', report)
+        with open(textfile) as f:
+            metrics = parse_textfile(f.read())
+        with open(report) as f:
+            report = json.load(f)
+
+        names = ['last_run_timestamp_seconds', 'duration_seconds', 'tags', 'new_blobs', 'ids_seconds',
+                 'worker_wait_seconds', 'worker_utilization', 'peak_rss_bytes',
+                 'stage_blobs', 'stage_blobs_per_second', 'stage_parse_seconds', 'stage_subprocesses',
+                 'stage_subprocess_seconds', 'stage_subprocess_bytes', 'stage_idents_written',
+                 'stage_write_seconds', 'table_puts', 'table_put_bytes']
+        self.assertEqual(sorted(metrics), sorted('elixir_update_' + name for name in names))
+        for name, metric in metrics.items():
+            self.assertTrue(metric['help'])
+            self.assertEqual(metric['type'], 'gauge')
+            self.assertTrue(metric['samples'])
+            self.assertTrue(all(labels['project'] == 'updtest' for labels, _ in metric['samples']))
+
+        self.assertEqual(metrics['elixir_update_tags']['samples'], [({'project': 'updtest'}, 4)])
+        blobs = {labels['stage']: value for labels, value in metrics['elixir_update_stage_blobs']['samples']}
+        self.assertEqual(sorted(blobs), sorted(report['stages']))
+        self.assertEqual(blobs['defs'], report['stages']['defs']['blobs'])
+        self.assertGreater(blobs['refs'], 0)
+        tables = set(labels['table'] for labels, _ in metrics['elixir_update_table_puts']['samples'])
+        self.assertIn('references', tables)
+
+    def test_incremental(self):
+        data_dir = self.run_update(self.make_data_dir(), '--incremental')
+        self.assertEqual(self.dump(data_dir), self.expected)
+
+    def test_bulk(self):
+        data_dir = self.run_update(self.make_data_dir(), '--bulk')
+        self.assertFalse(os.path.exists(os.path.join(data_dir, 'bulk')))
+        self.assertEqual(self.dump(data_dir), self.expected)
+
+    # expected: dump of a complete run with args, the one of a plain run by default
+    # crash_after: function of update.py after which writes are interrupted
+    def check_resume(self, *args, expected=None, crash_after='-'):
+        if expected is None:
+            expected = self.expected
+        self.run_update(self.make_data_dir(), *args, crash_at=0, crash_after=crash_after)
+        writes = int(self.last_output.split('writes ')[-1])
+        self.assertGreater(writes, 0)
+
+        resumed = 0
+        for crash_at in range(1, writes, max(1, writes // 10)):
+            with self.subTest(crash_at=crash_at):
+                data_dir = self.run_update(self.make_data_dir(), *args, crash_at=crash_at,
+                                           crash_after=crash_after)
+                self.run_update(data_dir, *args)
+                if 'resuming' in self.last_output:
+                    resumed += 1
+                self.assertEqual(self.dump(data_dir), expected)
+        self.assertGreater(resumed, 0)
+
+    def test_resume(self):
+        self.check_resume()
+
+    def test_resume_bulk(self):
+        self.check_resume('--bulk')
+
+    def test_newest_first(self):
+        dump = self.dump(self.run_update(self.make_data_dir(), '--newest-first', '2'))
+        result = self.by_blob(dump)
+        expected = self.by_blob(self.expected)
+        # v1.2 is indexed first, and references to list_len, only defined by
+        # older tags, are added by write_late_references()
+        self.assertIn(b'list_len', result['references'])
+
+        # The blob of main.c of v1.0, indexed oldest first before any tag
+        # defines later_init, keeps its reference to it
+        self.assertNotIn(b'later_init', expected['references'])
+        later = result['references'].pop(b'later_init')
+        self.assertEqual([entry[0][1] for entry in later], ['main.c'])
+        self.assertIn(later[0][0], expected['versions'][b'v1.0'])
+        self.assertEqual(result, expected)
+
+    def test_resume_newest_first(self):
+        expected = self.dump(self.run_update(self.make_data_dir(), '--newest-first', '2'))
+        self.check_resume('--newest-first', '2', expected=expected)
+
+    def test_resume_late_references(self):
+        expected = self.dump(self.run_update(self.make_data_dir(), '--newest-first', '2'))
+        self.check_resume('--newest-first', '2', expected=expected, crash_after='write_late_references')
+
+class SnapshotTest(RepoTestCase):
+    args = ('--ref', 'dev', '--keep-snapshots', '1')
+
+    # Returns the hashes of the blobs owned by each snapshot
+    @staticmethod
+    def get_owned(data_dir):
+        db = data.DB(data_dir, readonly=True)
+        hashes = {idx: hash for hash, idx in db.blob.iter_items()}
+        result = {name: sorted(hashes[idx] for idx in snapshot.iter_owned())
+                  for name, snapshot in db.snapshots.iter_items()}
+        db.close()
+        return result
+
+    def test_expire(self):
+        git(self.repo, 'checkout', '-q', '-b', 'dev')
+        self.commit({
+            'snap.c': '/**\n * snap_one - one\n */\nint snap_one(void)\n{\n\treturn util_add(1, 2);\n}\n',
+            'keep.c': 'int snap_keep(void)\n{\n\treturn snap_one();\n}\n',
+            'tagged.c': 'int snap_tagged(void)\n{\n\treturn 0;\n}\n',
+        })
+        first = b'dev:' + self.get_hash('HEAD')
+        removed = self.get_hash('HEAD:snap.c')
+        data_dir = self.run_update(self.make_data_dir(), *self.args)
+        self.assertEqual(list(self.get_owned(data_dir)), [first])
+        self.assertIn(b'snap_one', self.dump(data_dir)['doccomments'])
+
+        # A tag indexed after the first snapshot keeps tagged.c, and the
+        # second snapshot keeps keep.c
+        git(self.repo, 'checkout', '-q', '-b', 'side', 'v1.2')
+        self.commit({'tagged.c': 'int snap_tagged(void)\n{\n\treturn 0;\n}\n'}, 'v1.3')
+        git(self.repo, 'checkout', '-q', 'dev')
+        self.commit({
+            'snap.c': 'int snap_two(void)\n{\n\treturn util_add(2, 2);\n}\n',
+            'tagged.c': None,
+        })
+        second = b'dev:' + self.get_hash('HEAD')
+        self.run_update(data_dir, *self.args)
+        self.assertIn('expired 1 snapshots, removed 1 blobs', self.last_output)
+
+        result = self.dump(data_dir)
+        self.assertNotIn(first, result['versions'])
+        self.assertIn(second, result['versions'])
+        self.assertNotIn(removed, result['blobs'])
+        self.assertIn(self.get_hash('dev:keep.c'), result['blobs'])
+        self.assertIn(self.get_hash('v1.3:tagged.c'), result['blobs'])
+        # Without definitions, snap_one loses the reference of keep.c
+        self.assertNotIn(b'snap_one', result['definitions'])
+        self.assertNotIn(b'snap_one', result['references'])
+        self.assertNotIn(b'snap_one', result['doccomments'])
+
+        # Same content as a database that never had the first snapshot
+        fresh_dir = self.run_update(self.make_data_dir('fresh'), *self.args)
+        fresh = self.dump(fresh_dir)
+        self.assertEqual(sorted(result['blobs']), sorted(fresh['blobs']))
+        self.assertEqual(self.by_blob(result), self.by_blob(fresh))
+        self.assertEqual(self.get_owned(data_dir), self.get_owned(fresh_dir))
+
+class DaemonTest(RepoTestCase):
+    # Returns the lines output by process up to the first one that contains
+    # all of texts
+    def read_until(self, process, *texts):
+        lines = []
+        for line in process.stdout:
+            lines.append(line.decode())
+            if all(text in lines[-1] for text in texts):
+                return lines
+        self.fail('update.py exited: ' + ''.join(lines))
+
+    def test_new_tag(self):
+        data_dir = self.make_data_dir()
+        env = {**os.environ, 'LXR_REPO_DIR': self.repo, 'LXR_DATA_DIR': data_dir}
+        process = subprocess.Popen([sys.executable, 'update.py', '2', '--daemon', '--interval', '0.1'],
+                                   cwd=elixir_dir, env=env, start_new_session=True,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        timer = threading.Timer(120, os.killpg, (process.pid, signal.SIGKILL))
+        timer.start()
+        try:
+            self.read_until(process, 'v1.2: ', 'parsing tasks done')
+            self.commit({'new.c': 'int new_func(void)\n{\n\treturn util_add(1, 1);\n}\n'}, 'v1.3')
+            lines = self.read_until(process, 'v1.3: ', 'parsing tasks done')
+            self.assertIn('updtest - found 1 new tags\n', lines)
+
+            # Stopped by SIGTERM while waiting
+            os.kill(process.pid, signal.SIGTERM)
+            process.communicate()
+            self.assertEqual(process.returncode, 0)
+        finally:
+            timer.cancel()
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+        result = self.dump(data_dir)
+        self.assertIn(b'v1.3', result['versions'])
+        self.assertIn(b'new_func', result['definitions'])
+        self.assertEqual(result, self.dump(self.run_update(self.make_data_dir('fresh'))))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -22,617 +22,1639 @@
 # Throughout, an "idx" is the sequential number associated with a blob.
 # This is different from that blob's Git hash.
 
-from sys import argv
-from threading import Thread, Lock, Event, Condition
+# The main process assigns idxes to the blobs of each new tag, and is the
+# only one that writes to the database. New blobs are parsed by a pool of
+# worker processes, which never open the database and send back compact
+# results.
+
+# Progress is recorded in checkpoints.db: a tag stays there until all its
+# stages are written. An interrupted run can be started again, it removes
+# what was left half done and resumes from the last completed stage.
+
+import argparse
+import json
+import os
+import os.path
+import re
+import resource
+import shutil
+import signal
+import struct
+import threading
+import time
+import tracemalloc
+from bisect import bisect_right
+from collections import deque
+from heapq import heappush, heappop, merge
+from itertools import groupby
+from multiprocessing import Pool
+from queue import SimpleQueue
 
 import elixir.lib as lib
 from elixir.lib import script, scriptLines
 import elixir.data as data
+import elixir.gitpack as gitpack
 from elixir.data import PathList
 from find_compatible_dts import FindCompatibleDTS
 
 verbose = False
-
-dts_comp_support = int(script('dts-comp'))
+incremental = False # Enumerate tags from the tree diff with the previous tag
 
 compatibles_parser = FindCompatibleDTS()
 
-db = data.DB(lib.getDataDir(), readonly=False, shared=True, dtscomp=dts_comp_support)
-
-# Number of cpu threads (+2 for version indexing)
+# Number of worker processes
 cpu = 10
-threads_list = []
-
-hash_file_lock = Lock() # Lock for db.hash and db.file
-blobs_lock = Lock() # Lock for db.blobs
-defs_lock = Lock() # Lock for db.defs
-refs_lock = Lock() # Lock for db.refs
-docs_lock = Lock() # Lock for db.docs
-comps_lock = Lock() # Lock for db.comps
-comps_docs_lock = Lock() # Lock for db.comps_docs
-tag_ready = Condition() # Waiting for new tags
-
-new_idxes = [] # (new idxes, Event idxes ready, Event defs ready, Event comps ready, Event vers ready)
-bindings_idxes = [] # DT bindings documentation files
-idx_key_mod = 1000000
-defs_idxes = {} # Idents definitions stored with (idx*idx_key_mod + line) as the key.
-
-tags_done = False # True if all tags have been added to new_idxes
-
-# Progress variables [tags, finished threads]
-tags_defs = [0, 0]
-tags_defs_lock = Lock()
-tags_refs = [0, 0]
-tags_refs_lock = Lock()
-tags_docs = [0, 0]
-tags_docs_lock = Lock()
-tags_comps = [0, 0]
-tags_comps_lock = Lock()
-tags_comps_docs = [0, 0]
-tags_comps_docs_lock = Lock()
-
-class UpdateIds(Thread):
-    def __init__(self, tag_buf):
-        Thread.__init__(self, name="UpdateIdsElixir")
-        self.tag_buf = tag_buf
-
-    def run(self):
-        global new_idxes, tags_done, tag_ready
-        self.index = 0
-
-        for tag in self.tag_buf:
-
-            new_idxes.append((self.update_blob_ids(tag), Event(), Event(), Event(), Event()))
-
-            progress('ids: ' +  tag.decode() + ': ' + str(len(new_idxes[self.index][0])) +
-                        ' new blobs', self.index+1)
-
-            new_idxes[self.index][1].set() # Tell that the tag is ready
-
-            self.index += 1
-
-            # Wake up waiting threads
-            with tag_ready:
-                tag_ready.notify_all()
-
-        tags_done = True
-        progress('ids: Thread finished', self.index)
 
+# State of the main process, set by main()
+db = None
+dts_comp_support = 0
+project = None
+num_tags = 0
+
+bulk = None # BulkLoad, with --bulk
+metrics = None # Metrics of the run
+blob_index = None # In-memory data.BlobIndex of blobs.db, loaded once per run
+defs_filter = None # In-memory data.IdentFilter of definitions.db, see flush()
+comps_filter = None # Same for compatibledts.db, with DT support
+bindings_idxes = set() # DT bindings documentation files
+# (line, ident) of the definitions of each blob whose references are not
+# parsed yet, as a definition is not counted as a reference. Entries are
+# removed as soon as the references of the blob are parsed, so this only
+# holds blobs of the current tag.
+blob_defs = {}
+
+# Stages of blob parsing. Results of a tag are written in this order, so that
+# references are filtered with the definitions of the same tag, and DT
+# bindings with the compatible strings of the same tag.
+stages = ['defs', 'docs', 'comps', 'refs', 'comps_docs']
+# Stages written once all tags of the run are indexed, see write_late_references()
+deferred_stages = ['late_refs']
+# Stage -> ident -> entries of the current tag, see flush()
+buffers = {stage: {} for stage in stages + deferred_stages}
+
+
+# Calls to script.sh of the current process: count, seconds and bytes of
+# output, see Metrics
+script_stats = [0, 0.0, 0]
+
+def timed_script(*args, input=None):
+    start = time.perf_counter()
+    output = script(*args, input=input)
+    script_stats[0] += 1
+    script_stats[1] += time.perf_counter() - start
+    script_stats[2] += len(output)
+    return output
+
+def timed_script_lines(*args, input=None):
+    lines = timed_script(*args, input=input).split(b'\n')
+    del lines[-1]
+    return lines
+
+read_packs = False # Read blobs from the pack files of the repository, with --read-packs
+pack_reader = None # elixir.gitpack.PackReader of the worker process
+stoplist = frozenset() # Idents whose references are not indexed, see lib.getStopList()
+
+# Initializer of the worker processes. Options are given here rather than
+# inherited from the globals of the main process, which only happens when
+# workers are forked.
+# daemon: workers ignore SIGINT, see ignore_sigint()
+def init_worker(packs, stop, daemon):
+    global read_packs, stoplist
+    read_packs = packs
+    stoplist = stop
+    if daemon:
+        ignore_sigint()
+
+# Returns the blob argument of script.sh for a hash, and the content of the
+# blob to give on its standard input if it could be read from a pack.
+# Otherwise script.sh reads the blob with git itself.
+def read_blob(hash):
+    global pack_reader
+    if not read_packs:
+        return hash, None
+    if pack_reader is None:
+        pack_reader = gitpack.PackReader(lib.getRepoDir())
+
+    content = pack_reader.get_blob(hash)
+    if content is None:
+        return hash, None
+    return b'-', content
+
+# Parsing, done in worker processes.
+# Each function gets the hash, file name and family of a blob.
+
+def parse_defs(hash, filename, family):
+    defs = []
+    blob, content = read_blob(hash)
+    for l in timed_script_lines('parse-defs', blob, filename, family, input=content):
+        ident, type, line = l.split(b' ')
+        defs.append((ident, type.decode(), int(line.decode())))
+    return defs
+
+def parse_refs(hash, filename, family):
+    prefix = b''
+    # Kconfig values are saved as CONFIG_<value>
+    if family == 'K':
+        prefix = b'CONFIG_'
+
+    blob, content = read_blob(hash)
+    tokens = timed_script_lines('tokenize-file', '-b', blob, family, input=content)
+    even = True
+    line_num = 1
+    idents = {}
+    for tok in tokens:
+        even = not even
+        if even:
+            tok = prefix + tok
+
+            # Only idents that can have definitions are candidates. The
+            # main process only writes those that have definitions, see flush().
+            # Idents of the stop list have definitions, but no references.
+            # We only index CONFIG_??? in makefiles
+            if lib.isIdent(tok, stoplist) and (family != 'M' or tok.startswith(b'CONFIG_')):
+                if tok in idents:
+                    idents[tok].append(line_num)
+                else:
+                    idents[tok] = [line_num]
+        else:
+            line_num += tok.count(b'\1')
+    return idents
+
+def parse_docs(hash, filename, family):
+    docs = []
+    blob, content = read_blob(hash)
+    for l in timed_script_lines('parse-docs', blob, filename, input=content):
+        ident, line = l.split(b' ')
+        docs.append((ident, int(line.decode())))
+    return docs
+
+def parse_comps(hash, filename, family):
+    blob, content = read_blob(hash)
+    if content is None:
+        content = timed_script('get-blob', hash)
+    comps = {}
+    for ident, line in compatibles_parser.run(content, family):
+        if ident in comps:
+            comps[ident] += ',' + str(line)
+        else:
+            comps[ident] = str(line)
+    return comps
+
+parsers = {
+    'defs': parse_defs,
+    'refs': parse_refs,
+    'docs': parse_docs,
+    'comps': parse_comps,
+    'comps_docs': parse_comps,
+}
+
+# Returns the result of a parsing task, with the time it took and the
+# script.sh calls it made
+def parse_blob(task):
+    index, stage, idx, hash, filename, family = task
+    start = time.perf_counter()
+    before = list(script_stats)
+    result = parsers[stage](hash, filename, family)
+    stats = (time.perf_counter() - start, *(after - b for after, b in zip(script_stats, before)))
+    return index, stage, idx, family, result, stats
+
+
+# Writing, done in the main process
+
+class UpdateIds:
+    def __init__(self):
+        # In incremental mode, path -> idx of all blobs of the previous tag
+        self.tree = None
+        self.tree_tag = None
+        # (idx, path) of all blobs of the last tag, for UpdateVersions
+        self.tree_buf = None
+
+    # Returns the (idx, hash, filename) of the new blobs of the tag
     def update_blob_ids(self, tag):
 
-        global hash_file_lock, blobs_lock
-
         if db.vars.exists('numBlobs'):
             idx = db.vars.get('numBlobs')
         else:
             idx = 0
 
-        # Get blob hashes and associated file names (without path)
-        blobs = scriptLines('list-blobs', '-f', tag)
+        # Record the first idx of the tag before allocating any, so that an
+        # interrupted run can remove them, see resume_checkpoints()
+        checkpoint = data.Checkpoint()
+        checkpoint.first = idx
+        db.checkpoints.put(tag, checkpoint, sync=True)
+
+        same_tree = False
+        if incremental and self.tree is not None:
+            # Only look at files that changed since the previous tag
+            blobs = timed_script_lines('diff-blobs', self.tree_tag, tag)
+            tree = self.tree
+            same_tree = not blobs
+        else:
+            # Get blob hashes and associated file paths.
+            # This is the only traversal of the tree of the tag: UpdateVersions
+            # gets the paths from tree_buf.
+            blobs = [b'100644 ' + blob for blob in timed_script_lines('list-blobs', '-p', tag)]
+            tree = {}
 
-        new_idxes = []
+        new_blobs = []
         for blob in blobs:
-            hash, filename = blob.split(b' ',maxsplit=1)
-            with blobs_lock:
-                blob_exist = db.blob.exists(hash)
-                if not blob_exist:
-                    db.blob.put(hash, idx)
-
-            if not blob_exist:
-                with hash_file_lock:
-                    db.hash.put(idx, hash)
-                    db.file.put(idx, filename)
-
-                new_idxes.append(idx)
-                if verbose:
-                    print(f"New blob #{idx} {hash}:{filename}")
-                idx += 1
-        db.vars.put('numBlobs', idx)
-        return new_idxes
-
+            mode, hash, path = blob.split(b' ',maxsplit=2)
+            if mode in (b'000000', b'160000'):
+                # Deleted file or submodule
+                tree.pop(path, None)
+                continue
 
-class UpdateVersions(Thread):
-    def __init__(self, tag_buf):
-        Thread.__init__(self, name="UpdateVersionsElixir")
-        self.tag_buf = tag_buf
+            blob_idx = blob_index.get(hash)
 
-    def run(self):
-        global new_idxes, tag_ready
+            if blob_idx is None:
+                blob_idx = idx
+                filename = os.path.basename(path)
+                db.blob.put(hash, idx)
+                db.hash.put(idx, hash)
+                db.file.put(idx, filename)
+                blob_index.add(hash, idx)
 
-        index = 0
+                new_blobs.append((idx, hash, filename.decode()))
+                if verbose:
+                    print(f"New blob #{idx} {hash}:{filename}")
+                idx += 1
 
-        while index < len(self.tag_buf):
-            if index >= len(new_idxes):
-                # Wait for new tags
-                with tag_ready:
-                    tag_ready.wait()
-                continue
+            tree[path] = blob_idx
 
-            tag = self.tag_buf[index]
+        if not same_tree:
+            self.tree_buf = [(blob_idx, path) for path, blob_idx in tree.items()]
+        # Otherwise, the tag has the same tree as the previous one: keep the
+        # same list, UpdateVersions recognizes it and reuses its PathList
 
-            new_idxes[index][1].wait() # Make sure the tag is ready
+        if incremental:
+            self.tree = tree
+            self.tree_tag = tag
 
-            self.update_versions(tag)
+        for table in (db.blob, db.hash, db.file):
+            table.sync()
+        checkpoint.last = idx
+        db.checkpoints.put(tag, checkpoint, sync=True)
 
-            new_idxes[index][4].set() # Tell that UpdateVersions processed the tag
+        db.vars.put('numBlobs', idx, sync=True)
+        return new_blobs
 
-            progress('vers: ' + tag.decode() + ' done', index+1)
+    # Returns the (idx, hash, filename) of the new blobs of a tag whose idxes
+    # were allocated by an interrupted run
+    def resume_blob_ids(self, tag, checkpoint):
+        tree = {}
+        for blob in timed_script_lines('list-blobs', '-p', tag):
+            hash, path = blob.split(b' ',maxsplit=1)
+            tree[path] = blob_index.get(hash)
 
-            index += 1
+        self.tree_buf = [(blob_idx, path) for path, blob_idx in tree.items()]
+        if incremental:
+            self.tree = tree
+            self.tree_tag = tag
 
-        progress('vers: Thread finished', index)
+        return [(idx, db.hash.get(idx), db.file.get(idx))
+                for idx in range(checkpoint.first, checkpoint.last)]
 
-    def update_versions(self, tag):
-        global blobs_lock
 
-        # Get blob hashes and associated file paths
-        blobs = scriptLines('list-blobs', '-p', tag)
-        buf = []
+class UpdateVersions:
+    def __init__(self):
+        self.last_buf = None
+        self.last_obj = None
 
-        for blob in blobs:
-            hash, path = blob.split(b' ', maxsplit=1)
-            with blobs_lock:
-                idx = db.blob.get(hash)
-            buf.append((idx, path))
+    # buf: (idx, path) of all blobs of the tag, computed by UpdateIds
+    def update_versions(self, tag, buf):
+        if buf is self.last_buf:
+            # Same tree as the previous tag
+            if verbose:
+                print(f"Tag {tag}: same files as the previous tag")
+            db.vers.put(tag, self.last_obj, sync=True)
+            return
 
-        buf = sorted(buf)
+        # Keep the list given by UpdateIds, which it gives again for a tag
+        # with the same tree
+        self.last_buf = buf
         obj = PathList()
-        for idx, path in buf:
-            obj.append(idx, path)
+        buf = sorted(buf)
+        obj.extend(buf)
 
+        for idx, path in buf:
             # Store DT bindings documentation files to parse them later
             if path[:33] == b'Documentation/devicetree/bindings':
-                bindings_idxes.append(idx)
+                bindings_idxes.add(idx)
 
             if verbose:
                 print(f"Tag {tag}: adding #{idx} {path}")
         db.vers.put(tag, obj, sync=True)
+        self.last_obj = obj
 
 
+# Rebuilds the definitions caches from the whole definitions database.
+# Only needed for databases created before the caches existed, see
+# 'utils/maintenance.py check-defs-caches' to check them.
 def generate_defs_caches():
-    for key in db.defs.get_keys():
-        value = db.defs.get(key)
-        for family in ['C', 'K', 'D', 'M']:
-            if (lib.compatibleFamily(value.get_families(), family) or
-                        lib.compatibleMacro(value.get_macros(), family)):
-                db.defs_cache[family].put(key, b'')
-
-
-class UpdateDefs(Thread):
-    def __init__(self, start, inc):
-        Thread.__init__(self, name="UpdateDefsElixir")
-        self.index = start
-        self.inc = inc # Equivalent to the number of defs threads
-
-    def run(self):
-        global new_idxes, tags_done, tag_ready, tags_defs, tags_defs_lock
-
-        while not (tags_done and self.index >= len(new_idxes)):
-            if self.index >= len(new_idxes):
-                # Wait for new tags
-                with tag_ready:
-                    tag_ready.wait()
-                continue
-
-            new_idxes[self.index][1].wait() # Make sure the tag is ready
-
-            with tags_defs_lock:
-                tags_defs[0] += 1
-
-            self.update_definitions(new_idxes[self.index][0])
-
-            new_idxes[self.index][2].set() # Tell that UpdateDefs processed the tag
-
-            self.index += self.inc
-
-        with tags_defs_lock:
-            tags_defs[1] += 1
-            progress('defs: Thread ' + str(tags_defs[1]) + '/' + str(self.inc) + ' finished', tags_defs[0])
-
-
-    def update_definitions(self, idxes):
-        global hash_file_lock, defs_lock, tags_defs
-
-        for idx in idxes:
-            if idx % 1000 == 0: progress('defs: ' + str(idx), tags_defs[0])
-
-            with hash_file_lock:
-                hash = db.hash.get(idx)
-                filename = db.file.get(idx)
-
+    for ident, obj in db.defs.iter_items():
+        add_to_defs_caches(ident, obj)
+
+# Adds an ident to the definitions caches of the families of its DefList.
+# Only enough when entries were added to it: put_definitions() also removes
+# the ident from the caches of the families it lost.
+def add_to_defs_caches(ident, obj):
+    for family in obj.get_cache_families():
+        db.defs_cache[family].put(ident, b'')
+
+
+# The update_* functions below only add the results of a blob to the buffer
+# of their stage. Buffers are written to the database by flush() once the
+# whole stage of a tag is parsed, with a single read and write per ident.
+
+def buffer_append(buf, ident, entry):
+    if ident in buf:
+        buf[ident].append(entry)
+    else:
+        buf[ident] = [entry]
+
+def update_definitions(idx, family, defs):
+    blob_defs[idx] = set((line, ident) for ident, type, line in defs)
+
+    for ident, type, line in defs:
+        buffer_append(buffers['defs'], ident, (idx, type, line, family))
+        if verbose:
+            print(f"def {type} {ident} in #{idx} @ {line}")
+
+def update_references(idx, family, idents):
+    defs = blob_defs.pop(idx, ())
+
+    for ident, lines in idents.items():
+        # Do not count a definition as a reference
+        lines = [l for l in lines if (l, ident) not in defs]
+        if not lines:
+            continue
+
+        lines = ','.join(str(l) for l in lines)
+        buffer_append(buffers['refs'], ident, (idx, lines, family))
+        if verbose:
+            print(f"ref: {ident} in #{idx} @ {lines}")
+
+def update_doc_comments(idx, family, docs):
+    for ident, line in docs:
+        buffer_append(buffers['docs'], ident, (idx, str(line), family))
+        if verbose:
+            print(f"doc: {ident} in #{idx} @ {line}")
+
+def update_compatibles(idx, family, comps):
+    for ident, lines in comps.items():
+        buffer_append(buffers['comps'], ident, (idx, lines, family))
+        if verbose:
+            print(f"comps: {ident} in #{idx} @ {lines}")
+
+def update_compatibles_bindings(idx, family, comps):
+    for ident, lines in comps.items():
+        buffer_append(buffers['comps_docs'], ident, (idx, lines, family))
+        if verbose:
+            print(f"comps_docs: {ident} in #{idx} @ {lines}")
+
+writers = {
+    'defs': update_definitions,
+    'refs': update_references,
+    'docs': update_doc_comments,
+    'comps': update_compatibles,
+    'comps_docs': update_compatibles_bindings,
+}
+
+def flush_definitions(buf):
+    for ident in sorted(buf):
+        if db.defs.exists(ident):
+            obj = db.defs.get(ident)
+        elif lib.isIdent(ident):
+            obj = data.DefList()
+        else:
+            continue
+
+        obj.extend(buf[ident])
+        db.defs.put(ident, obj)
+        add_to_defs_caches(ident, obj)
+        if defs_filter is not None:
+            defs_filter.add(ident)
+
+# known: if set, only idents that exist in this table are kept
+def flush_reflists(table, buf, known=None):
+    idents = [ident for ident in sorted(buf) if known is None or known.exists(ident)]
+    if table.idents is not None:
+        # The IDs of new idents are saved first, so that no entry is written
+        # under an ID that an interruption would lose
+        for ident in idents:
+            table.idents.add(ident)
+        table.idents.sync()
+
+    for ident in idents:
+        table.extend(ident, buf[ident])
+
+# Database tables written by a stage
+def get_stage_tables(stage):
+    if stage == 'defs':
+        return [db.defs, *db.defs_cache.values()]
+    elif stage == 'late_refs':
+        return [db.refs]
+    return [getattr(db, stage)]
+
+def flush(stage):
+    buf = buffers[stage]
+    if not buf:
+        return
+    elif stage == 'defs':
+        flush_definitions(buf)
+    elif stage == 'refs':
+        # Only keep references to idents that have definitions. Most
+        # candidates have none, which the filter tells without a lookup.
+        flush_reflists(db.refs, buf, defs_filter or db.defs)
+    elif stage == 'docs':
+        flush_reflists(db.docs, buf)
+    elif stage == 'comps':
+        flush_reflists(db.comps, buf)
+        if comps_filter is not None:
+            for ident in buf:
+                comps_filter.add(ident)
+    elif stage == 'comps_docs':
+        # Only keep strings that are compatibles found in code or devicetrees.
+        # Most words of bindings documentation are not.
+        flush_reflists(db.comps_docs, buf, comps_filter or db.comps)
+    elif stage == 'late_refs':
+        flush_reflists(db.refs, buf)
+    buf.clear()
+
+# Work scheduling
+#
+# Each new tag first goes through UpdateIds and UpdateVersions in the main
+# process, which then queues one parsing task per new blob and stage.
+# Parsing only depends on blob idxes, so tasks of several tags are queued at
+# once and workers take them in (tag, stage, idx) order, whatever the stage.
+# A stage of a tag is written once all its blobs are parsed and all previous
+# stages and tags are written. This keeps the dependencies between stages
+# (defs -> refs, comps -> comps_docs), and the result does not depend on the
+# number of workers or the order in which tasks complete.
+
+# Maximum number of tags being parsed at the same time
+max_tags_in_flight = 16
+
+class TagTasks:
+    '''Parsing state of a tag'''
+    def __init__(self, index, tag, tasks, checkpoint):
+        self.index = index
+        self.tag = tag
+        self.checkpoint = checkpoint
+        self.num_tasks = len(tasks)
+        self.remaining = {stage: 0 for stage in stages} # Tasks not parsed yet
+        for task in tasks:
+            self.remaining[task[1]] += 1
+        self.results = {stage: [] for stage in stages}
+        self.next_stage = 0 # Index in stages of the next stage to write
+
+# Returns the parsing tasks of new blobs of a tag.
+# done: stages already written by an interrupted run
+def get_tasks(index, new_blobs, done):
+    tasks = []
+    for stage in stages:
+        if stage in ('comps', 'comps_docs') and not dts_comp_support:
+            continue
+        # Definitions are still needed to write references, see blob_defs
+        if stage in done and not (stage == 'defs' and 'refs' not in done):
+            continue
+
+        for idx, hash, filename in new_blobs:
             family = lib.getFileFamily(filename)
-            if family in [None, 'M']: continue
-
-            lines = scriptLines('parse-defs', hash, filename, family)
-
-            with defs_lock:
-                for l in lines:
-                    ident, type, line = l.split(b' ')
-                    type = type.decode()
-                    line = int(line.decode())
-
-                    defs_idxes[idx*idx_key_mod + line] = ident
-
-                    if db.defs.exists(ident):
-                        obj = db.defs.get(ident)
-                    elif lib.isIdent(ident):
-                        obj = data.DefList()
-                    else:
-                        continue
-
-                    obj.append(idx, type, line, family)
-                    if verbose:
-                        print(f"def {type} {ident} in #{idx} @ {line}")
-                    db.defs.put(ident, obj)
-
-        generate_defs_caches()
-
 
-class UpdateRefs(Thread):
-    def __init__(self, start, inc):
-        Thread.__init__(self, name="UpdateRefsElixir")
-        self.index = start
-        self.inc = inc # Equivalent to the number of refs threads
-
-    def run(self):
-        global new_idxes, tags_done, tags_refs, tags_refs_lock
-
-        while not (tags_done and self.index >= len(new_idxes)):
-            if self.index >= len(new_idxes):
-                # Wait for new tags
-                with tag_ready:
-                    tag_ready.wait()
+            if stage == 'comps_docs':
+                # Parse only bindings doc files
+                if not idx in bindings_idxes:
+                    continue
+                family = 'B'
+            elif family is None:
                 continue
-
-            new_idxes[self.index][1].wait() # Make sure the tag is ready
-            new_idxes[self.index][2].wait() # Make sure UpdateDefs processed the tag
-
-            with tags_refs_lock:
-                tags_refs[0] += 1
-
-            self.update_references(new_idxes[self.index][0])
-
-            self.index += self.inc
-
-        with tags_refs_lock:
-            tags_refs[1] += 1
-            progress('refs: Thread ' + str(tags_refs[1]) + '/' + str(self.inc) + ' finished', tags_refs[0])
-
-    def update_references(self, idxes):
-        global hash_file_lock, defs_lock, refs_lock, tags_refs
-
-        for idx in idxes:
-            if idx % 1000 == 0: progress('refs: ' + str(idx), tags_refs[0])
-
-            with hash_file_lock:
-                hash = db.hash.get(idx)
-                filename = db.file.get(idx)
-
-            family = lib.getFileFamily(filename)
-            if family == None: continue
-
-            prefix = b''
-            # Kconfig values are saved as CONFIG_<value>
-            if family == 'K':
-                prefix = b'CONFIG_'
-
-            tokens = scriptLines('tokenize-file', '-b', hash, family)
-            even = True
-            line_num = 1
-            idents = {}
-            with defs_lock:
-                for tok in tokens:
-                    even = not even
-                    if even:
-                        tok = prefix + tok
-
-                        if (db.defs.exists(tok) and
-                            not ( (idx*idx_key_mod + line_num) in defs_idxes and
-                                defs_idxes[idx*idx_key_mod + line_num] == tok ) and
-                            (family != 'M' or tok.startswith(b'CONFIG_'))):
-                            # We only index CONFIG_??? in makefiles
-                            if tok in idents:
-                                idents[tok] += ',' + str(line_num)
-                            else:
-                                idents[tok] = str(line_num)
-
-                    else:
-                        line_num += tok.count(b'\1')
-
-            with refs_lock:
-                for ident, lines in idents.items():
-                    if db.refs.exists(ident):
-                        obj = db.refs.get(ident)
-                    else:
-                        obj = data.RefList()
-
-                    obj.append(idx, lines, family)
-                    if verbose:
-                        print(f"ref: {ident} in #{idx} @ {lines}")
-                    db.refs.put(ident, obj)
-
-
-class UpdateDocs(Thread):
-    def __init__(self, start, inc):
-        Thread.__init__(self, name="UpdateDocsElixir")
-        self.index = start
-        self.inc = inc # Equivalent to the number of docs threads
-
-    def run(self):
-        global new_idxes, tags_done, tags_docs, tags_docs_lock
-
-        while not (tags_done and self.index >= len(new_idxes)):
-            if self.index >= len(new_idxes):
-                # Wait for new tags
-                with tag_ready:
-                    tag_ready.wait()
+            elif stage in ('defs', 'docs') and family == 'M':
                 continue
-
-            new_idxes[self.index][1].wait() # Make sure the tag is ready
-
-            with tags_docs_lock:
-                tags_docs[0] += 1
-
-            self.update_doc_comments(new_idxes[self.index][0])
-
-            self.index += self.inc
-
-        with tags_docs_lock:
-            tags_docs[1] += 1
-            progress('docs: Thread ' + str(tags_docs[1]) + '/' + str(self.inc) + ' finished', tags_docs[0])
-
-    def update_doc_comments(self, idxes):
-        global hash_file_lock, docs_lock, tags_docs
-
-        for idx in idxes:
-            if idx % 1000 == 0: progress('docs: ' + str(idx), tags_docs[0])
-
-            with hash_file_lock:
-                hash = db.hash.get(idx)
-                filename = db.file.get(idx)
-
-            family = lib.getFileFamily(filename)
-            if family in [None, 'M']: continue
-
-            lines = scriptLines('parse-docs', hash, filename)
-            with docs_lock:
-                for l in lines:
-                    ident, line = l.split(b' ')
-                    line = int(line.decode())
-
-                    if db.docs.exists(ident):
-                        obj = db.docs.get(ident)
-                    else:
-                        obj = data.RefList()
-
-                    obj.append(idx, str(line), family)
-                    if verbose:
-                        print(f"doc: {ident} in #{idx} @ {line}")
-                    db.docs.put(ident, obj)
-
-
-class UpdateComps(Thread):
-    def __init__(self, start, inc):
-        Thread.__init__(self, name="UpdateCompsElixir")
-        self.index = start
-        self.inc = inc # Equivalent to the number of comps threads
-
-    def run(self):
-        global new_idxes, tags_done, tags_comps, tags_comps_lock
-
-        while not (tags_done and self.index >= len(new_idxes)):
-            if self.index >= len(new_idxes):
-                # Wait for new tags
-                with tag_ready:
-                    tag_ready.wait()
+            elif stage == 'comps' and family in ('K', 'M'):
                 continue
 
-            new_idxes[self.index][1].wait() # Make sure the tag is ready
-
-            with tags_comps_lock:
-                tags_comps[0] += 1
-
-            self.update_compatibles(new_idxes[self.index][0])
-
-            new_idxes[self.index][3].set() # Tell that UpdateComps processed the tag
-
-            self.index += self.inc
-
-        with tags_comps_lock:
-            tags_comps[1] += 1
-            progress('comps: Thread ' + str(tags_comps[1]) + '/' + str(self.inc) + ' finished', tags_comps[0])
-
-    def update_compatibles(self, idxes):
-        global hash_file_lock, comps_lock, tags_comps
-
-        for idx in idxes:
-            if idx % 1000 == 0: progress('comps: ' + str(idx), tags_comps[0])
-
-            with hash_file_lock:
-                hash = db.hash.get(idx)
-                filename = db.file.get(idx)
-
-            family = lib.getFileFamily(filename)
-            if family in [None, 'K', 'M']: continue
-
-            lines = compatibles_parser.run(scriptLines('get-blob', hash), family)
-            comps = {}
-            for l in lines:
-                ident, line = l.split(' ')
-
-                if ident in comps:
-                    comps[ident] += ',' + str(line)
-                else:
-                    comps[ident] = str(line)
-
-            with comps_lock:
-                for ident, lines in comps.items():
-                    if db.comps.exists(ident):
-                        obj = db.comps.get(ident)
-                    else:
-                        obj = data.RefList()
-
-                    obj.append(idx, lines, family)
-                    if verbose:
-                        print(f"comps: {ident} in #{idx} @ {line}")
-                    db.comps.put(ident, obj)
-
-
-class UpdateCompsDocs(Thread):
-    def __init__(self, start, inc):
-        Thread.__init__(self, name="UpdateCompsDocsElixir")
-        self.index = start
-        self.inc = inc # Equivalent to the number of comps_docs threads
-
-    def run(self):
-        global new_idxes, tags_done, tags_comps_docs, tags_comps_docs_lock
-
-        while not (tags_done and self.index >= len(new_idxes)):
-            if self.index >= len(new_idxes):
-                # Wait for new tags
-                with tag_ready:
-                    tag_ready.wait()
+            tasks.append((index, stage, idx, hash, filename, family))
+    return tasks
+
+# Writes the stages of the oldest tags whose blobs are all parsed.
+# deferred: list where to add the (tag, checkpoint) of tags that still have
+# deferred stages to write
+def write_tags(in_flight, deferred):
+    while in_flight:
+        tag_tasks = in_flight[0]
+
+        while tag_tasks.next_stage < len(stages):
+            stage = stages[tag_tasks.next_stage]
+            if tag_tasks.remaining[stage]:
+                return
+
+            for idx, family, result in sorted(tag_tasks.results[stage], key=lambda r: r[0]):
+                if idx % 1000 == 0: progress(stage + ': ' + str(idx), tag_tasks.index)
+                writers[stage](idx, family, result)
+            tag_tasks.results[stage] = None
+
+            if stage in tag_tasks.checkpoint.done:
+                buffers[stage].clear()
+            elif bulk is not None:
+                bulk.add(stage, buffers[stage])
+                buffers[stage].clear()
+            else:
+                write_stage(tag_tasks.tag, tag_tasks.checkpoint, stage)
+            tag_tasks.next_stage += 1
+
+        checkpoint = tag_tasks.checkpoint
+        if bulk is not None:
+            # With --bulk, checkpoints are kept until the tables are written
+            pass
+        elif any(stage not in checkpoint.done for stage in checkpoint.deferred):
+            deferred.append((tag_tasks.tag, checkpoint))
+        else:
+            db.checkpoints.delete(tag_tasks.tag)
+            db.checkpoints.sync()
+        blob_defs.clear()
+        in_flight.popleft()
+
+        progress(tag_tasks.tag.decode() + ': ' + str(tag_tasks.num_tasks) + ' parsing tasks done, peak RSS ' +
+                    str(get_peak_rss() // 1024) + ' MiB', tag_tasks.index)
+        metrics.add_tag(tag_tasks.tag, tag_tasks.num_tasks)
+
+# Writes the buffer of a stage of a tag. The idents about to change are
+# recorded in the checkpoint of the tag first, and the stage is marked as
+# done once the tables are synced.
+def write_stage(tag, checkpoint, stage):
+    if buffers[stage]:
+        start = time.perf_counter()
+        num_idents = len(buffers[stage])
+        checkpoint.writing = stage
+        checkpoint.idents = [lib.autoBytes(ident) for ident in sorted(buffers[stage])]
+        db.checkpoints.put(tag, checkpoint, sync=True)
+
+        flush(stage)
+        for table in get_stage_tables(stage):
+            table.sync()
+        metrics.add_write(stage, num_idents, time.perf_counter() - start)
+
+    checkpoint.done.append(stage)
+    checkpoint.writing = None
+    checkpoint.idents = []
+    db.checkpoints.put(tag, checkpoint, sync=True)
+
+# Removes what an interrupted run left half done: the idxes being allocated
+# for a tag, and the entries of a stage being written. Tags with a checkpoint
+# are then indexed again by update_tags(), without the stages already written.
+def resume_checkpoints():
+    if db.vars.exists('numBlobs'):
+        num_blobs = db.vars.get('numBlobs')
+    else:
+        num_blobs = 0
+
+    for tag, checkpoint in list(db.checkpoints.iter_items()):
+        print(project + ' - resuming ' + tag.decode())
+
+        if checkpoint.last is None:
+            remove_blobs(checkpoint.first)
+            num_blobs = max(num_blobs, checkpoint.first)
+            db.checkpoints.delete(tag)
+            continue
+
+        num_blobs = max(num_blobs, checkpoint.last)
+        if checkpoint.writing is not None:
+            rollback_stage(checkpoint)
+            checkpoint.writing = None
+            checkpoint.idents = []
+            db.checkpoints.put(tag, checkpoint)
+
+    if db.idents is not None:
+        db.idents.restore_names()
+    for table in (db.blob, db.hash, db.file, *get_stage_tables('defs'), db.refs, db.docs):
+        table.sync()
+    if dts_comp_support:
+        db.comps.sync()
+        db.comps_docs.sync()
+    db.checkpoints.sync()
+    db.vars.put('numBlobs', num_blobs, sync=True)
+
+# Removes blobs from the idx first
+def remove_blobs(first):
+    for hash, idx in list(db.blob.iter_items()):
+        if idx >= first:
+            db.blob.delete(hash)
+
+    for table in (db.hash, db.file):
+        for idx in table.get_keys():
+            if int(idx) >= first:
+                table.delete(idx)
+
+# Removes the entries of a tag from the idents of the stage being written
+def rollback_stage(checkpoint):
+    stage = checkpoint.writing
+    for ident in checkpoint.idents:
+        if stage == 'late_refs':
+            # Entries of the tag were added among those of other tags
+            obj = db.refs.get(ident)
+            if obj is None:
+                continue
+            obj.filter(lambda idx: not checkpoint.first <= idx < checkpoint.last)
+            put_reflist(db.refs, ident, obj)
+            continue
+
+        if stage != 'defs':
+            get_stage_tables(stage)[0].truncate(ident, checkpoint.first)
+            continue
+
+        obj = db.defs.get(ident)
+        if obj is None:
+            continue
+
+        obj.truncate(checkpoint.first)
+        put_definitions(ident, obj)
+
+# Writes the definitions of an ident some entries were removed from, and
+# updates its definitions caches
+def put_definitions(ident, obj):
+    if obj.data:
+        db.defs.put(ident, obj)
+        families = obj.get_cache_families()
+    else:
+        db.defs.delete(ident)
+        families = []
+
+    for family, cache in db.defs_cache.items():
+        if family in families:
+            cache.put(ident, b'')
+        elif cache.exists(ident):
+            cache.delete(ident)
+
+# Writes the RefList of an ident some entries were removed from
+def put_reflist(table, ident, obj):
+    if obj.data:
+        table.put(ident, obj)
+    else:
+        table.delete(ident)
+
+# References of a tag indexed before older tags miss the idents that only
+# these older tags define, as flush() only keeps references to idents that
+# have definitions. Once all tags are indexed, the references of such tags
+# are parsed again, and those to idents whose first definition was written
+# after the tag are added.
+# Older tags are not filtered the other way round: their blobs keep the
+# references to idents that only the newer tags define, which indexing
+# oldest first drops. --newest-first indexes these additional references.
+def write_late_references(pool, deferred):
+    first_defs = {} # Ident -> smallest idx of its definitions
+
+    for tag, checkpoint in deferred:
+        new_blobs = [(idx, db.hash.get(idx), db.file.get(idx))
+                     for idx in range(checkpoint.first, checkpoint.last)]
+        tasks = [task for task in get_tasks(0, new_blobs, []) if task[1] == 'refs']
+        chunksize = max(1, min(16, len(tasks) // (4*cpu)))
+
+        buf = buffers['late_refs']
+        for _, _, idx, family, idents, stats in pool.imap(parse_blob, tasks, chunksize):
+            metrics.add_task('late_refs', stats)
+            for ident, lines in idents.items():
+                if ident not in first_defs:
+                    obj = db.defs.get(ident)
+                    first_defs[ident] = min((id for id, *_ in obj.iter()), default=None) if obj else None
+
+                # The blob does not define the ident, as it is older than
+                # all its definitions
+                first = first_defs[ident]
+                if first is not None and first >= checkpoint.last:
+                    buffer_append(buf, ident, (idx, ','.join(str(l) for l in lines), family))
+
+        print(project + ' - late refs: ' + tag.decode() + ': ' + str(len(buf)) + ' idents')
+        write_stage(tag, checkpoint, 'late_refs')
+        db.checkpoints.delete(tag)
+        db.checkpoints.sync()
+
+# ahead: tags indexed before older tags, which get the 'late_refs' stage
+# ids, vers: UpdateIds and UpdateVersions kept from a previous call, see
+# run_daemon()
+def update_tags(pool, tag_buf, ahead=(), ids=None, vers=None):
+    if ids is None:
+        ids = UpdateIds()
+    if vers is None:
+        vers = UpdateVersions()
+    deferred = [] # (tag, checkpoint) of tags whose deferred stages are not written
+
+    in_flight = deque() # TagTasks of tags being parsed, oldest first
+    queued = [] # Heap of tasks not sent to workers yet
+    results = SimpleQueue() # Results sent back by workers
+    running = 0 # Tasks sent to workers whose result was not received yet
+    next_tag = 0
+
+    while (next_tag < len(tag_buf) and not stop_requested.is_set()) or in_flight:
+        # Prepare the next tags when workers are about to run out of tasks
+        while (next_tag < len(tag_buf) and len(in_flight) < max_tags_in_flight and
+                len(queued) < 2*cpu and not stop_requested.is_set()):
+            tag = tag_buf[next_tag]
+            next_tag += 1
+
+            start = time.perf_counter()
+            checkpoint = db.checkpoints.get(tag)
+            if checkpoint is not None:
+                new_blobs = ids.resume_blob_ids(tag, checkpoint)
+            else:
+                new_blobs = ids.update_blob_ids(tag)
+                checkpoint = db.checkpoints.get(tag)
+                if tag in ahead:
+                    checkpoint.deferred = ['late_refs']
+                    db.checkpoints.put(tag, checkpoint, sync=True)
+            progress('ids: ' + tag.decode() + ': ' + str(len(new_blobs)) + ' new blobs', next_tag)
+
+            vers.update_versions(tag, ids.tree_buf)
+            progress('vers: ' + tag.decode() + ' done', next_tag)
+            metrics.add_ids(len(new_blobs), time.perf_counter() - start)
+
+            if bulk is not None:
+                bulk.add_tag(checkpoint)
+
+            tasks = get_tasks(next_tag, new_blobs, checkpoint.done)
+            in_flight.append(TagTasks(next_tag, tag, tasks, checkpoint))
+            for task in tasks:
+                index, stage, idx = task[:3]
+                heappush(queued, (index, stages.index(stage), idx, task))
+
+        # Keep a few tasks per worker in the pool, so that tasks are still
+        # taken in priority order
+        while queued and running < 2*cpu:
+            task = heappop(queued)[3]
+            pool.apply_async(parse_blob, (task,), callback=results.put, error_callback=results.put)
+            running += 1
+
+        write_tags(in_flight, deferred)
+
+        if running:
+            start = time.perf_counter()
+            result = results.get()
+            metrics.wait_seconds += time.perf_counter() - start
+            running -= 1
+            if isinstance(result, BaseException):
+                raise result
+
+            index, stage, idx, family, result, stats = result
+            metrics.add_task(stage, stats)
+            tag_tasks = in_flight[index - in_flight[0].index]
+            tag_tasks.results[stage].append((idx, family, result))
+            tag_tasks.remaining[stage] -= 1
+
+    write_late_references(pool, deferred)
+
+
+# Bulk loading
+#
+# With --bulk, an empty database is not written tag by tag. The buffers of
+# each stage are added to in-memory runs, which are written to run files
+# sorted by ident when they get large. Once all tags are parsed, the runs of
+# each table are merged, and the table is written in key order in a single
+# pass, which Berkeley DB packs densely. Each table only needs one record
+# per run in memory during the merge.
+#
+# References and DT bindings are filtered like flush() does: they are only
+# kept from the tag where their ident got its first definition, or
+# compatible string, on.
+
+class BulkLoad:
+    run_size = 64*1024*1024 # Bytes of entries of a stage kept in memory
+
+    def __init__(self, dir):
+        self.dir = dir
+        shutil.rmtree(dir, ignore_errors=True)
+        os.mkdir(dir)
+
+        self.tag_firsts = [] # First idx of the new blobs of each tag
+        self.runs = {stage: {} for stage in stages} # Ident -> [(first idx, entries)]
+        self.run_bytes = {stage: 0 for stage in stages}
+        self.run_files = {stage: [] for stage in stages}
+
+    def add_tag(self, checkpoint):
+        self.tag_firsts.append(checkpoint.first)
+
+    # Returns the index of the tag of a blob
+    def get_tag(self, idx):
+        return bisect_right(self.tag_firsts, idx) - 1
+
+    # Adds the buffer of a stage of a tag
+    def add(self, stage, buf):
+        run = self.runs[stage]
+        for ident, entries in buf.items():
+            obj = data.DefList() if stage == 'defs' else data.RefList()
+            obj.extend(entries)
+            obj = obj.pack()
+            buffer_append(run, lib.autoBytes(ident), (entries[0][0], obj))
+            self.run_bytes[stage] += len(ident) + len(obj)
+
+        if self.run_bytes[stage] > self.run_size:
+            self.write_run(stage)
+
+    def write_run(self, stage):
+        run = self.runs[stage]
+        path = os.path.join(self.dir, stage + '.' + str(len(self.run_files[stage])))
+        with open(path, 'wb') as f:
+            for ident in sorted(run):
+                for first, obj in run[ident]:
+                    f.write(struct.pack('>III', len(ident), first, len(obj)) + ident + obj)
+
+        self.run_files[stage].append(path)
+        run.clear()
+        self.run_bytes[stage] = 0
+
+    @staticmethod
+    def read_run(path):
+        with open(path, 'rb', buffering=1024*1024) as f:
+            while True:
+                header = f.read(12)
+                if not header:
+                    break
+                ident_len, first, obj_len = struct.unpack('>III', header)
+                yield f.read(ident_len), first, f.read(obj_len)
+
+    # Yields (ident, [(first idx, entries)]) of a stage, in ident order,
+    # with the entries of each ident in idx order
+    def iter_stage(self, stage):
+        run = self.runs[stage]
+        runs = [self.read_run(path) for path in self.run_files[stage]]
+        runs.append((ident, first, obj) for ident in sorted(run) for first, obj in run[ident])
+
+        # Equal idents are taken from the oldest run first
+        for ident, records in groupby(merge(*runs, key=lambda r: r[0]), key=lambda r: r[0]):
+            yield ident, [(first, obj) for _, first, obj in records]
+
+    def write(self):
+        self.write_tables('defs', 'refs')
+        self.write_tables('docs')
+        self.write_tables('comps', 'comps_docs')
+        shutil.rmtree(self.dir)
+
+    # Writes the table of a stage, and the table of the stage filtered with
+    # it, walking both in ident order
+    def write_tables(self, stage, filtered=None):
+        if stage in ('comps', 'comps_docs') and not dts_comp_support:
+            return
+        print(project + ' - bulk: writing ' + stage + (' and ' + filtered if filtered else ''))
+
+        others = self.iter_stage(filtered) if filtered else iter(())
+        other = next(others, None)
+        for ident, objs in self.iter_stage(stage):
+            if not self.write_value(stage, ident, objs):
                 continue
 
-            new_idxes[self.index][1].wait() # Make sure the tag is ready
-            new_idxes[self.index][3].wait() # Make sure UpdateComps processed the tag
-            new_idxes[self.index][4].wait() # Make sure UpdateVersions processed the tag
-
-            with tags_comps_docs_lock:
-                tags_comps_docs[0] += 1
-
-            self.update_compatibles_bindings(new_idxes[self.index][0])
+            while other is not None and other[0] < ident:
+                other = next(others, None)
+            if other is not None and other[0] == ident:
+                first_tag = self.get_tag(objs[0][0])
+                self.write_value(filtered, ident,
+                    [(first, obj) for first, obj in other[1] if self.get_tag(first) >= first_tag])
+
+        if db.idents is not None:
+            db.idents.sync()
+        for table in get_stage_tables(stage) + (get_stage_tables(filtered) if filtered else []):
+            table.sync()
+
+    # Returns False if the ident is not kept
+    def write_value(self, stage, ident, objs):
+        if not objs:
+            return False
+
+        if stage != 'defs':
+            get_stage_tables(stage)[0].put(ident, b''.join(obj for _, obj in objs))
+            return True
+
+        if not lib.isIdent(ident):
+            return False
+
+        obj = data.DefList()
+        parts = []
+        for _, value in objs:
+            part, families = value.split(b'#')
+            if part:
+                parts.append(part)
+            for family in families.decode().split(','):
+                if family:
+                    obj.add_family(family)
+        obj.data = b','.join(parts)
+
+        db.defs.put(ident, obj)
+        add_to_defs_caches(ident, obj)
+        return True
+
+# Starts a bulk load if no tag is completely indexed
+def start_bulk_load(data_dir):
+    global bulk
+
+    for tag in db.vers.get_keys():
+        if not db.checkpoints.exists(tag):
+            print(project + ' - the database is not empty, not using bulk mode')
+            return
+
+    # Tags interrupted in the middle of a previous run, bulk or not, are
+    # parsed again from scratch
+    db.vars.put('bulkLoad', 1, sync=True)
+    for stage in stages:
+        if stage in ('comps', 'comps_docs') and not dts_comp_support:
+            continue
+        for table in get_stage_tables(stage):
+            for key in table.db.keys():
+                table.db.delete(key)
+            table.sync()
+    if db.idents is not None:
+        db.idents.clear()
+
+    for tag, checkpoint in list(db.checkpoints.iter_items()):
+        checkpoint.done = []
+        checkpoint.deferred = []
+        db.checkpoints.put(tag, checkpoint)
+    db.checkpoints.sync()
+
+    bulk = BulkLoad(os.path.join(data_dir, 'bulk'))
+
+def finish_bulk_load():
+    global bulk, defs_filter, comps_filter
+    bulk.write()
+
+    for tag in db.checkpoints.get_keys():
+        db.checkpoints.delete(tag)
+    db.checkpoints.sync()
+    db.vars.delete('bulkLoad')
+    db.vars.sync()
+    bulk = None
+    # Bulk writes do not go through flush()
+    defs_filter = comps_filter = None
+
+
+# Shadow builds
+#
+# With --shadow, the data directory is a symbolic link to a generation
+# directory next to it, for example data -> data.3. The next generation is
+# built in data.4.build, seeded with a copy of data.3, while the web
+# interface keeps reading data.3. Once complete, it is renamed to data.4 and
+# the link is replaced atomically. Query resolves the link when it opens the
+# database, so each request reads a single generation. The previous
+# generation is kept for rollback, older ones are removed.
+
+# Returns the sorted numbers of the generations of a data directory
+def get_generations(data_dir):
+    parent, name = os.path.split(data_dir)
+    gens = []
+    for entry in os.listdir(parent):
+        num = entry[len(name)+1:]
+        if entry.startswith(name + '.') and num.isdigit():
+            gens.append(int(num))
+    return sorted(gens)
+
+# Returns the directory where to build the next generation, or None if there
+# is nothing new to index
+# refs: refs of --ref, whose new commits also need a new generation
+def start_shadow_build(data_dir, refs=()):
+    if not os.path.islink(data_dir):
+        # First shadow build: the current directory becomes generation 0.
+        # It is missing for a moment, until the link is created.
+        os.rename(data_dir, data_dir + '.0')
+        os.symlink(os.path.basename(data_dir) + '.0', data_dir)
+
+    current = os.path.realpath(data_dir)
+    build_dir = f'{data_dir}.{get_generations(data_dir)[-1] + 1}.build'
+    if os.path.isdir(build_dir):
+        # Left by an interrupted run, resume it
+        return build_dir
+
+    if os.path.exists(current + '/versions.db'):
+        live = data.DB(current, readonly=True, dtscomp=dts_comp_support)
+        new_tags = [tag for tag in scriptLines('list-tags') if not live.vers.exists(tag)]
+        new_snapshots = [name for name in map(get_snapshot_name, refs)
+                         if name is not None and not live.vers.exists(name)]
+        live.close()
+
+        interrupted = False
+        if os.path.exists(current + '/checkpoints.db'):
+            checkpoints = data.BsdDB(current + '/checkpoints.db', True, data.Checkpoint)
+            interrupted = len(checkpoints) > 0
+            checkpoints.close()
+
+        if not new_tags and not new_snapshots and not interrupted:
+            return None
+
+    # Copy to a temporary directory first, so that an interrupted copy is
+    # never taken for an interrupted build
+    shutil.rmtree(build_dir + '.tmp', ignore_errors=True)
+    shutil.copytree(current, build_dir + '.tmp')
+    os.rename(build_dir + '.tmp', build_dir)
+    return build_dir
+
+# Makes a complete build the current generation
+def finish_shadow_build(data_dir, build_dir):
+    previous = os.path.realpath(data_dir)
+    new_dir = build_dir[:-len('.build')]
+    os.rename(build_dir, new_dir)
+
+    link = data_dir + '.link'
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(os.path.basename(new_dir), link)
+    os.replace(link, data_dir)
+    print(project + ' - switched to ' + os.path.basename(new_dir))
+
+    for gen in get_generations(data_dir):
+        gen_dir = f'{data_dir}.{gen}'
+        if gen_dir not in (previous, new_dir):
+            shutil.rmtree(gen_dir)
+
+
+# Increments the generation variable, which tells the web interface that the
+# list of tags changed
+def bump_generation():
+    generation = db.vars.get('generation') if db.vars.exists('generation') else 0
+    db.vars.put('generation', generation + 1, sync=True)
+
+# Returns the tags of the repository that are not in the indexed set, or
+# were not completely indexed, oldest first
+def get_new_tags(indexed):
+    return [tag for tag in scriptLines('list-tags')
+            if tag not in indexed or db.checkpoints.exists(tag)]
+
+# Loads the definitions and compatibles filters once per run, and again
+# once the idents added since outgrow them. Idents removed since (rollbacks,
+# expired snapshots) are only false positives, which flush() looks up.
+def load_filters():
+    global defs_filter, comps_filter
+    if bulk is not None:
+        return
+    if defs_filter is None or defs_filter.is_full():
+        defs_filter = data.IdentFilter(db.defs)
+    if dts_comp_support and (comps_filter is None or comps_filter.is_full()):
+        comps_filter = data.IdentFilter(db.comps)
+
+# Indexes tag_buf, listed oldest first. Returns True if there were tags.
+def index_tags(pool, build_dir, tag_buf, args, ids=None, vers=None):
+    global num_tags, blob_index
+
+    ahead = ()
+    if args.newest_first > 0:
+        # Tags are listed oldest first. Idxes are allocated in indexing
+        # order whatever it is, and the query layer sorts entries by idx.
+        newest = tag_buf[-args.newest_first:]
+        older = tag_buf[:-len(newest)]
+        tag_buf = newest[::-1] + older
+        ahead = set(newest if older else newest[1:])
+
+    num_tags = len(tag_buf)
+
+    print(project + ' - found ' + str(num_tags) + ' new tags')
+    if not num_tags:
+        return False
+
+    if args.bulk or db.vars.exists('bulkLoad'):
+        # An interrupted bulk load has to be finished in bulk mode
+        start_bulk_load(build_dir)
+
+    if blob_index is None:
+        blob_index = data.BlobIndex(db.blob)
+    load_filters()
+    add_snapshot_tags(tag_buf)
+    update_tags(pool, tag_buf, ahead, ids, vers)
+    if bulk is not None:
+        finish_bulk_load()
+
+    bump_generation()
+    return True
+
+
+# Snapshots
+#
+# With --ref, branches or commits are indexed after the new tags, as
+# versions named <ref>:<full commit hash>, for example
+# master:1a2b3c4d5e6f7a8b9c0d1e2f3a4b5c6d7e8f9a0b. They share blob idxes
+# with tags, so only the blobs that changed since the previous snapshot or
+# tag are parsed. A new snapshot is taken each time a ref points
+# to another commit, and only the --keep-snapshots newest snapshots of each
+# ref are kept. Older ones expire and are removed with the blobs that no
+# other version contains.
+#
+# Such blobs were all allocated by a snapshot, and may only be contained by
+# later snapshots or tags. Each snapshot keeps track of them ("owned"), and
+# of the tags indexed after it. When a snapshot expires, the blobs it owns
+# that a remaining snapshot contains are handed to it, those that one of
+# these tags contains are kept for good, and the others are removed. Their
+# entries are found by parsing them again, like write_late_references()
+# does, instead of going through whole tables.
+
+# Returns the name of the snapshot of the current commit of a ref, or None
+# if the ref is unknown
+def get_snapshot_name(ref):
+    commit = script('get-commit', ref).strip()
+    if not commit:
+        return None
+    return re.sub(rb'[^\w.,-]', b'_', ref.encode()) + b':' + commit
+
+# Adds the tags about to be indexed to those indexed after each snapshot
+def add_snapshot_tags(tag_buf):
+    for name, snapshot in list(db.snapshots.iter_items()):
+        snapshot.tags += [tag for tag in tag_buf if tag not in snapshot.tags]
+        db.snapshots.put(name, snapshot)
+    db.snapshots.sync()
+
+# Indexes the refs whose commit has no snapshot yet. Returns True if there
+# were some.
+def index_snapshots(pool, refs, ids=None, vers=None):
+    global num_tags, blob_index
+
+    # Snapshots interrupted by a previous run, even if their ref moved since
+    todo = [(name, snapshot.ref) for name, snapshot in db.snapshots.iter_items()
+            if db.checkpoints.exists(name)]
+    for ref in refs:
+        name = get_snapshot_name(ref)
+        if name is None:
+            print(project + ' - ' + ref + ': unknown ref')
+        elif not db.vers.exists(name) and name not in (n for n, _ in todo):
+            todo.append((name, ref))
+
+    if todo and blob_index is None:
+        blob_index = data.BlobIndex(db.blob)
+    if todo:
+        load_filters()
+
+    for name, ref in todo:
+        snapshot = db.snapshots.get(name)
+        if snapshot is None:
+            snapshot = data.Snapshot()
+            snapshot.seq = db.vars.get('numSnapshots') if db.vars.exists('numSnapshots') else 0
+            snapshot.ref = ref
+            db.vars.put('numSnapshots', snapshot.seq + 1, sync=True)
+            db.snapshots.put(name, snapshot, sync=True)
+
+        # Each snapshot is indexed on its own, so that the blobs it
+        # allocates are the ones between numBlobs before and after
+        checkpoint = db.checkpoints.get(name)
+        if checkpoint is not None:
+            first, last = checkpoint.first, checkpoint.last
+        else:
+            first = db.vars.get('numBlobs') if db.vars.exists('numBlobs') else 0
+
+        num_tags = 1
+        update_tags(pool, [name], (), ids, vers)
+
+        if checkpoint is None:
+            last = db.vars.get('numBlobs')
+        snapshot.owned = [(first, last)] if last > first else []
+        db.snapshots.put(name, snapshot, sync=True)
+        print(project + ' - snapshot ' + name.decode() + ': ' + str(last - first) + ' new blobs')
+
+    return len(todo) > 0
+
+# Indexes the snapshots of the refs of --ref, and removes expired ones
+def update_snapshots(pool, args, ids=None, vers=None):
+    changed = index_snapshots(pool, args.ref, ids, vers)
+    if expire_snapshots(pool, args.keep_snapshots) or changed:
+        bump_generation()
+
+# Removes the snapshots of each ref but the keep newest ones, with the blobs
+# that no other version contains. Returns True if there were some.
+def expire_snapshots(pool, keep):
+    by_ref = {}
+    for name, snapshot in sorted(db.snapshots.iter_items(), key=lambda item: item[1].seq):
+        by_ref.setdefault(snapshot.ref, []).append((name, snapshot))
+
+    expired = sorted((item for items in by_ref.values() for item in items[:-keep]),
+                     key=lambda item: item[1].seq)
+    if not expired:
+        return False
+    remaining = sorted((item for items in by_ref.values() for item in items[-keep:]),
+                       key=lambda item: item[1].seq)
+
+    contents = {} # Name of remaining snapshot -> its blob idxes
+    garbage = {} # Idx of blob to remove -> path
+    for name, snapshot in expired:
+        paths = db.vers.get(name)
+        paths = dict(paths.iter()) if paths is not None else {}
+        owned = set(snapshot.iter_owned())
+
+        for tag in snapshot.tags:
+            tag_paths = db.vers.get(tag)
+            if tag_paths is not None:
+                owned.difference_update(idx for idx, _ in tag_paths.iter())
+
+        for other_name, other in remaining:
+            if not owned:
+                break
+            if other_name not in contents:
+                other_paths = db.vers.get(other_name)
+                contents[other_name] = set(idx for idx, _ in other_paths.iter()) if other_paths else set()
+
+            handed = owned & contents[other_name]
+            if handed:
+                other.set_owned(set(other.iter_owned()) | handed)
+                owned -= handed
+
+        for idx in owned:
+            if db.hash.exists(idx):
+                garbage[idx] = paths.get(idx, '')
+
+    # Written first, the blobs handed to remaining snapshots are not lost
+    # if interrupted
+    for name, snapshot in remaining:
+        db.snapshots.put(name, snapshot)
+    db.snapshots.sync()
+
+    if garbage:
+        remove_snapshot_blobs(pool, garbage)
+
+    for name, _ in expired:
+        db.vers.delete(name)
+        db.snapshots.delete(name)
+    db.vers.sync()
+    db.snapshots.sync()
+
+    print(project + ' - expired ' + str(len(expired)) + ' snapshots, removed ' +
+          str(len(garbage)) + ' blobs')
+    return True
+
+# Removes blobs from all tables. garbage: idx -> path of the blobs
+def remove_snapshot_blobs(pool, garbage):
+    global blob_index
+
+    new_blobs = [(idx, db.hash.get(idx), db.file.get(idx)) for idx in sorted(garbage)]
+    bindings_idxes.update(idx for idx, path in garbage.items()
+                          if path.startswith('Documentation/devicetree/bindings'))
+    tasks = get_tasks(0, new_blobs, [])
+    chunksize = max(1, min(16, len(tasks) // (4*cpu)))
+
+    idents = {stage: set() for stage in stages}
+    for _, stage, _, _, result, stats in pool.imap_unordered(parse_blob, tasks, chunksize):
+        metrics.add_task(stage, stats)
+        if stage in ('defs', 'docs'):
+            idents[stage].update(entry[0] for entry in result)
+        else:
+            idents[stage].update(lib.autoBytes(ident) for ident in result)
+
+    keep = lambda idx: idx not in garbage
+    removed = {stage: set() for stage in stages} # Idents left without entries
+    for stage in stages:
+        # Like flush(), only keep references to idents that still have
+        # definitions, and strings that are still compatibles
+        if stage == 'refs':
+            idents[stage] |= removed['defs']
+        elif stage == 'comps_docs':
+            idents[stage] |= removed['comps']
+        if not idents[stage]:
+            continue
+
+        tables = get_stage_tables(stage)
+        for ident in sorted(idents[stage]):
+            obj = tables[0].get(ident)
+            if obj is None:
+                continue
 
-            self.index += self.inc
+            size = len(obj.data)
+            if ident in removed['defs'] and stage == 'refs' or \
+                    ident in removed['comps'] and stage == 'comps_docs':
+                obj.data = b''
+            else:
+                obj.filter(keep)
+            if len(obj.data) == size:
+                continue
 
-        with tags_comps_docs_lock:
-            tags_comps_docs[1] += 1
-            progress('comps_docs: Thread ' + str(tags_comps_docs[1]) + '/' + str(self.inc) + ' finished', tags_comps_docs[0])
+            if not obj.data:
+                removed[stage].add(ident)
+            if stage == 'defs':
+                put_definitions(ident, obj)
+            else:
+                put_reflist(tables[0], ident, obj)
 
-    def update_compatibles_bindings(self, idxes):
-        global hash_file_lock, comps_lock, comps_docs_lock, tags_comps_docs, bindings_idxes
+        for table in tables:
+            table.sync()
 
-        for idx in idxes:
-            if idx % 1000 == 0: progress('comps_docs: ' + str(idx), tags_comps_docs[0])
+    for idx in sorted(garbage):
+        db.blob.delete(db.hash.get(idx))
+        db.hash.delete(idx)
+        db.file.delete(idx)
+    for table in (db.blob, db.hash, db.file):
+        table.sync()
 
-            if not idx in bindings_idxes: # Parse only bindings doc files
-                continue
+    # The in-memory index still has the removed hashes
+    blob_index = None
 
-            with hash_file_lock:
-                hash = db.hash.get(idx)
 
-            family = 'B'
-            lines = compatibles_parser.run(scriptLines('get-blob', hash), family)
-            comps_docs = {}
-            with comps_lock:
-                for l in lines:
-                    ident, line = l.split(' ')
+# Daemon mode
+#
+# With --daemon, update.py does not exit once the new tags are indexed. It
+# keeps its workers, the database, the blob index and the tree of the last
+# tag, and checks the refs of the repository every few seconds with
+# 'git for-each-ref'. Tags are only listed again, and --ref snapshots taken,
+# when the output changes.
+# SIGTERM and SIGINT stop it once the tags being indexed are written, or
+# right away when it is waiting. A kill in the middle of a tag is handled by
+# the checkpoints when it is started again.
+
+stop_requested = threading.Event()
+
+def request_stop(signum, frame):
+    print(project + ' - stopping')
+    stop_requested.set()
+
+# Workers get the SIGINT of a Ctrl-C too, and a task of a killed worker
+# would never return
+def ignore_sigint():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def run_daemon(pool, build_dir, args):
+    global metrics
+
+    ids = UpdateIds()
+    vers = UpdateVersions()
+    indexed = set(db.vers.get_keys())
+    refs = None
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    while not stop_requested.is_set():
+        new_refs = script('list-refs')
+        if new_refs != refs:
+            refs = new_refs
+            metrics = Metrics(metrics.trace_memory)
+            tag_buf = get_new_tags(indexed)
+            if tag_buf:
+                index_tags(pool, build_dir, tag_buf, args, ids, vers)
+                indexed.update(tag_buf)
+                # The database is not empty anymore
+                args.bulk = False
+            if args.ref and not stop_requested.is_set():
+                update_snapshots(pool, args, ids, vers)
+            if tag_buf or args.ref:
+                write_metrics(args)
+
+        stop_requested.wait(args.interval)
+
+
+# Metrics
+#
+# Counters of a run, written with --report as JSON, and with --textfile in the
+# text format of the textfile collector of the Prometheus node exporter.
+# Workers measure each parsing task, and the script.sh calls it makes (git,
+# ctags, perl...). There are no locks to wait for: the main process is the
+# only writer. The time it waits for results of workers, and the time it
+# spends writing each stage, tell whether parsing or writing limits a run.
+
+class Metrics:
+    def __init__(self, trace_memory=False):
+        self.start = time.time()
+        self.stages = {stage: dict.fromkeys(('blobs', 'parse_seconds', 'subprocesses',
+                                             'subprocess_seconds', 'subprocess_bytes',
+                                             'idents_written', 'write_seconds'), 0)
+                       for stage in stages + deferred_stages}
+        self.new_blobs = 0
+        self.ids_seconds = 0.0 # Listing trees and allocating idxes
+        self.wait_seconds = 0.0 # Waiting for the results of workers
+        self.tags = [] # Report of each tag
+        self.last_tag = time.perf_counter()
+        # Tables count their writes since they were opened
+        self.tables_start = {table.filename: (table.puts, table.put_bytes)
+                             for table in self.get_tables()}
+        # With tracemalloc, the lines that allocated the most memory are
+        # recorded after each tag
+        self.trace_memory = trace_memory
+        if trace_memory:
+            tracemalloc.start()
+
+    # stats: returned by parse_blob()
+    def add_task(self, stage, stats):
+        seconds, count, script_seconds, script_bytes = stats
+        counters = self.stages[stage]
+        counters['blobs'] += 1
+        counters['parse_seconds'] += seconds
+        counters['subprocesses'] += count
+        counters['subprocess_seconds'] += script_seconds
+        counters['subprocess_bytes'] += script_bytes
+
+    def add_write(self, stage, idents, seconds):
+        self.stages[stage]['idents_written'] += idents
+        self.stages[stage]['write_seconds'] += seconds
+
+    def add_ids(self, new_blobs, seconds):
+        self.new_blobs += new_blobs
+        self.ids_seconds += seconds
+
+    def add_tag(self, tag, tasks):
+        now = time.perf_counter()
+        report = {
+            'tag': tag.decode(),
+            'tasks': tasks,
+            'seconds': round(now - self.last_tag, 3),
+            'peak_rss_kib': get_peak_rss(),
+        }
+        self.last_tag = now
+
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            top = tracemalloc.take_snapshot().statistics('lineno')[:10]
+            report['traced_memory'] = {
+                'current_bytes': current,
+                'peak_bytes': peak,
+                'top': [{'line': str(stat.traceback[0]), 'bytes': stat.size, 'blocks': stat.count}
+                        for stat in top],
+            }
+        self.tags.append(report)
+
+    def get_tables(self):
+        tables = [db.vars, db.blob, db.hash, db.file, db.vers, db.defs, *db.defs_cache.values(),
+                  db.refs, db.docs, db.checkpoints, db.snapshots]
+        if db.idents is not None:
+            tables += [db.idents.ids, db.idents.names]
+        if dts_comp_support:
+            tables += [db.comps, db.comps_docs]
+        return tables
+
+    def get_report(self):
+        elapsed = time.time() - self.start
+        stages_report = {}
+        for stage, counters in self.stages.items():
+            stages_report[stage] = {
+                **{name: round(value, 3) for name, value in counters.items()},
+                'blobs_per_second': round(counters['blobs'] / elapsed, 3),
+            }
+
+        tables = {}
+        for table in self.get_tables():
+            puts, put_bytes = self.tables_start[table.filename]
+            tables[os.path.basename(table.filename)[:-len('.db')]] = {
+                'puts': table.puts - puts,
+                'put_bytes': table.put_bytes - put_bytes,
+            }
+
+        parse_seconds = sum(counters['parse_seconds'] for counters in self.stages.values())
+        return {
+            'project': project,
+            'start': round(self.start, 3),
+            'seconds': round(elapsed, 3),
+            'processes': cpu,
+            'tags': len(self.tags),
+            'new_blobs': self.new_blobs,
+            'ids_seconds': round(self.ids_seconds, 3),
+            # script.sh calls of the main process, mostly listing trees
+            'ids_subprocesses': script_stats[0],
+            'ids_subprocess_seconds': round(script_stats[1], 3),
+            'worker_wait_seconds': round(self.wait_seconds, 3),
+            'worker_utilization': round(parse_seconds / (elapsed * cpu), 3),
+            'peak_rss_kib': get_peak_rss(),
+            'stages': stages_report,
+            'tables': tables,
+            'per_tag': self.tags,
+        }
+
+# Writes a file through a temporary one, so that readers never see it
+# partly written
+def write_file_atomically(path, content):
+    with open(path + '.tmp', 'w') as f:
+        f.write(content)
+    os.replace(path + '.tmp', path)
+
+def write_textfile(path, report):
+    lines = []
+    def add(name, help, values):
+        lines.append(f'# HELP elixir_update_{name} {help}')
+        lines.append(f'# TYPE elixir_update_{name} gauge')
+        for labels, value in values:
+            labels = ''.join(f',{key}="{val}"' for key, val in labels.items())
+            lines.append(f'elixir_update_{name}{{project="{project}"{labels}}} {value}')
+
+    add('last_run_timestamp_seconds', 'Start time of the last run', [({}, report['start'])])
+    add('duration_seconds', 'Duration of the last run', [({}, report['seconds'])])
+    add('tags', 'Tags indexed by the last run', [({}, report['tags'])])
+    add('new_blobs', 'New blobs of the last run', [({}, report['new_blobs'])])
+    add('ids_seconds', 'Time spent listing trees and allocating blob ids',
+        [({}, report['ids_seconds'])])
+    add('worker_wait_seconds', 'Time the main process waited for parsing results',
+        [({}, report['worker_wait_seconds'])])
+    add('worker_utilization', 'Share of the time workers spent parsing',
+        [({}, report['worker_utilization'])])
+    add('peak_rss_bytes', 'Peak resident memory of the main process',
+        [({}, report['peak_rss_kib'] * 1024)])
+
+    for name, help in (('blobs', 'Blobs parsed'),
+                       ('blobs_per_second', 'Blobs parsed per second of the run'),
+                       ('parse_seconds', 'Time workers spent parsing'),
+                       ('subprocesses', 'Subprocesses started by parsers'),
+                       ('subprocess_seconds', 'Time spent in subprocesses started by parsers'),
+                       ('subprocess_bytes', 'Bytes output by subprocesses started by parsers'),
+                       ('idents_written', 'Idents written'),
+                       ('write_seconds', 'Time spent writing to the database')):
+        add('stage_' + name, help + ', by stage',
+            [({'stage': stage}, counters[name]) for stage, counters in report['stages'].items()])
+
+    for name, help in (('puts', 'Database puts'), ('put_bytes', 'Bytes of values put')):
+        add('table_' + name, help + ', by table',
+            [({'table': table}, counters[name]) for table, counters in report['tables'].items()])
+
+    write_file_atomically(path, '\n'.join(lines) + '\n')
+
+def write_metrics(args):
+    if not args.report and not args.textfile:
+        return
+    report = metrics.get_report()
+    if args.report:
+        write_file_atomically(args.report, json.dumps(report, indent=2) + '\n')
+    if args.textfile:
+        write_textfile(args.textfile, report)
+
+
+# Peak resident memory of the main process, in KiB
+def get_peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
 
-                    if db.comps.exists(ident):
-                        if ident in comps_docs:
-                            comps_docs[ident] += ',' + str(line)
-                        else:
-                            comps_docs[ident] = str(line)
+def progress(msg, current):
+    print('{} - {} ({:.1%})'.format(project, msg, current/num_tags))
 
-            with comps_docs_lock:
-                for ident, lines in comps_docs.items():
-                    if db.comps_docs.exists(ident):
-                        obj = db.comps_docs.get(ident)
-                    else:
-                        obj = data.RefList()
 
-                    obj.append(idx, lines, family)
-                    if verbose:
-                        print(f"comps_docs: {ident} in #{idx} @ {line}")
-                    db.comps_docs.put(ident, obj)
+def main():
+    global db, dts_comp_support, project, cpu, incremental, metrics, read_packs, stoplist
+
+    parser = argparse.ArgumentParser(description="Index new tags of the current project.")
+    parser.add_argument('cpu', type=int, nargs='?', default=cpu,
+                        help="number of processes parsing files")
+    parser.add_argument('--incremental', action='store_true',
+                        help="only look at the files that changed since the previous tag, "
+                             "instead of listing all files of each tag")
+    parser.add_argument('--newest-first', type=int, default=0, metavar='N',
+                        help="index the N newest new tags first, newest one first, "
+                             "then the older ones")
+    parser.add_argument('--bulk', action='store_true',
+                        help="for an empty database: write each table in key order once all "
+                             "tags are parsed, instead of updating it after each tag")
+    parser.add_argument('--shadow', action='store_true',
+                        help="build a new generation of the database next to the current one, "
+                             "and switch to it when complete")
+    parser.add_argument('--daemon', action='store_true',
+                        help="keep running, and index new tags as soon as they appear")
+    parser.add_argument('--interval', type=float, default=5, metavar='SECONDS',
+                        help="with --daemon, how often to check the tags of the repository "
+                             "(default: %(default)s)")
+    parser.add_argument('--ref', action='append', default=[],
+                        help="also index the current commit of this branch or commit as a "
+                             "snapshot version, can be given several times")
+    parser.add_argument('--keep-snapshots', type=int, default=7, metavar='N',
+                        help="number of snapshots of each ref to keep (default: %(default)s)")
+    parser.add_argument('--report', metavar='FILE',
+                        help="write metrics of the run to this file, as JSON")
+    parser.add_argument('--textfile', metavar='FILE',
+                        help="write metrics of the run to this file, for the textfile collector "
+                             "of the Prometheus node exporter (use one file per project)")
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help="with --report, record the lines that allocated the most memory "
+                             "after each tag (slow)")
+    parser.add_argument('--read-packs', action='store_true',
+                        help="read blobs from the pack files of the repository instead of "
+                             "starting git for each of them")
+    args = parser.parse_args()
+    if args.keep_snapshots < 1:
+        parser.error("--keep-snapshots must be at least 1")
+    if args.bulk and args.newest_first:
+        parser.error("--bulk writes all tags at the end, it cannot be used with --newest-first")
+    if args.daemon and args.shadow:
+        parser.error("--shadow builds a copy of the database each time, it cannot be used with --daemon")
+
+    cpu = max(args.cpu, 1)
+    incremental = args.incremental
+    read_packs = args.read_packs
+
+    dts_comp_support = int(script('dts-comp'))
+    project = lib.currentProject()
+
+    data_dir = lib.getDataDir().rstrip('/')
+    build_dir = data_dir
+    if args.shadow:
+        build_dir = start_shadow_build(data_dir, args.ref)
+        if build_dir is None:
+            print(project + ' - found 0 new tags')
+            return
+
+    stoplist = lib.getStopList(build_dir)
+    with Pool(cpu, init_worker, (read_packs, stoplist, args.daemon)) as pool:
+        db = data.DB(build_dir, readonly=False, shared=True, dtscomp=dts_comp_support)
+        metrics = Metrics(args.tracemalloc and args.report is not None)
+
+        resume_checkpoints()
+
+        if args.daemon:
+            run_daemon(pool, build_dir, args)
+        else:
+            ids = UpdateIds()
+            vers = UpdateVersions()
+            tag_buf = get_new_tags(set(db.vers.get_keys()))
+            if not index_tags(pool, build_dir, tag_buf, args, ids, vers) and \
+                    db.defs_cache['C'].db.stat()['nkeys'] == 0:
+                # Backward-compatibility: generate defs caches if they are empty.
+                generate_defs_caches()
+            if args.ref:
+                update_snapshots(pool, args, ids, vers)
+            write_metrics(args)
 
+        db.close()
 
-def progress(msg, current):
-    print('{} - {} ({:.1%})'.format(project, msg, current/num_tags))
+    if args.shadow:
+        finish_shadow_build(data_dir, build_dir)
 
 
-# Main
-
-# Check number of threads arg
-if len(argv) >= 2 and argv[1].isdigit() :
-    cpu = int(argv[1])
-
-    if cpu < 5 :
-        cpu = 5
-
-# Distribute threads among functions using the following rules :
-# There are more (or equal) refs threads than others
-# There are more (or equal) defs threads than docs or comps threads
-# Example : if cpu=6 : defs=1, refs=2, docs=1, comps=1, comps_docs=1
-#           if cpu=7 : defs=2, refs=2, docs=1, comps=1, comps_docs=1
-#           if cpu=8 : defs=2, refs=3, docs=1, comps=1, comps_docs=1
-#           if cpu=11: defs=2, refs=3, docs=2, comps=2, comps_docs=2
-quo, rem = divmod(cpu, 5)
-num_th_refs = quo
-num_th_defs = quo
-num_th_docs = quo
-
-# If DT bindings support is enabled, use $quo threads for each of the 2 threads
-# Otherwise add them to the remaining threads
-if dts_comp_support:
-    num_th_comps = quo
-    num_th_comps_docs = quo
-else :
-    num_th_comps = 0
-    num_th_comps_docs = 0
-    rem += 2*quo
-
-quo, rem = divmod(rem, 2)
-num_th_defs += quo
-num_th_refs += quo + rem
-
-tag_buf = []
-for tag in scriptLines('list-tags'):
-    if not db.vers.exists(tag):
-        tag_buf.append(tag)
-
-num_tags = len(tag_buf)
-project = lib.currentProject()
-
-print(project + ' - found ' + str(num_tags) + ' new tags')
-
-if not num_tags:
-    # Backward-compatibility: generate defs caches if they are empty.
-    if db.defs_cache['C'].db.stat()['nkeys'] == 0:
-        generate_defs_caches()
-    exit(0)
-
-threads_list.append(UpdateIds(tag_buf))
-threads_list.append(UpdateVersions(tag_buf))
-
-# Define defs threads
-for i in range(num_th_defs):
-    threads_list.append(UpdateDefs(i, num_th_defs))
-# Define refs threads
-for i in range(num_th_refs):
-    threads_list.append(UpdateRefs(i, num_th_refs))
-# Define docs threads
-for i in range(num_th_docs):
-    threads_list.append(UpdateDocs(i, num_th_docs))
-# Define comps threads
-for i in range(num_th_comps):
-    threads_list.append(UpdateComps(i, num_th_comps))
-# Define comps_docs threads
-for i in range(num_th_comps_docs):
-    threads_list.append(UpdateCompsDocs(i, num_th_comps_docs))
-
-
-# Start to process tags
-threads_list[0].start()
-
-# Wait until the first tag is ready
-with tag_ready:
-    tag_ready.wait()
-
-# Start remaining threads
-for i in range(1, len(threads_list)):
-    threads_list[i].start()
-
-# Make sure all threads finished
-for i in range(len(threads_list)):
-    threads_list[i].join()
+if __name__ == "__main__":
+    main()
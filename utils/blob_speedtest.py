@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+#  This file is part of Elixir, a source code cross-referencer.
+#
+#  Elixir is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Elixir is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with Elixir.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compares reading the blobs of a tag through script.sh and git cat-file,
+# and with the pack reader of update.py --read-packs.
+# Example call: `python3 -m utils.blob_speedtest v6.1 --max 2000`
+
+import argparse
+import time
+
+from elixir import lib
+from elixir import gitpack
+
+def main():
+    parser = argparse.ArgumentParser(description="Time reading the blobs of a tag with "
+                                                 "git cat-file and with the pack reader.")
+    parser.add_argument('tag', help="tag whose blobs are read, in list-blobs order")
+    parser.add_argument('--max', type=int, default=1000,
+                        help="number of blobs to read (default: %(default)s)")
+    args = parser.parse_args()
+
+    hashes = lib.scriptLines('list-blobs', args.tag)[:args.max]
+    if not hashes:
+        print(f"{args.tag}: no blobs")
+        return 1
+
+    start = time.perf_counter()
+    blobs = [lib.script('get-blob', hash) for hash in hashes]
+    git_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    reader = gitpack.PackReader(lib.getRepoDir())
+    contents = [reader.get_blob(hash) for hash in hashes]
+    pack_time = time.perf_counter() - start
+
+    missing = sum(1 for content in contents if content is None)
+    different = sum(1 for blob, content in zip(blobs, contents)
+                    if content is not None and content != blob)
+    size = sum(len(blob) for blob in blobs)
+
+    print(f"{len(hashes)} blobs, {size / (1 << 20):.1f} MiB")
+    print(f"script.sh:    {git_time:.2f}s, {git_time / len(hashes) * 1000:.2f} ms/blob")
+    print(f"pack reader:  {pack_time:.2f}s, {pack_time / len(hashes) * 1000:.2f} ms/blob, "
+          f"{missing} not in a pack")
+    if different:
+        print(f"error: {different} blobs differ")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,509 @@
+#!/usr/bin/env python3
+
+#  This file is part of Elixir, a source code cross-referencer.
+#
+#  Elixir is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Elixir is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with Elixir.  If not, see <http://www.gnu.org/licenses/>.
+
+# Maintenance commands for the database of the current project.
+# Example call: `python3 -m utils.maintenance check-defs-caches`
+
+import os
+import os.path
+import shutil
+import time
+from collections import Counter
+
+from elixir import lib
+from elixir import data
+
+# Rebuilds the definitions caches from scratch and compares them with the
+# ones maintained by update.py. With fix, the caches are updated to match.
+def cmd_check_defs_caches(fix, **kwargs):
+    db = data.DB(lib.getDataDir(), readonly=not fix)
+
+    expected = {family: set() for family in lib.CACHED_DEFINITIONS_FAMILIES}
+    for ident, deflist in db.defs.iter_items():
+        for family in deflist.get_cache_families():
+            expected[family].add(ident)
+
+    errors = 0
+    for family in lib.CACHED_DEFINITIONS_FAMILIES:
+        cache = db.defs_cache[family]
+        actual = set(cache.get_keys())
+        missing = expected[family] - actual
+        extra = actual - expected[family]
+        errors += len(missing) + len(extra)
+
+        print(f"{family}: {len(actual)} idents, {len(missing)} missing, {len(extra)} extra")
+        for ident in sorted(missing):
+            print(f"  missing: {ident.decode()}")
+            if fix:
+                cache.put(ident, b'')
+        for ident in sorted(extra):
+            print(f"  extra: {ident.decode()}")
+            if fix:
+                cache.delete(ident)
+
+    db.close()
+    return errors
+
+# Applies keep to the blob IDs of all definitions, and updates the
+# definitions caches of the idents that changed
+def prune_definitions(db, keep):
+    updated = 0
+    removed = 0
+    for ident in db.defs.get_keys():
+        obj = db.defs.get(ident)
+        size = len(obj.data)
+        obj.filter(keep)
+        if len(obj.data) == size:
+            continue
+
+        if obj.data:
+            db.defs.put(ident, obj)
+            families = obj.get_cache_families()
+            updated += 1
+        else:
+            db.defs.delete(ident)
+            families = []
+            removed += 1
+
+        for family, cache in db.defs_cache.items():
+            if family in families:
+                cache.put(ident, b'')
+            elif cache.exists(ident):
+                cache.delete(ident)
+
+    print(f"definitions.db: {updated} idents updated, {removed} removed")
+
+# Applies keep to the blob IDs of all values of a RefListDB.
+# known: if set, idents that do not exist in this table are removed, like
+# update.py does not add them
+def prune_reflists(table, keep, known=None):
+    updated = 0
+    removed = 0
+    for ident in table.get_keys():
+        if known is not None and not known.exists(ident):
+            table.delete(ident)
+            removed += 1
+            continue
+
+        obj = table.get(ident)
+        size = len(obj.data)
+        obj.filter(keep)
+        if len(obj.data) == size:
+            continue
+
+        if obj.data:
+            table.put(ident, obj)
+            updated += 1
+        else:
+            table.delete(ident)
+            removed += 1
+
+    print(f"{os.path.basename(table.filename)}: {updated} idents updated, {removed} removed")
+
+# Removes tags, then the blobs that no remaining tag contains from all tables.
+# Nothing else must use the database meanwhile.
+def cmd_prune(tags, **kwargs):
+    db = data.DB(lib.getDataDir(), readonly=False, dtscomp=int(lib.script('dts-comp')))
+
+    if len(db.checkpoints):
+        print("update.py was interrupted, run it again first")
+        db.close()
+        return 1
+
+    for tag in tags:
+        if not db.vers.exists(tag):
+            print(f"{tag}: unknown tag")
+            db.close()
+            return 1
+
+    for tag in tags:
+        db.vers.delete(tag)
+
+    used = set()
+    for _, paths in db.vers.iter_items():
+        for idx, _ in paths.iter():
+            used.add(idx)
+
+    unused = set(int(idx) for idx in db.hash.get_keys()) - used
+    print(f"{len(tags)} tags removed, {len(unused)} blobs no longer used")
+
+    if unused:
+        keep = lambda idx: idx not in unused
+        prune_definitions(db, keep)
+        # Only keep references to idents that still have definitions
+        prune_reflists(db.refs, keep, db.defs)
+        prune_reflists(db.docs, keep)
+        if db.dtscomp:
+            prune_reflists(db.comps, keep)
+            prune_reflists(db.comps_docs, keep, db.comps)
+
+        for idx in sorted(unused):
+            db.blob.delete(db.hash.get(idx))
+            db.hash.delete(idx)
+            db.file.delete(idx)
+
+    # Tell the web interface that the list of tags changed, as update.py does
+    generation = db.vars.get('generation') if db.vars.exists('generation') else 0
+    db.vars.put('generation', generation + 1, sync=True)
+
+    db.close()
+    return 0
+
+def format_size(size):
+    return f"{size / (1024*1024):.1f} MiB"
+
+# Rewrites every table of the database in key order, which packs B-tree pages
+# densely. Without output, the tables are replaced in place: nothing else
+# must use the database meanwhile. With output, compacted copies are written
+# to that directory, for example the next generation of a shadow build.
+def cmd_compact(output, **kwargs):
+    data_dir = lib.getDataDir()
+    if output is not None:
+        os.makedirs(output, exist_ok=True)
+
+    errors = 0
+    total_before = 0
+    total_after = 0
+    for name in sorted(os.listdir(data_dir)):
+        if not name.endswith('.db'):
+            continue
+
+        src_path = os.path.join(data_dir, name)
+        if output is not None:
+            dst_path = os.path.join(output, name)
+        else:
+            dst_path = src_path + '.compact'
+        if os.path.exists(dst_path):
+            os.remove(dst_path)
+
+        src = data.BsdDB(src_path, True, lambda x: x)
+        dst = data.BsdDB(dst_path, False, lambda x: x)
+        copied = 0
+        for key, value in src.iter_items():
+            dst.put(key, value)
+            copied += 1
+        dst.close()
+
+        # Check the number of entries of the copy as read back from disk
+        dst = data.BsdDB(dst_path, True, lambda x: x)
+        counts = (len(src), copied, len(dst))
+        src.close()
+        dst.close()
+
+        before = os.path.getsize(src_path)
+        after = os.path.getsize(dst_path)
+        if counts[0] != counts[1] or counts[1] != counts[2]:
+            print(f"{name}: entry count mismatch: {counts[0]} in the table, {counts[1]} copied, "
+                  f"{counts[2]} in the copy")
+            os.remove(dst_path)
+            errors += 1
+            continue
+
+        print(f"{name}: {copied} entries, {format_size(before)} -> {format_size(after)}")
+        total_before += before
+        total_after += after
+        if output is None:
+            os.replace(dst_path, src_path)
+
+    print(f"total: {format_size(total_before)} -> {format_size(total_after)}")
+    return errors
+
+# Returns the latest tag of the database, excluding release candidates
+def get_latest_tag(db):
+    for tag in lib.scriptLines('get-latest-tags'):
+        if db.vers.exists(tag):
+            return tag
+    return None
+
+# Lists the idents with more than threshold references in the blobs of a
+# tag, the latest one by default. With apply, adds them to the stop list
+# of the project and removes their references: update.py does not index
+# them anymore. Nothing else must use the database meanwhile.
+def cmd_stoplist(threshold, tag, apply, **kwargs):
+    data_dir = lib.getDataDir()
+    db = data.DB(data_dir, readonly=not apply)
+
+    tag = tag.encode() if tag is not None else get_latest_tag(db)
+    if tag is None or not db.vers.exists(tag):
+        print(f"{tag.decode() if tag else 'latest tag'}: unknown tag")
+        db.close()
+        return 1
+    blobs = set(idx for idx, _ in db.vers.get(tag).iter())
+
+    # Number of reference lines of each ident in the blobs of the tag, and
+    # size of its whole entry
+    counts = {}
+    sizes = {}
+    total_refs = 0
+    total_size = 0
+    for ident, obj in db.refs.iter_items():
+        refs = 0
+        for entry in obj.data.split(b'\n')[:-1]:
+            idx, lines, _ = entry.split(b':', 2)
+            if int(idx) in blobs:
+                refs += lines.count(b',') + 1
+        total_refs += refs
+        total_size += len(obj.data)
+        if refs > threshold:
+            counts[ident] = refs
+            sizes[ident] = len(obj.data)
+
+    stoplist = lib.getStopList(data_dir)
+    print(f"{'ident':32} {'refs':>10} {'size':>10}")
+    for ident in sorted(counts, key=counts.get, reverse=True):
+        print(f"{ident.decode():32} {counts[ident]:10} {format_size(sizes[ident]):>10}")
+
+    refs = sum(counts.values())
+    size = sum(sizes.values())
+    print(f"{len(counts)} idents with more than {threshold} references in {tag.decode()}, "
+          f"which update.py would not write for tags like it: {refs / max(total_refs, 1):.1%} "
+          f"of its references")
+    print(f"references.db: {format_size(size)} of {format_size(total_size)} for these idents")
+
+    if apply and counts:
+        path = os.path.join(data_dir, 'stoplist')
+        with open(path, 'a+b') as f:
+            f.seek(max(f.tell() - 1, 0))
+            last = f.read(1)
+            if last and last != b'\n':
+                f.write(b'\n')
+            for ident in sorted(counts):
+                if ident not in stoplist:
+                    f.write(ident + b'\n')
+        for ident in counts:
+            db.refs.delete(ident)
+        print(f"{path}: idents added, and their references removed. "
+              f"Run compact to reclaim the space.")
+
+    db.close()
+    return 0
+
+# Writes a copy of the database to output, with references and doc comments
+# keyed by ident ID instead of name, like update.py writes new databases.
+# Values are copied as stored, compressed or not. update.py must not run
+# meanwhile, the web interface can.
+def cmd_ident_ids(output, **kwargs):
+    data_dir = lib.getDataDir()
+    db = data.DB(data_dir, readonly=True)
+    if db.idents is not None:
+        print("references are already keyed by ident ID")
+        db.close()
+        return 0
+
+    if os.path.exists(data_dir + '/checkpoints.db'):
+        checkpoints = data.BsdDB(data_dir + '/checkpoints.db', True, data.Checkpoint)
+        interrupted = len(checkpoints) > 0
+        checkpoints.close()
+        if interrupted:
+            print("update.py was interrupted, run it again first")
+            db.close()
+            return 1
+
+    if os.path.exists(output) and os.listdir(output):
+        print(f"{output}: not empty")
+        db.close()
+        return 1
+    os.makedirs(output, exist_ok=True)
+
+    tables = [db.refs, db.docs]
+    names = [os.path.basename(table.filename) for table in tables]
+    for name in sorted(os.listdir(data_dir)):
+        path = os.path.join(data_dir, name)
+        if name not in names and os.path.isfile(path):
+            shutil.copy2(path, os.path.join(output, name))
+
+    vars = data.BsdDB(output + '/variables.db', False, lambda x: int(x.decode()))
+    idents = data.IdentDict(output, False, vars)
+    for table, name in zip(tables, names):
+        # Walked in name order, references get IDs in the same order, and
+        # are written in key order
+        dst = data.BsdDB(os.path.join(output, name), False, lambda x: x)
+        cur = table.db.cursor()
+        rec = cur.first()
+        while rec is not None:
+            key, value = rec
+            ident, sep, n = key.partition(b'\0')
+            dst.db.put(idents.pack_id(idents.add(ident)) + sep + n, value)
+            rec = cur.next()
+        cur.close()
+        dst.close()
+        print(f"{name}: {len(table)} keys copied")
+
+    idents.sync()
+    print(f"{len(idents.ids)} idents given an ID")
+    idents.close()
+    vars.close()
+    db.close()
+    print(f"Replace the data directory with {output} once update.py is not running")
+    return 0
+
+# Returns a zlib preset dictionary of size bytes made of the most common
+# substrings of samples, the most common ones last as they are the cheapest
+# to refer to
+def train_dictionary(samples, size=16*1024, n=8):
+    counts = Counter()
+    for sample in samples:
+        for i in range(len(sample) - n):
+            counts[sample[i:i+n]] += 1
+    return b''.join(reversed([gram for gram, _ in counts.most_common(size // n)]))
+
+# Returns up to limit bytes of values of at least threshold bytes, taken
+# across the whole table
+def sample_values(table, threshold, limit=1 << 20):
+    keys = table.db.keys()
+    step = max(1, len(keys) // 1000)
+    samples = []
+    total = 0
+    for key in keys[::step]:
+        value = table.get_raw(key)
+        if len(value) >= threshold and not value.startswith(b'@'):
+            samples.append(value)
+            total += len(value)
+            if total >= limit:
+                break
+    return samples
+
+# Rewrites all values of a table with its current codec. Returns the size of
+# the values, stored before and after, the number of compressed values and
+# the time to decode them.
+def rewrite_values(table):
+    raw = before = after = 0
+    compressed = 0
+    decode_time = 0
+    for key in table.db.keys():
+        stored = table.db.get(key)
+        value = table.get_raw(key)
+        table.put_raw(key, value)
+        new = table.db.get(key)
+
+        if new.startswith(data.ZlibCodec.marker):
+            start = time.perf_counter()
+            table.codec.decode(new)
+            decode_time += time.perf_counter() - start
+            compressed += 1
+        raw += len(value)
+        before += len(stored)
+        after += len(new)
+    table.sync()
+    return raw, before, after, compressed, decode_time
+
+# Compresses the values of tables that are at least threshold bytes long,
+# with a preset dictionary trained on the table, and prints the space saved
+# and the decoding cost. With off, values are stored uncompressed again.
+# update.py then writes values the same way. Nothing else must use the
+# database meanwhile.
+def cmd_compress(tables, threshold, level, off, **kwargs):
+    data_dir = lib.getDataDir()
+    # Created first, so that the tables are opened with their codecs
+    data.BsdDB(data_dir + '/codecs.db', False, lambda x: x).close()
+    db = data.DB(data_dir, readonly=False, dtscomp=int(lib.script('dts-comp')))
+
+    if len(db.checkpoints):
+        print("update.py was interrupted, run it again first")
+        db.close()
+        return 1
+
+    for table in db.get_codec_tables():
+        name = os.path.basename(table.filename)[:-len('.db')]
+        if tables and name not in tables:
+            continue
+
+        name = name.encode()
+        dictionaries = table.codec.dictionaries if table.codec is not None else {}
+        if off:
+            if table.codec is None:
+                # Never compressed
+                continue
+            if db.codecs.exists(name):
+                db.codecs.delete(name)
+            current = None
+        else:
+            current = max(dictionaries, default=0) + 1
+            if current > 255:
+                print(f"{name.decode()}: too many dictionaries, run with --off first")
+                continue
+            table.codec = data.ZlibCodec(dictionaries)
+            zdict = train_dictionary(sample_values(table, threshold))
+            db.codecs.put(name + b':' + str(current).encode(), zdict)
+            db.codecs.put(name, f'{current} {threshold} {level}')
+        db.codecs.sync()
+        db.load_codecs()
+
+        raw, before, after, compressed, decode_time = rewrite_values(table)
+        print(f"{name.decode()}: values {format_size(raw)}, stored {format_size(before)} -> "
+              f"{format_size(after)} ({after / max(raw, 1):.0%}), {compressed} values "
+              f"compressed, {decode_time / max(compressed, 1) * 1e6:.0f} us to decode each")
+
+    print("Run compact to reclaim the space in the files")
+    db.close()
+    return 0
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(required=True)
+
+    cache_subparser = subparsers.add_parser('check-defs-caches',
+                                            help="Rebuild the definitions caches and compare them with the database")
+    cache_subparser.add_argument('--fix', action='store_true', help="Update the caches to match")
+    cache_subparser.set_defaults(func=cmd_check_defs_caches)
+
+    prune_subparser = subparsers.add_parser('prune',
+                                            help="Remove tags and the blobs only they contain")
+    prune_subparser.add_argument('tags', nargs='+', help="Tags to remove")
+    prune_subparser.set_defaults(func=cmd_prune)
+
+    compact_subparser = subparsers.add_parser('compact',
+                                              help="Rewrite all tables in key order to reclaim space")
+    compact_subparser.add_argument('--output', help="Write compacted copies to this directory "
+                                                    "instead of replacing the tables in place")
+    compact_subparser.set_defaults(func=cmd_compact)
+
+    stoplist_subparser = subparsers.add_parser('stoplist',
+                                               help="List the idents with the most references, "
+                                                    "and stop indexing their references")
+    stoplist_subparser.add_argument('--threshold', type=int, default=20000,
+                                    help="Minimum number of references in the tag (default: %(default)s)")
+    stoplist_subparser.add_argument('--tag', help="Tag to count references in (default: latest tag)")
+    stoplist_subparser.add_argument('--apply', action='store_true',
+                                    help="Add the idents to the stop list of the project, "
+                                         "and remove their references")
+    stoplist_subparser.set_defaults(func=cmd_stoplist)
+
+    ident_ids_subparser = subparsers.add_parser('ident-ids',
+                                                help="Write a copy of the database with references "
+                                                     "keyed by ident ID")
+    ident_ids_subparser.add_argument('output', help="Empty directory to write the copy to")
+    ident_ids_subparser.set_defaults(func=cmd_ident_ids)
+
+    compress_subparser = subparsers.add_parser('compress',
+                                               help="Compress large values of the tables, "
+                                                    "and print the space saved")
+    compress_subparser.add_argument('tables', nargs='*',
+                                    help="Tables to compress, for example references "
+                                         "(default: all that can be)")
+    compress_subparser.add_argument('--threshold', type=int, default=512,
+                                    help="Minimum size of the values to compress (default: %(default)s)")
+    compress_subparser.add_argument('--level', type=int, default=6,
+                                    help="zlib compression level (default: %(default)s)")
+    compress_subparser.add_argument('--off', action='store_true',
+                                    help="Store the values uncompressed again")
+    compress_subparser.set_defaults(func=cmd_compress)
+
+    args = parser.parse_args()
+    exit(1 if args.func(**vars(args)) else 0)
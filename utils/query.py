@@ -7,7 +7,7 @@ def cmd_stats(q, **kwargs):
     if len(q.db.blob) != len(q.db.hash) or len(q.db.hash) != len(q.db.file):
         print("Warning, number of blobs, hashes or files is not equal")
     print("Definitions: ", len(q.db.defs))
-    print("References: ", len(q.db.refs))
+    print("References: ", len(q.db.refs.get_keys()))
 
 def cmd_versions(q, **kwargs):
     for major in q.get_versions().values():
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+
+#  This file is part of Elixir, a source code cross-referencer.
+#
+#  Elixir is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Elixir is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with Elixir.  If not, see <http://www.gnu.org/licenses/>.
+
+# Runs update.py for all projects of LXR_PROJ_DIR at the same time, sharing
+# one budget of parsing processes between them.
+# Example call: `python3 -m utils.update_all 16 -- --incremental`
+#
+# Projects with the most new tags are started first, and get an equal share
+# of the processes left, up to --jobs projects at a time. The processes of a
+# project are given to the next ones when it is done. Projects without new
+# tags are run last, with a single process.
+
+import argparse
+import os
+import os.path
+import re
+import resource
+import subprocess
+import sys
+import threading
+import time
+from queue import SimpleQueue
+
+from elixir import lib
+from elixir import data
+
+ELIXIR_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+found_regex = re.compile(r'^\S+ - found (\d+) new tags$')
+tag_done_regex = re.compile(r'^\S+ - \S+: \d+ parsing tasks done')
+
+class Project:
+    '''update.py run of a project'''
+    def __init__(self, name, basedir):
+        self.name = name
+        self.data_dir = os.path.join(basedir, name, 'data')
+        self.repo_dir = os.path.join(basedir, name, 'repo')
+        self.new_tags = 0 # Tags to index, or -1 if an interrupted run has to be resumed
+        self.found = 0 # Tags update.py found to index
+        self.done = 0 # Tags written by update.py
+        self.cpu = 0
+        self.start = None
+        self.end = None
+        self.returncode = None
+
+    def get_env(self):
+        return {
+            **os.environ,
+            'LXR_REPO_DIR': self.repo_dir,
+            'LXR_DATA_DIR': self.data_dir,
+        }
+
+    # Counts the tags update.py will index, without opening the database for
+    # writing
+    def count_new_tags(self):
+        data_dir = os.path.realpath(self.data_dir)
+        tags = lib.scriptLines('list-tags', env=self.get_env())
+        if not os.path.exists(data_dir + '/versions.db'):
+            self.new_tags = len(tags)
+            return
+
+        if os.path.exists(data_dir + '/checkpoints.db'):
+            checkpoints = data.BsdDB(data_dir + '/checkpoints.db', True, data.Checkpoint)
+            interrupted = len(checkpoints) > 0
+            checkpoints.close()
+            if interrupted:
+                self.new_tags = -1
+                return
+
+        vers = data.BsdDB(data_dir + '/versions.db', True, data.PathList)
+        self.new_tags = sum(1 for tag in tags if not vers.exists(tag))
+        vers.close()
+
+# Returns the projects of basedir that have a data and a repo directory
+def get_projects(basedir, names):
+    projects = []
+    for name in names or sorted(os.listdir(basedir)):
+        project = Project(name, basedir)
+        if os.path.isdir(project.data_dir) and os.path.isdir(project.repo_dir):
+            projects.append(project)
+        elif names:
+            print(f"{name}: no data or repo directory in {basedir}")
+    return projects
+
+class Scheduler:
+    def __init__(self, projects, cpu, jobs, update_args):
+        self.projects = projects
+        self.cpu = cpu
+        self.jobs = jobs
+        self.update_args = update_args
+        self.free = cpu
+        self.running = []
+        self.finished = SimpleQueue() # Projects whose update.py exited
+        self.lock = threading.Lock() # Serializes the output of all projects
+        self.start = time.time()
+        self.total_tags = 0
+
+    def run(self):
+        # Interrupted runs first, then by number of new tags
+        pending = sorted(self.projects, key=lambda p: p.new_tags if p.new_tags >= 0 else float('inf'),
+                         reverse=True)
+        with_tags = sum(1 for p in pending if p.new_tags != 0)
+        self.total_tags = sum(p.new_tags for p in pending if p.new_tags > 0)
+
+        while pending or self.running:
+            while pending and self.free and len(self.running) < self.jobs:
+                project = pending.pop(0)
+                if project.new_tags:
+                    with_tags -= 1
+                    # Equal share of what is left between the next projects
+                    # with new tags that can run
+                    slots = min(self.jobs - len(self.running), with_tags + 1)
+                    project.cpu = max(1, self.free // slots)
+                else:
+                    project.cpu = 1
+                self.launch(project)
+
+            project = self.finished.get()
+            self.running.remove(project)
+            self.free += project.cpu
+
+    def launch(self, project):
+        self.free -= project.cpu
+        self.running.append(project)
+        project.start = time.time()
+        self.print(f"{project.name} - starting with {project.cpu} processes, "
+                   f"{project.new_tags if project.new_tags >= 0 else 'interrupted run,'} new tags")
+
+        p = subprocess.Popen([sys.executable, os.path.join(ELIXIR_DIR, 'update.py'),
+                              str(project.cpu), *self.update_args],
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                             env=project.get_env())
+        threading.Thread(target=self.follow, args=(project, p), daemon=True).start()
+
+    # Prints the output of update.py, and counts the tags it writes
+    def follow(self, project, p):
+        for line in p.stdout:
+            line = line.decode(errors='replace').rstrip('\n')
+            match = found_regex.match(line)
+            if match:
+                project.found = int(match.group(1))
+                if project.new_tags < 0:
+                    self.total_tags += project.found
+            elif tag_done_regex.match(line):
+                project.done += 1
+                line += '  [' + self.get_progress() + ']'
+            self.print(line)
+
+        project.returncode = p.wait()
+        project.end = time.time()
+        if project.returncode:
+            self.print(f"{project.name} - update.py failed with status {project.returncode}")
+        self.finished.put(project)
+
+    def get_progress(self):
+        elapsed = time.time() - self.start
+        done = sum(p.done for p in self.projects)
+        return (f"all: {done}/{self.total_tags} tags, {len(self.running)} projects running, "
+                f"{done / elapsed * 60:.1f} tags/min")
+
+    def print(self, line):
+        with self.lock:
+            print(line, flush=True)
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes // 60}:{minutes % 60:02}:{seconds:02}"
+
+def print_summary(projects, scheduler):
+    elapsed = time.time() - scheduler.start
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_time = usage.ru_utime + usage.ru_stime
+
+    print()
+    print(f"{'project':20} {'procs':>5} {'tags':>6} {'time':>9} {'tags/min':>9}  status")
+    for p in projects:
+        duration = p.end - p.start
+        rate = p.done / duration * 60 if duration else 0
+        status = 'ok' if p.returncode == 0 else f'failed ({p.returncode})'
+        print(f"{p.name:20} {p.cpu:5} {p.done:6} {format_duration(duration):>9} {rate:9.1f}  {status}")
+
+    done = sum(p.done for p in projects)
+    print(f"total: {done} tags in {format_duration(elapsed)}, {done / elapsed * 60:.1f} tags/min, "
+          f"{cpu_time / (elapsed * scheduler.cpu):.0%} of {scheduler.cpu} processes used")
+
+def main():
+    parser = argparse.ArgumentParser(description="Index new tags of all projects with a "
+                                                 "global number of processes.")
+    parser.add_argument('cpu', type=int, nargs='?', default=os.cpu_count(),
+                        help="number of processes parsing files, for all projects")
+    parser.add_argument('--jobs', type=int, default=4,
+                        help="maximum number of projects indexed at the same time (default: %(default)s)")
+    parser.add_argument('--project', action='append', dest='projects',
+                        help="only index this project, can be given several times")
+    parser.epilog = "Options after -- are given to update.py, for example: -- --incremental"
+
+    argv = sys.argv[1:]
+    update_args = []
+    if '--' in argv:
+        update_args = argv[argv.index('--')+1:]
+        argv = argv[:argv.index('--')]
+    args = parser.parse_args(argv)
+
+    if 'LXR_PROJ_DIR' not in os.environ:
+        print(sys.argv[0] + ': LXR_PROJ_DIR needs to be set')
+        return 1
+
+    projects = get_projects(os.environ['LXR_PROJ_DIR'], args.projects)
+    for project in projects:
+        project.count_new_tags()
+
+    scheduler = Scheduler(projects, max(args.cpu, 1), max(args.jobs, 1), update_args)
+    scheduler.run()
+    print_summary(projects, scheduler)
+
+    return 1 if any(p.returncode for p in projects) else 0
+
+if __name__ == "__main__":
+    exit(main())